@@ -69,35 +69,8 @@ def validate_backup_results_file(backup_results_file, max_age):
             nagios_exit(NAGIOS_STATUS_CRITICAL, message)
 
 
-def main():
-    """Call main function."""
-    parser = argparse.ArgumentParser(
-        description="check auto_backup scrpt results",
-        # show default in help
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-    )
-
-    parser.add_argument(
-        "-f",
-        "--backup-results-file",
-        dest="backup_results_file",
-        default=AUTO_BACKUP_RESULTS_PATH,
-        help="backups results file to check",
-    )
-
-    parser.add_argument(
-        "-a",
-        "--backup-results-max-age",
-        dest="backup_results_max_age",
-        type=int,
-        default=25,
-        help="backup results file max age in hours, 0 to ignore",
-    )
-
-    args = parser.parse_args()
-    backup_results_file = pathlib.Path(args.backup_results_file)
-    max_age = args.backup_results_max_age
-
+def check_backup_results_file(backup_results_file, max_age):
+    """Check a backup results file, exit with a CRITICAL status on the first issue."""
     validate_backup_results_file(backup_results_file, max_age)
 
     raw_backup_results = backup_results_file.read_text(encoding="utf-8")
@@ -146,6 +119,62 @@ def main():
             f"Invalid backup results file: {backup_results_file}",
         )
 
+
+def main():
+    """Call main function."""
+    parser = argparse.ArgumentParser(
+        description="check auto_backup scrpt results",
+        # show default in help
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-f",
+        "--backup-results-file",
+        dest="backup_results_file",
+        default=AUTO_BACKUP_RESULTS_PATH,
+        help="backups results file to check",
+    )
+
+    parser.add_argument(
+        "-a",
+        "--backup-results-max-age",
+        dest="backup_results_max_age",
+        type=int,
+        default=25,
+        help="backup results file max age in hours, 0 to ignore",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--controller-max-age",
+        dest="controller_max_ages",
+        action="append",
+        default=[],
+        metavar="CONTROLLER=HOURS",
+        help="max age in hours of the results file of a controller backed up on a schedule "
+        "of its own, --backup-results-max-age by default, can be repeated",
+    )
+
+    args = parser.parse_args()
+    backup_results_file = pathlib.Path(args.backup_results_file)
+    max_age = args.backup_results_max_age
+    controller_max_ages = {}
+    for option in args.controller_max_ages:
+        controller_name, _, hours = option.rpartition("=")
+        try:
+            controller_max_ages[controller_name] = int(hours)
+        except ValueError:
+            nagios_exit(NAGIOS_STATUS_UNKNOWN, f"invalid --controller-max-age: {option}")
+
+    check_backup_results_file(backup_results_file, max_age)
+    # the controllers backed up on a schedule of their own have their own results
+    # files next to the main one, e.g. "auto_backup_results.<controller>.json"
+    pattern = f"{backup_results_file.stem}.*{backup_results_file.suffix}"
+    for path in sorted(backup_results_file.parent.glob(pattern)):
+        controller_name = path.stem.split(".", 1)[1]
+        check_backup_results_file(path, controller_max_ages.get(controller_name, max_age))
+
     # if we haven't found any issues, return OK
     nagios_exit(NAGIOS_STATUS_OK, "backups are OK")
 
@@ -24,7 +24,6 @@ import json
 import logging
 import os
 import pathlib
-import subprocess
 import sys
 import time
 import traceback
@@ -42,8 +41,23 @@ from jujubackupall.process import (  # noqa E402, pylint: disable=wrong-import-p
     BackupProcessor,
 )
 
-from config import Paths  # noqa E402, pylint: disable=wrong-import-position
-from utils import SSHKeyHelper  # noqa E402, pylint: disable=wrong-import-position
+from checksum import write_manifest  # noqa E402, pylint: disable=wrong-import-position
+from compression import CODECS, Compressor  # noqa E402, pylint: disable=wrong-import-position
+from config import (  # noqa E402, pylint: disable=wrong-import-position
+    BLOB_STORE_DIRNAME,
+    DEFAULT_BACKUP_CONCURRENCY,
+    DEFAULT_BACKUP_CONCURRENCY_PER_CONTROLLER,
+    DEFAULT_BACKUP_CONCURRENCY_PER_MODEL,
+    DEFAULT_SSH_KEY_PUSH_CONCURRENCY,
+    Paths,
+    auto_backup_results_paths,
+    controller_scoped_path,
+)
+from scheduler import AdaptiveTimeout  # noqa E402, pylint: disable=wrong-import-position
+from sharding import Shard  # noqa E402, pylint: disable=wrong-import-position
+from state import BackupLinks, Checkpoint  # noqa E402, pylint: disable=wrong-import-position
+from store import BlobStore  # noqa E402, pylint: disable=wrong-import-position
+from utils import BackupRunner, SSHKeyHelper  # noqa E402, pylint: disable=wrong-import-position
 
 logger = logging.getLogger(__name__)
 
@@ -145,43 +159,71 @@ class AutoJujuBackupAll:
 
     def __init__(self):
         """Initialize the class and configure it for juju backups."""
-        self.config = Config(args=yaml.safe_load(Paths.CONFIG_YAML.read_text()))
+        self.config_data = yaml.safe_load(Paths.CONFIG_YAML.read_text())
+        self.config = Config(args=self.config_data)
 
         # configure libjuju to the location of the credentials
         if "JUJUDATA_DIR" not in os.environ:
             os.environ["JUJU_DATA"] = str(Paths.JUJUDATA_DIR)
 
-    def perform_backup(self, omit_models=None):
-        """Perform backups."""
-        # first ensure the ssh key is in all models, then perform the backup
+    def restrict_controllers(self, controller_name=None, excluded_controllers=None):
+        """Only back up a single controller, or leave some controllers out.
+
+        The controllers with a schedule of their own are backed up by their own runs,
+        which leave the juju client config to the main runs.
+        """
+        if controller_name is not None:
+            controller_names = [controller_name]
+            self.config_data["backup_juju_client_config"] = False
+        elif excluded_controllers:
+            controller_names = [
+                name
+                for name in BackupProcessor(self.config).controller_names
+                if name not in excluded_controllers
+            ]
+        else:
+            return
+
+        logger.info("restricting the backups to the controllers: %s", controller_names)
+        self.config_data["all_controllers"] = False
+        self.config_data["controllers"] = controller_names
+        self.config = Config(args=self.config_data)
+
+    def perform_backup(
+        self, omit_models=None, resume=False, runner_options=None, ssh_helper_options=None
+    ):
+        """Perform backups.
+
+        `runner_options` are passed to the BackupRunner (e.g. lazy_ssh_key_push,
+        concurrency) and `ssh_helper_options` to the SSHKeyHelper (e.g. cache_ttl).
+        """
+        # each controller worker ensures the ssh key is in all its models before
+        # the backup tasks are run
         accounts_yaml = (Paths.JUJUDATA_DIR / "accounts.yaml").read_text()
         accounts = yaml.safe_load(accounts_yaml)["controllers"]
-        ssh_helper = SSHKeyHelper(self.config, accounts)
-        ssh_helper.push_ssh_keys_to_models()
-
-        backup_processor = BackupProcessor(self.config)
-        backup_results = backup_processor.process_backups(omit_models=omit_models)
+        ssh_helper = SSHKeyHelper(self.config, accounts, **(ssh_helper_options or {}))
+        runner = BackupRunner(self.config_data, ssh_helper, **(runner_options or {}))
+        backup_results = runner.run(omit_models=omit_models, resume=resume)
         logger.info("backup results = '%s'", backup_results)
         return backup_results
 
-    def purge_old_backups(self, days_old):
-        """Purge backup files older than `day_old`."""
+    def purge_old_backups(self, days_old, store=None):
+        """Purge backup files older than `day_old`.
+
+        The backup files linking to the content of a previous run are aged from the
+        time of their link (see `BackupLinks`). With a `store`, the blobs are left out
+        of the purge, and are removed once no backup file links to them anymore.
+        """
         logger.info("purging backup files older than: '%s' days", days_old)
-        cmd = [
-            "find",
-            self.config.output_dir,
-            "-mtime",
-            f"+{days_old}",
-            "-type",
-            "f",
-            "-delete",
-        ]
+        links = BackupLinks(Paths.BACKUP_LINKS_PATH)
+        removed = links.purge(
+            self.config.output_dir, days_old, exclude=store.root if store is not None else None
+        )
+        links.save()
+        logger.info("removed %d backup files", removed)
 
-        try:
-            subprocess.check_output(cmd)
-        except subprocess.CalledProcessError as error:
-            logger.error(error.output.decode("utf8"))
-            raise
+        if store is not None:
+            logger.info("removed %d unreferenced blobs", store.gc())
 
         logger.debug("completed purging old backup files")
 
@@ -216,6 +258,208 @@ class AutoJujuBackupAll:
             help="Individual task timeout length",
         )
 
+        parser.add_argument(
+            "--ssh-key-push-concurrency",
+            action="store",
+            dest="ssh_key_push_concurrency",
+            metavar="MODELS",
+            default=DEFAULT_SSH_KEY_PUSH_CONCURRENCY,
+            type=int,
+            help="Number of models per controller to push the ssh key to concurrently",
+        )
+
+        parser.add_argument(
+            "--ssh-key-cache-ttl",
+            action="store",
+            dest="ssh_key_cache_ttl",
+            metavar="HOURS",
+            default=0,
+            type=int,
+            help="Skip models where the ssh key was confirmed in the last HOURS (0 disables)",
+        )
+
+        parser.add_argument(
+            "--ssh-key-full-sweep-runs",
+            action="store",
+            dest="ssh_key_full_sweep_runs",
+            metavar="RUNS",
+            default=1,
+            type=int,
+            help="Push the ssh key to all models every RUNS runs, only to new models otherwise",
+        )
+
+        parser.add_argument(
+            "--lazy-ssh-key-push",
+            action="store_true",
+            help="Only push the ssh key to the models where backups fail for the missing key",
+        )
+
+        parser.add_argument(
+            "--backup-concurrency",
+            action="store",
+            dest="backup_concurrency",
+            metavar="TASKS",
+            default=DEFAULT_BACKUP_CONCURRENCY,
+            type=int,
+            help="Number of backup tasks to run in parallel",
+        )
+
+        parser.add_argument(
+            "--backup-concurrency-per-controller",
+            action="store",
+            dest="backup_concurrency_per_controller",
+            metavar="TASKS",
+            default=DEFAULT_BACKUP_CONCURRENCY_PER_CONTROLLER,
+            type=int,
+            help="Number of backup tasks of a controller to run in parallel (0 for no limit)",
+        )
+
+        parser.add_argument(
+            "--backup-concurrency-per-model",
+            action="store",
+            dest="backup_concurrency_per_model",
+            metavar="TASKS",
+            default=DEFAULT_BACKUP_CONCURRENCY_PER_MODEL,
+            type=int,
+            help="Number of backup tasks of a model to run in parallel (0 for no limit)",
+        )
+
+        parser.add_argument(
+            "--adaptive-timeout",
+            action="store_true",
+            help="Derive the timeout of each task from its recorded durations",
+        )
+
+        parser.add_argument(
+            "--adaptive-timeout-factor",
+            action="store",
+            dest="adaptive_timeout_factor",
+            metavar="FACTOR",
+            default=2.0,
+            type=float,
+            help="Factor applied to the 99th percentile of the durations of a task",
+        )
+
+        parser.add_argument(
+            "--adaptive-timeout-floor",
+            action="store",
+            dest="adaptive_timeout_floor",
+            metavar="SECONDS",
+            default=60,
+            type=int,
+            help="Minimum adaptive timeout of a task",
+        )
+
+        parser.add_argument(
+            "--adaptive-timeout-ceiling",
+            action="store",
+            dest="adaptive_timeout_ceiling",
+            metavar="SECONDS",
+            default=7200,
+            type=int,
+            help="Maximum adaptive timeout of a task",
+        )
+
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Skip the tasks completed by the last run (implied if it did not finish)",
+        )
+
+        parser.add_argument(
+            "--resume-window",
+            action="store",
+            dest="resume_window",
+            metavar="HOURS",
+            default=12,
+            type=int,
+            help="Only resume a run started in the last HOURS",
+        )
+
+        parser.add_argument(
+            "--run-deadline",
+            action="store",
+            dest="run_deadline",
+            metavar="MINUTES",
+            default=0,
+            type=int,
+            help="Skip the tasks that cannot be done in the first MINUTES of the run (0 disables)",
+        )
+
+        parser.add_argument(
+            "--backup-priority",
+            action="append",
+            dest="backup_priorities",
+            metavar="NAME=PRIORITY",
+            default=[],
+            help=(
+                "Priority of the tasks of a charm, or of the 'controller' or"
+                " 'juju-client-config' tasks. Can be specified multiple times."
+            ),
+        )
+
+        parser.add_argument(
+            "--checksums",
+            action="store_true",
+            help="Record the sha256 of the backup files in the results and manifest",
+        )
+
+        parser.add_argument(
+            "--dedup-store",
+            action="store_true",
+            help="Store each distinct backup file once, linked from the backup directories",
+        )
+
+        parser.add_argument(
+            "--skip-unchanged",
+            action="store_true",
+            help="Link the last juju client config backup instead, if it did not change",
+        )
+
+        parser.add_argument(
+            "--transfer-retries",
+            action="store",
+            dest="transfer_retries",
+            metavar="RETRIES",
+            default=0,
+            type=int,
+            help="Resume the downloads from the units up to RETRIES times (0 disables)",
+        )
+
+        parser.add_argument(
+            "--compression",
+            action="store",
+            dest="compression",
+            choices=sorted(CODECS),
+            help="Compress the downloaded backup files with this codec",
+        )
+
+        parser.add_argument(
+            "--compression-level",
+            action="store",
+            dest="compression_level",
+            metavar="LEVEL",
+            default=6,
+            type=int,
+            help="Compression level, from 1 (fastest) to 9 (smallest), 0 for gzip and xz too",
+        )
+
+        parser.add_argument(
+            "--controller",
+            action="store",
+            dest="controller",
+            metavar="CONTROLLER_NAME",
+            help="Only back up this controller, with its own results file",
+        )
+
+        parser.add_argument(
+            "--exclude-controller",
+            action="append",
+            dest="excluded_controllers",
+            metavar="CONTROLLER_NAME",
+            help="Do not back up this controller. Can be specified multiple times.",
+        )
+
         parser.add_argument(
             "--omit-model",
             action="append",
@@ -229,34 +473,95 @@ class AutoJujuBackupAll:
         log_level = logging.DEBUG if args.debug else logging.ERROR
         self.configure_logging(log_level=log_level)
 
+        # the runs of a controller with a schedule of its own have their own files
+        pid_filename = controller_scoped_path(PID_FILENAME, args.controller)
+        results_path = controller_scoped_path(Paths.AUTO_BACKUP_RESULTS_PATH, args.controller)
+        checkpoint_path = controller_scoped_path(Paths.CHECKPOINT_PATH, args.controller)
+        manifest_path = controller_scoped_path(Paths.AUTO_BACKUP_MANIFEST_PATH, args.controller)
+
         # Ensure a single instance via a simple pidfile
         pid = str(os.getpid())
 
-        if PID_FILENAME.is_file():
-            sys.exit(f"{PID_FILENAME} already exists, exiting")
+        if pid_filename.is_file():
+            sys.exit(f"{pid_filename} already exists, exiting")
+
+        pid_filename.write_text(pid, encoding="utf-8")
 
-        PID_FILENAME.write_text(pid, encoding="utf-8")
+        store = (
+            BlobStore(pathlib.Path(self.config.output_dir) / BLOB_STORE_DIRNAME)
+            if args.dedup_store
+            else None
+        )
 
         stime = time.time()
         purge_count = 0
         try:
-            backup_results = self.perform_backup(omit_models=args.omit_models)
-            Paths.AUTO_BACKUP_RESULTS_PATH.write_text(backup_results)
+            self.restrict_controllers(args.controller, args.excluded_controllers)
+            backup_results = self.perform_backup(
+                omit_models=args.omit_models,
+                resume=args.resume,
+                runner_options={
+                    "lazy_ssh_key_push": args.lazy_ssh_key_push,
+                    "concurrency": args.backup_concurrency,
+                    "concurrency_per_controller": args.backup_concurrency_per_controller,
+                    "concurrency_per_model": args.backup_concurrency_per_model,
+                    "adaptive_timeout": (
+                        AdaptiveTimeout(
+                            args.adaptive_timeout_factor,
+                            args.adaptive_timeout_floor,
+                            args.adaptive_timeout_ceiling,
+                        )
+                        if args.adaptive_timeout
+                        else None
+                    ),
+                    "checkpoint": Checkpoint(checkpoint_path, args.resume_window * 3600),
+                    "shard": Shard.load(Paths.SHARD_PATH),
+                    "deadline": args.run_deadline * 60,
+                    "priorities": {
+                        name: int(priority)
+                        for name, _, priority in (
+                            option.partition("=") for option in args.backup_priorities
+                        )
+                    },
+                    "checksums": args.checksums,
+                    "store": store,
+                    "skip_unchanged": args.skip_unchanged,
+                    "transfer_retries": args.transfer_retries,
+                    "compressor": (
+                        Compressor(
+                            args.compression,
+                            args.compression_level,
+                            concurrent_tasks=args.backup_concurrency,
+                        )
+                        if args.compression
+                        else None
+                    ),
+                },
+                ssh_helper_options={
+                    "concurrency": args.ssh_key_push_concurrency,
+                    "cache_ttl": args.ssh_key_cache_ttl,
+                    "full_sweep_runs": args.ssh_key_full_sweep_runs,
+                },
+            )
+            results_path.write_text(backup_results)
+            if args.checksums:
+                write_manifest(json.loads(backup_results), manifest_path)
 
             # purge old backups if requested
             if args.purge_after_days and args.purge_after_days > 0:
                 purge_count += 1
-                self.purge_old_backups(args.purge_after_days)
+                self.purge_old_backups(args.purge_after_days, store=store)
         except Exception:
             backup_results = {"ERROR": traceback.format_exc()}
             logger.debug("writing error details to the results file")
-            Paths.AUTO_BACKUP_RESULTS_PATH.write_text(json.dumps(backup_results))
+            results_path.write_text(json.dumps(backup_results))
             logger.error("backup failed! check log for details")
             raise
         finally:
-            PID_FILENAME.unlink()
+            pid_filename.unlink()
             duration = time.time() - stime
-            result_code = check_backup_file(Paths.AUTO_BACKUP_RESULTS_PATH)
+            # the exporter reports the worst status of the main and per-controller runs
+            result_code = max(check_backup_file(path) for path in auto_backup_results_paths())
             status_ok = float(result_code == 0)
             backup_stats = {
                 "duration": duration,
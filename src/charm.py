@@ -3,6 +3,7 @@
 # See LICENSE file for licensing details.
 """Juju backup all charm."""
 
+import json
 import logging
 import os
 
@@ -11,7 +12,7 @@ from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, ModelError
 
-from config import EXPORTER_RELATION_NAME
+from config import EXPORTER_RELATION_NAME, PEER_RELATION_NAME, Paths
 from exporter import Exporter
 from utils import JujuBackupAllHelper
 
@@ -32,10 +33,22 @@ class JujuBackupAllCharm(CharmBase):
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.do_backup_action, self._on_do_backup_action)
         self.framework.observe(self.on.push_ssh_keys_action, self._on_push_ssh_keys_action)
+        self.framework.observe(self.on.rotate_ssh_key_action, self._on_rotate_ssh_key_action)
+        self.framework.observe(self.on.gc_ssh_keys_action, self._on_gc_ssh_keys_action)
+        self.framework.observe(self.on.retry_failed_action, self._on_retry_failed_action)
+        self.framework.observe(self.on.plan_backup_action, self._on_plan_backup_action)
         self.framework.observe(
             self.on.nrpe_external_master_relation_changed,
             self._on_nem_changed,
         )
+        self.framework.observe(self.on.leader_elected, self._on_peers_changed)
+        self.framework.observe(self.on[PEER_RELATION_NAME].relation_joined, self._on_peers_changed)
+        self.framework.observe(
+            self.on[PEER_RELATION_NAME].relation_changed, self._on_peers_changed
+        )
+        self.framework.observe(
+            self.on[PEER_RELATION_NAME].relation_departed, self._on_peers_changed
+        )
 
         # initialise helpers, etc.
         self.helper = JujuBackupAllHelper(self.model)
@@ -90,9 +103,41 @@ class JujuBackupAllCharm(CharmBase):
         backup_results = self.helper.perform_backup(omit_models=omit_models)
         event.set_results({"result": backup_results})
 
+    def _on_plan_backup_action(self, event):
+        """Handle the plan-backup action."""
+        event.set_results({"result": self.helper.plan_backup()})
+
+    def _on_retry_failed_action(self, event):
+        """Handle the retry-failed action."""
+        try:
+            backup_results = self.helper.retry_failed()
+        except ValueError as error:
+            event.fail(str(error))
+            return
+        if backup_results is None:
+            event.set_results({"result": "The last backup run has no failed tasks to retry."})
+            return
+        event.set_results({"result": backup_results})
+
     def _on_push_ssh_keys_action(self, event):
         """Handle the push-ssh-keys action."""
-        result = self.helper.push_ssh_keys()
+        result = self.helper.push_ssh_keys(progress=event.log)
+        event.set_results({"result": result})
+
+    def _on_rotate_ssh_key_action(self, event):
+        """Handle the rotate-ssh-key action."""
+        rotation = self.helper.rotate_ssh_key(event.params["key-type"], progress=event.log)
+        # share the new key with the other units
+        self._on_peers_changed(event)
+        event.set_results({"result": json.dumps(rotation["report"], indent=2)})
+        if not rotation["switched"]:
+            event.fail("The new ssh key could not be pushed to all models, the old key is kept.")
+        elif not rotation["removed"]:
+            event.fail("The backups use the new ssh key, but the old key was not removed.")
+
+    def _on_gc_ssh_keys_action(self, event):
+        """Handle the gc-ssh-keys action."""
+        result = self.helper.gc_ssh_keys(dry_run=event.params["dry-run"], progress=event.log)
         event.set_results({"result": result})
 
     def _on_install_or_upgrade(self, _event):
@@ -148,6 +193,9 @@ class JujuBackupAllCharm(CharmBase):
         self.helper.create_backup_dir()
         self.helper.update_jujudata_config()
         self.helper.update_crontab()
+        # the max age of the backup results checked by nagios follows the schedules
+        if self.model.get_relation("nrpe-external-master") is not None:
+            self.helper.configure_nrpe()
         self.model.unit.status = ActiveStatus("Unit is ready")
 
     def _on_nem_changed(self, event):
@@ -155,6 +203,30 @@ class JujuBackupAllCharm(CharmBase):
         logging.info("Got nrpe-external-master changed %s", event)
         self.helper.configure_nrpe()
 
+    def _on_peers_changed(self, _event):
+        """Share the backups among the units of the application."""
+        relation = self.model.get_relation(PEER_RELATION_NAME)
+        if relation is None:
+            return
+
+        # the leader assigns the backups to the current units, see `Shard`
+        if self.unit.is_leader():
+            units = sorted({self.unit.name} | {unit.name for unit in relation.units})
+            relation.data[self.app]["units"] = json.dumps(units)
+
+        # every unit has a backup ssh key of its own, which must survive gc-ssh-keys
+        if Paths.SSH_PUBLIC_KEY.exists():
+            relation.data[self.unit]["ssh-public-key"] = Paths.SSH_PUBLIC_KEY.read_text().strip()
+
+        units = json.loads(relation.data[self.app].get("units", "[]")) or [self.unit.name]
+        ssh_public_keys = [
+            relation.data[unit]["ssh-public-key"]
+            for unit in relation.units
+            if relation.data[unit].get("ssh-public-key")
+        ]
+        logger.info("sharing the backups among units: %s", units)
+        self.helper.update_shard(self.unit.name, units, ssh_public_keys)
+
     def _configure_logging(self):
         logging.getLogger("websockets").setLevel(logging.ERROR)
         logging.getLogger("juju").setLevel(logging.ERROR)
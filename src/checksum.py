@@ -0,0 +1,85 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Checksums of the backup files."""
+import hashlib
+import logging
+import os
+import pathlib
+
+from config import CHECKSUM_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path):
+    """Return the sha256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(CHECKSUM_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tree_sha256(root, names):
+    """Return the sha256 hex digest of the files named `names` in `root`, and their paths.
+
+    Directories are hashed with all the files they contain, and missing files are
+    hashed as such, so that any file added, removed, renamed or modified changes the
+    digest.
+    """
+    root = pathlib.Path(root)
+    digest = hashlib.sha256()
+    for name in sorted(names):
+        path = root / name
+        files = sorted(path.rglob("*")) if path.is_dir() else [path]
+        for file_path in files:
+            if file_path.is_dir():
+                continue
+            digest.update(str(file_path.relative_to(root)).encode("utf-8") + b"\0")
+            digest.update(file_sha256(file_path).encode() if file_path.exists() else b"-")
+    return digest.hexdigest()
+
+
+def add_checksums(results, known=None):
+    """Record the "sha256" of the files of a results document that have none yet.
+
+    The files compressed by the `Compressor` were hashed as they were written, and the
+    files in `known` as they were downloaded. The others are read once here.
+    Directories are left without checksum.
+
+    Args:
+        results: results document
+        known: mapping of file path to the (sha256, size, mtime_ns) of the file when it
+            was hashed, only used if the file was not modified since
+    """
+    known = known or {}
+    for backup_type, backup_entries in results.items():
+        if not backup_type.endswith("_backups"):
+            continue
+        for backup_entry in backup_entries:
+            if "sha256" in backup_entry:
+                continue
+            path = pathlib.Path(backup_entry.get("download_path", ""))
+            if not path.is_file():
+                continue
+            stat = path.stat()
+            sha256, size, mtime_ns = known.get(str(path), (None, None, None))
+            if sha256 is None or (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                sha256 = file_sha256(path)
+            backup_entry["sha256"] = sha256
+    return results
+
+
+def write_manifest(results, path):
+    """Write the checksums of a results document, in the format of `sha256sum --check`."""
+    lines = [
+        f"{backup_entry['sha256']}  {backup_entry['download_path']}\n"
+        for backup_type, backup_entries in sorted(results.items())
+        if backup_type.endswith("_backups")
+        for backup_entry in backup_entries
+        if "sha256" in backup_entry
+    ]
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text("".join(lines), encoding="utf-8")
+    os.replace(tmp_path, path)
+    logger.info("wrote the checksums of %d backup files to %s", len(lines), path)
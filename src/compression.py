@@ -0,0 +1,137 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Compression of the downloaded backup files."""
+import bz2
+import collections
+import gzip
+import hashlib
+import logging
+import lzma
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+from config import COMPRESSION_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# compress function and file suffix of each codec, the compressed blocks of a file are
+# independent streams, which gzip, bzip2 and xz decompress as a single file
+CODECS = {
+    "gzip": (lambda data, level: gzip.compress(data, compresslevel=level, mtime=0), ".gz"),
+    "bzip2": (lambda data, level: bz2.compress(data, compresslevel=level), ".bz2"),
+    "xz": (lambda data, level: lzma.compress(data, preset=level), ".xz"),
+}
+# lowest and highest compression level of each codec
+LEVELS = {"gzip": (0, 9), "bzip2": (1, 9), "xz": (0, 9)}
+# suffixes of the files not worth compressing again
+COMPRESSED_SUFFIXES = (".gz", ".tgz", ".bz2", ".xz", ".zst", ".zip")
+
+
+def valid_level(codec, level):
+    """Return True if `level` is a compression level of the codec."""
+    lowest, highest = LEVELS[codec]
+    return lowest <= level <= highest
+
+
+class Compressor:
+    """Compress files by blocks, on several cores.
+
+    The file is read one block at a time, and the blocks are compressed in parallel as
+    they are read, so that only a few blocks are held in memory at any given time.
+    """
+
+    def __init__(
+        self, codec, level, threads=None, concurrent_tasks=1, block_size=COMPRESSION_BLOCK_SIZE
+    ):  # pylint: disable=too-many-arguments
+        """Initialise the compressor.
+
+        Args:
+            codec: name of the codec, see CODECS
+            level: compression level, from 1 (fastest) to 9 (smallest), see LEVELS
+            threads: number of blocks compressed in parallel, by default the cores are
+                shared among the `concurrent_tasks`
+            concurrent_tasks: number of backup tasks compressing files at the same time
+            block_size: size in bytes of the blocks compressed independently
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Unsupported compression codec: {codec}")
+        if not valid_level(codec, level):
+            raise ValueError(f"Unsupported {codec} compression level: {level}")
+        self.codec = codec
+        self.level = level
+        if threads is None:
+            threads = (os.cpu_count() or 1) // max(1, concurrent_tasks)
+        self.threads = max(1, threads)
+        self.block_size = block_size
+
+    def compress_file(self, path):
+        """Replace a file by its compressed version.
+
+        Returns:
+            (compressed_path, sha256): path and sha256 hex digest of the compressed file,
+                hashed as it is written
+        """
+        compress, suffix = CODECS[self.codec]
+        path = pathlib.Path(path)
+        compressed_path = path.with_name(path.name + suffix)
+        tmp_path = compressed_path.with_name(f".{compressed_path.name}.tmp")
+        digest = hashlib.sha256()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                with open(path, "rb") as source, open(tmp_path, "wb") as target:
+                    # bound the blocks in flight, and write them in order
+                    in_flight = collections.deque()
+                    while True:
+                        block = source.read(self.block_size)
+                        if block:
+                            in_flight.append(executor.submit(compress, block, self.level))
+                        if in_flight and (not block or len(in_flight) >= 2 * self.threads):
+                            compressed_block = in_flight.popleft().result()
+                            digest.update(compressed_block)
+                            target.write(compressed_block)
+                        elif not block:
+                            break
+                    # an empty file still needs a valid compressed stream
+                    if target.tell() == 0:
+                        compressed_block = compress(b"", self.level)
+                        digest.update(compressed_block)
+                        target.write(compressed_block)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        os.replace(tmp_path, compressed_path)
+        path.unlink()
+        return compressed_path, digest.hexdigest()
+
+    def compress_results(self, results):
+        """Compress the files of a results document, and record their compressed size.
+
+        The "download_path" of each entry is updated to the compressed file, and its
+        "compression" records the codec, the size before and after, and their ratio.
+        The "sha256" of the compressed file is recorded too, see `checksum`.
+        Directories and files already compressed are left as they are.
+        """
+        for backup_type, backup_entries in results.items():
+            if not backup_type.endswith("_backups"):
+                continue
+            for backup_entry in backup_entries:
+                path = pathlib.Path(backup_entry.get("download_path", ""))
+                if not path.is_file() or path.name.endswith(COMPRESSED_SUFFIXES):
+                    continue
+
+                size = path.stat().st_size
+                compressed_path, sha256 = self.compress_file(path)
+                compressed_size = compressed_path.stat().st_size
+                logger.debug("compressed %s: %d -> %d bytes", path, size, compressed_size)
+                backup_entry["download_path"] = str(compressed_path)
+                backup_entry["sha256"] = sha256
+                backup_entry["compression"] = {
+                    "codec": self.codec,
+                    "size": size,
+                    "compressed_size": compressed_size,
+                    "ratio": round(size / compressed_size, 3) if compressed_size else None,
+                }
+        return results
@@ -6,6 +6,37 @@ import pathlib
 BACKUP_USERNAME = "jujubackup"
 EXPORTER_NAME = "prometheus-juju-backup-all-exporter"
 EXPORTER_RELATION_NAME = "metrics-endpoint"
+PEER_RELATION_NAME = "cluster"
+DEFAULT_SSH_KEY_PUSH_CONCURRENCY = 10
+CLIENT_CONFIG_WORKER = "juju-client-config"
+DEFAULT_BACKUP_CONCURRENCY = 8
+DEFAULT_BACKUP_CONCURRENCY_PER_CONTROLLER = 4
+DEFAULT_BACKUP_CONCURRENCY_PER_MODEL = 1
+# maximum number of models of a controller connected concurrently to plan the backups
+MODEL_DISCOVERY_CONCURRENCY = 10
+# number of durations of each backup task kept in the task history
+TASK_HISTORY_SIZE = 50
+# number of recorded durations a task needs before its timeout is adapted to them
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 5
+# number of points of each unit on the hash ring sharding the backups across units
+HASH_RING_REPLICAS = 64
+# charms juju-backup-all knows how to back up, each one is backed up by its own task
+BACKUP_CHARMS = ("etcd", "mysql-innodb-cluster", "percona-cluster", "postgresql")
+# size in bytes of the blocks of a backup file compressed in parallel
+COMPRESSION_BLOCK_SIZE = 16 * 1024 * 1024
+# size in bytes of the blocks read to checksum a backup file
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+# directory of the backup dir holding the content-addressed store of the backup files
+BLOB_STORE_DIRNAME = ".store"
+# files of JUJUDATA_DIR making up the juju client config backup, see `skip_unchanged`
+CLIENT_CONFIG_FILES = ("accounts.yaml", "controllers.yaml", "ssh")
+# size in bytes of the blocks of a backup file written as they are downloaded, and
+# of the end of a partial download checked against the unit before it is resumed
+TRANSFER_BLOCK_SIZE = 1024 * 1024
+TRANSFER_VERIFY_SIZE = 1024 * 1024
+# type of the backup ssh keys generated by the charm, and algorithm of each supported type
+SSH_KEY_TYPE = "ed25519"
+SSH_KEY_TYPES = {"rsa": "ssh-rsa", "ed25519": "ssh-ed25519"}
 
 
 class Paths:  # pylint: disable=too-few-public-methods
@@ -17,10 +48,41 @@ class Paths:  # pylint: disable=too-few-public-methods
     JUJUDATA_COOKIES_DIR = JUJUDATA_DIR / "cookies"
     SSH_PRIVATE_KEY = JUJUDATA_SSH_DIR / "juju_id_rsa"
     SSH_PUBLIC_KEY = SSH_PRIVATE_KEY.with_suffix(".pub")
+    # next backup key, generated by a key rotation until it is pushed to all models
+    SSH_NEW_PRIVATE_KEY = SSH_PRIVATE_KEY.with_suffix(".new")
+    SSH_NEW_PUBLIC_KEY = SSH_PRIVATE_KEY.with_suffix(".new.pub")
+    # previous backup key, kept until it is removed from all models by a key rotation
+    SSH_OLD_PRIVATE_KEY = SSH_PRIVATE_KEY.with_suffix(".old")
+    SSH_OLD_PUBLIC_KEY = SSH_PRIVATE_KEY.with_suffix(".old.pub")
     AUTO_BACKUP_SCRIPT_PATH = JUJUDATA_DIR / "auto_backup.py"
     AUTO_BACKUP_LOG_PATH = JUJUDATA_DIR / "auto_backup.log"
     AUTO_BACKUP_RESULTS_PATH = JUJUDATA_DIR / "auto_backup_results.json"
+    SSH_KEY_CACHE_PATH = JUJUDATA_DIR / "ssh_key_cache.json"
+    MODEL_INVENTORY_PATH = JUJUDATA_DIR / "model_inventory.json"
+    TASK_HISTORY_PATH = JUJUDATA_DIR / "task_history.json"
+    CHECKPOINT_PATH = JUJUDATA_DIR / "auto_backup_checkpoint.json"
+    AUTO_BACKUP_MANIFEST_PATH = JUJUDATA_DIR / "auto_backup_manifest.sha256"
+    SHARD_PATH = JUJUDATA_DIR / "shard.json"
+    BACKUP_FINGERPRINTS_PATH = JUJUDATA_DIR / "backup_fingerprints.json"
+    BACKUP_LINKS_PATH = JUJUDATA_DIR / "backup_links.json"
     AUTO_BACKUP_CRONTAB_PATH = pathlib.Path("/etc/cron.d/juju-backup-all")
     NAGIOS_PLUGINS_DIR = pathlib.Path("/usr/local/lib/nagios/plugins/")
     EXPORTER_CONFIG = pathlib.Path(f"/var/snap/{EXPORTER_NAME}/current/config.yaml")
     EXPORTER_BACKUP_RESULTS_PATH = pathlib.Path(f"/var/snap/{EXPORTER_NAME}/common")
+
+
+def controller_scoped_path(path, controller_name):
+    """Return the path of the copy of a file used by the runs of a single controller.
+
+    e.g. "auto_backup_results.json" becomes "auto_backup_results.<controller>.json", or
+    stays as is if `controller_name` is None.
+    """
+    if controller_name is None:
+        return path
+    return path.with_name(f"{path.stem}.{controller_name}{path.suffix}")
+
+
+def auto_backup_results_paths():
+    """Return the results files of the main backup runs and of each controller's runs."""
+    pattern = f"{Paths.AUTO_BACKUP_RESULTS_PATH.stem}.*{Paths.AUTO_BACKUP_RESULTS_PATH.suffix}"
+    return [Paths.AUTO_BACKUP_RESULTS_PATH] + sorted(Paths.JUJUDATA_DIR.glob(pattern))
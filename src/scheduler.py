@@ -0,0 +1,234 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Concurrent scheduling of the backup tasks."""
+import collections
+import contextlib
+import logging
+import math
+import threading
+import time
+import traceback
+
+from config import ADAPTIVE_TIMEOUT_MIN_SAMPLES, CLIENT_CONFIG_WORKER
+
+logger = logging.getLogger(__name__)
+
+
+class BackupTask:  # pylint: disable=too-few-public-methods
+    """A backup task, run on its own by the scheduler.
+
+    Depending on the fields set, the task backs up:
+    - the juju client config, if there is no controller
+    - a controller, if there is no model
+    - the applications of a charm in a model, or all applications of the model if there
+      is no charm
+    """
+
+    def __init__(self, controller=None, model=None, charm=None):
+        """Initialise the task."""
+        self.controller = controller
+        self.model = model
+        self.charm = charm
+
+    @property
+    def name(self):
+        """Return the unique name of the task, e.g. "controller/model/charm"."""
+        if self.controller is None:
+            return CLIENT_CONFIG_WORKER
+        return "/".join(part for part in (self.controller, self.model, self.charm) if part)
+
+    def __repr__(self):
+        """Return the representation of the task."""
+        return f"BackupTask({self.name})"
+
+
+class TaskSkipped(Exception):
+    """The task was not started, as it could not be done before the deadline of the run."""
+
+
+class AdaptiveTimeout:  # pylint: disable=too-few-public-methods
+    """Timeout of a task derived from its recorded durations.
+
+    The timeout is the 99th percentile of the durations times `factor`, within `floor`
+    and `ceiling`. Tasks with too few recorded durations keep the static timeout.
+    """
+
+    def __init__(self, factor, floor, ceiling, min_samples=ADAPTIVE_TIMEOUT_MIN_SAMPLES):
+        """Initialise the timeout policy, `floor` and `ceiling` are in seconds."""
+        self.factor = factor
+        self.floor = floor
+        self.ceiling = ceiling
+        self.min_samples = min_samples
+
+    def timeout(self, durations, default):
+        """Return the timeout in seconds of a task, `default` if there is too little history."""
+        if len(durations) < self.min_samples:
+            return default
+        # nearest-rank percentile
+        ordered = sorted(durations)
+        p99 = ordered[math.ceil(0.99 * len(ordered)) - 1]
+        return math.ceil(min(max(p99 * self.factor, self.floor), self.ceiling))
+
+
+class TaskScheduler:  # pylint: disable=too-few-public-methods
+    """Run tasks concurrently, within caps on the tasks running in total and per scope.
+
+    Tasks are started in the given order, except that a task whose controller or model
+    is at its cap is passed over until a running task of that controller or model is
+    done. If the run has a deadline, tasks that are not expected to be done by then are
+    skipped instead of started.
+    """
+
+    def __init__(
+        self,
+        max_workers,
+        max_per_controller=0,
+        max_per_model=0,
+        worker_context=contextlib.nullcontext,
+    ):
+        """Initialise the scheduler.
+
+        Args:
+            max_workers: maximum number of tasks running at any given time
+            max_per_controller: maximum number of tasks of a controller running at any
+                given time, 0 or less for no cap
+            max_per_model: maximum number of tasks of a model running at any given time,
+                0 or less for no cap
+            worker_context: factory of the context manager each worker thread runs its
+                tasks in, e.g. to set up an event loop
+        """
+        self.max_workers = max(1, max_workers)
+        self.max_per_controller = max_per_controller
+        self.max_per_model = max_per_model
+        self.worker_context = worker_context
+        self._condition = threading.Condition()
+        self._pending = []
+        self._running = collections.Counter()
+        self._results = {}
+        self._deadline = None
+        self._durations = {}
+
+    def run(self, tasks, func, deadline=None, durations=None):
+        """Run `func(task)` for every task.
+
+        Args:
+            tasks: the tasks, in the order they should be started
+            func: callable running a task
+            deadline: time (see `time.monotonic`) after which no task should be running,
+                None for no deadline
+            durations: mapping of task name to its expected duration in seconds, a task
+                with no expected duration is only skipped once the deadline has passed
+
+        Returns:
+            results: mapping of task name to the value returned by `func`, or to the
+                exception it raised, TaskSkipped for the tasks skipped for the deadline
+        """
+        self._pending = list(tasks)
+        self._running.clear()
+        self._results = {}
+        self._deadline = deadline
+        self._durations = durations or {}
+
+        workers = [
+            threading.Thread(target=self._work, args=(func,), name=f"backup-worker-{i}")
+            for i in range(min(self.max_workers, len(self._pending)))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        return {task.name: self._results[task.name] for task in tasks}
+
+    def estimate(self, tasks, durations):
+        """Return the expected duration of a run of the tasks, simulating the scheduling.
+
+        Args:
+            tasks: the tasks, in the order they would be run
+            durations: mapping of task name to its expected duration in seconds, tasks
+                with no expected duration are counted as instantaneous
+        """
+        pending = list(tasks)
+        running = []  # (end time, task) of the running tasks
+        counts = collections.Counter()
+        now = 0
+        while pending or running:
+            while len(running) < self.max_workers:
+                task = next((task for task in pending if self._within_caps(task, counts)), None)
+                if task is None:
+                    break
+                pending.remove(task)
+                counts.update(self._scopes(task))
+                running.append((now + (durations.get(task.name) or 0), task))
+
+            # move on to the end of the next task
+            running.sort(key=lambda item: item[0])
+            now, task = running.pop(0)
+            counts.subtract(self._scopes(task))
+        return now
+
+    def _work(self, func):
+        """Run the pending tasks one after the other, until there are none left."""
+        with self.worker_context():
+            while True:
+                task = self._next_task()
+                if task is None:
+                    return
+
+                try:
+                    self._results[task.name] = func(task)
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    logger.error("task %s failed: %s", task.name, traceback.format_exc())
+                    self._results[task.name] = error
+                finally:
+                    with self._condition:
+                        self._running.subtract(self._scopes(task))
+                        self._condition.notify_all()
+
+    def _next_task(self):
+        """Wait for a pending task that is within the caps and take it, None if none left."""
+        with self._condition:
+            while self._pending:
+                for task in list(self._pending):
+                    if self._past_deadline(task):
+                        logger.warning("skipping task %s, the deadline is too close", task.name)
+                        self._pending.remove(task)
+                        self._results[task.name] = TaskSkipped(
+                            f"not started, as it could not be done before the deadline of the"
+                            f" run (expected duration: {self._durations.get(task.name)}s)"
+                        )
+                    elif self._within_caps(task, self._running):
+                        self._pending.remove(task)
+                        self._running.update(self._scopes(task))
+                        return task
+                if self._pending:
+                    self._condition.wait(self._wait_timeout())
+            return None
+
+    def _past_deadline(self, task):
+        """Return True if the task is not expected to be done before the deadline."""
+        if self._deadline is None:
+            return False
+        return time.monotonic() + (self._durations.get(task.name) or 0) >= self._deadline
+
+    def _wait_timeout(self):
+        """Return how long to wait for a running task, to wake up at the deadline at the latest."""
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - time.monotonic())
+
+    def _within_caps(self, task, running):
+        """Return True if the task can start without exceeding a cap, given the running counts."""
+        controller_scope, model_scope = self._scopes(task)
+        if self.max_per_controller > 0 and task.controller is not None:
+            if running[controller_scope] >= self.max_per_controller:
+                return False
+        if self.max_per_model > 0 and task.model is not None:
+            if running[model_scope] >= self.max_per_model:
+                return False
+        return True
+
+    @staticmethod
+    def _scopes(task):
+        """Return the controller and model scopes a task counts against."""
+        return (("controller", task.controller), ("model", task.controller, task.model))
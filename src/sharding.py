@@ -0,0 +1,86 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Sharding of the backup tasks across the units of the application."""
+import bisect
+import hashlib
+import json
+import logging
+
+from config import CLIENT_CONFIG_WORKER, HASH_RING_REPLICAS
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    """Return a stable hash of a string key."""
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:  # pylint: disable=too-few-public-methods
+    """Consistent hashing ring mapping keys to nodes.
+
+    Each node is placed `replicas` times on the ring, so that the keys are evenly spread,
+    and only the keys of a node that goes away are moved to the other nodes.
+    """
+
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        """Build the ring of the given nodes."""
+        self._ring = sorted(
+            (_hash(f"{node}#{replica}"), node) for node in nodes for replica in range(replicas)
+        )
+        self._hashes = [node_hash for node_hash, _ in self._ring]
+
+    def node(self, key):
+        """Return the node a key is assigned to, None if the ring is empty."""
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class Shard:
+    """The share of the backup tasks of a unit, among the units of the application.
+
+    The tasks of a model are all assigned to the same unit, as are the controller
+    backup and the juju client config backup.
+    """
+
+    def __init__(self, unit, units, ssh_public_keys=()):
+        """Initialise the shard of `unit` among `units` (unit names).
+
+        Args:
+            unit: name of this unit
+            units: names of all the units sharing the backups, as set by the leader
+            ssh_public_keys: backup ssh public keys of all the units
+        """
+        self.unit = unit
+        self.units = sorted(units)
+        self.ssh_public_keys = list(ssh_public_keys)
+        self._ring = HashRing(self.units)
+
+    @classmethod
+    def load(cls, path):
+        """Load the shard written by the charm, None if there is no sharding."""
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            return cls(data["unit"], data["units"], data.get("ssh_public_keys", []))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            logger.warning("ignoring invalid shard file '%s': %s", path, error)
+            return None
+
+    def save(self, path):
+        """Write the shard for the backup runs."""
+        data = {"unit": self.unit, "units": self.units, "ssh_public_keys": self.ssh_public_keys}
+        path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+
+    def owns(self, task):
+        """Return True if the task is assigned to this unit."""
+        if task.controller is None:
+            key = CLIENT_CONFIG_WORKER
+        elif task.model is None:
+            key = task.controller
+        else:
+            key = f"{task.controller}/{task.model}"
+        return self._ring.node(key) == self.unit
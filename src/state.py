@@ -0,0 +1,379 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""State persisted between backup runs."""
+import contextlib
+import copy
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import statistics
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def _locked_directory(path):
+    """Hold an exclusive lock of a directory, shared with the other processes."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class JSONStateFile:
+    """A dict persisted as a json file.
+
+    The state can be shared by several workers, every access must hold `lock`. It can
+    also be shared by several processes, e.g. the overlapping runs of controllers on
+    schedules of their own: each one only writes the entries it changed (see `save`).
+    """
+
+    def __init__(self, path):
+        """Load the state from `path`, starting afresh if it is missing or invalid."""
+        self.path = pathlib.Path(path)
+        self.lock = threading.RLock()
+        self.data = self._load()
+        # the state as last loaded or saved, to tell the entries changed since
+        self._saved = copy.deepcopy(self.data)
+
+    def _load(self):
+        """Read the state file."""
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            logger.warning("ignoring invalid state file '%s': %s", self.path, error)
+            return {}
+
+        if not isinstance(data, dict):
+            logger.warning("ignoring invalid state file '%s'", self.path)
+            return {}
+        return data
+
+    def save(self):
+        """Atomically write the state to disk, keeping the changes of other processes.
+
+        Under an exclusive lock of its directory (the file itself is replaced), the
+        state is read again and only the top level entries changed since it was loaded
+        or last saved are written over it. The state then includes the entries saved
+        by the other processes meanwhile.
+        """
+        with self.lock, _locked_directory(self.path.parent):
+            data = self._load()
+            for key in set(self.data) | set(self._saved):
+                if key not in self.data:
+                    data.pop(key, None)
+                elif key not in self._saved or self.data[key] != self._saved[key]:
+                    data[key] = self.data[key]
+
+            tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps(data, indent=2, sort_keys=True), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+            self.data = data
+            self._saved = copy.deepcopy(data)
+
+
+class SSHKeyCache(JSONStateFile):
+    """Models where the backup ssh key was last confirmed to be present.
+
+    The state looks like the following:
+
+    {
+        "<model uuid>": {
+            "controller": "<controller name>",
+            "model": "<model name>",
+            "keys": {"<key fingerprint>": <timestamp of the last confirmation>}
+        }
+    }
+    """
+
+    def __init__(self, path, ttl):
+        """Initialise the cache, entries older than `ttl` seconds are ignored."""
+        super().__init__(path)
+        self.ttl = ttl
+
+    def is_fresh(self, model_uuid, fingerprint, now=None):
+        """Return True if the key was confirmed in the model within the ttl."""
+        now = time.time() if now is None else now
+        with self.lock:
+            confirmed = self.data.get(model_uuid, {}).get("keys", {}).get(fingerprint)
+        return confirmed is not None and now - confirmed < self.ttl
+
+    def confirm(self, model_uuid, fingerprint, controller_name, model_name, now=None):
+        """Record that the key is present in the model."""
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.data.setdefault(model_uuid, {"keys": {}})
+            entry.update(controller=controller_name, model=model_name)
+            entry["keys"][fingerprint] = now
+
+    def invalidate(self, controller_name, model_name):
+        """Forget every key confirmed in the model."""
+        with self.lock:
+            for model_uuid, entry in list(self.data.items()):
+                if entry.get("controller") == controller_name and entry.get("model") == model_name:
+                    logger.debug("invalidating ssh key cache for model: %s", model_uuid)
+                    del self.data[model_uuid]
+
+
+class ModelInventory(JSONStateFile):
+    """Models seen on each controller, to only process the new or changed ones.
+
+    The state looks like the following:
+
+    {
+        "<controller name>": {
+            "runs_since_full_sweep": <number of incremental runs since the last full sweep>,
+            "models": {"<model name>": {"uuid": "<model uuid>", "processed": <timestamp>}}
+        }
+    }
+    """
+
+    def __init__(self, path, full_sweep_runs):
+        """Initialise the inventory, every `full_sweep_runs` runs all models are processed."""
+        super().__init__(path)
+        self.full_sweep_runs = full_sweep_runs
+
+    def select(self, controller_name, models):
+        """Start a run and return the models (name to uuid) that need processing.
+
+        These are the models that are new or whose uuid changed since they were last
+        processed, or all models if a full sweep is due.
+        """
+        with self.lock:
+            entry = self.data.setdefault(
+                controller_name, {"runs_since_full_sweep": None, "models": {}}
+            )
+            runs = entry["runs_since_full_sweep"]
+            full_sweep = runs is None or runs + 1 >= self.full_sweep_runs
+            entry["runs_since_full_sweep"] = 0 if full_sweep else runs + 1
+
+            # forget about the models that do not exist anymore
+            known = entry["models"]
+            for model_name in set(known) - set(models):
+                del known[model_name]
+
+            if full_sweep:
+                logger.debug("full sweep of the models of controller: %s", controller_name)
+                return dict(models)
+
+            return {
+                model_name: model_uuid
+                for model_name, model_uuid in models.items()
+                if known.get(model_name, {}).get("uuid") != model_uuid
+            }
+
+    def record(self, controller_name, model_name, model_uuid, now=None):
+        """Record that the model was processed."""
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.data.setdefault(
+                controller_name, {"runs_since_full_sweep": None, "models": {}}
+            )
+            entry["models"][model_name] = {"uuid": model_uuid, "processed": now}
+
+    def invalidate(self, controller_name, model_name):
+        """Forget that the model was processed, so that the next run selects it."""
+        with self.lock:
+            models = self.data.get(controller_name, {}).get("models", {})
+            if models.pop(model_name, None) is not None:
+                logger.debug(
+                    "invalidating model inventory entry: %s/%s", controller_name, model_name
+                )
+
+
+class TaskHistory(JSONStateFile):
+    """Durations and sizes of the last successful runs of each backup task.
+
+    The state looks like the following (durations are in seconds, sizes in bytes):
+
+    {
+        "<task name>": {
+            "durations": [<oldest duration>, ..., <latest duration>],
+            "sizes": [<oldest size>, ..., <latest size>]
+        }
+    }
+    """
+
+    def __init__(self, path, length):
+        """Initialise the history, keeping the last `length` runs of each task."""
+        super().__init__(path)
+        self.length = length
+
+    def record(self, task_name, duration, size=None):
+        """Record the duration and backed up size of a successful run of a task."""
+        with self.lock:
+            entry = self.data.setdefault(task_name, {})
+            self._append(entry.setdefault("durations", []), round(duration, 3))
+            if size is not None:
+                self._append(entry.setdefault("sizes", []), size)
+
+    def _append(self, values, value):
+        """Append a value to a list of recorded values, dropping the oldest ones."""
+        values.append(value)
+        del values[: -self.length]
+
+    def durations(self, task_name):
+        """Return the recorded durations of a task, oldest first."""
+        with self.lock:
+            return list(self.data.get(task_name, {}).get("durations", []))
+
+    def expected_duration(self, task_name):
+        """Return the median recorded duration of a task, None if it was never run."""
+        durations = self.durations(task_name)
+        return statistics.median(durations) if durations else None
+
+    def expected_size(self, task_name):
+        """Return the median recorded size of a task, None if it was never recorded."""
+        with self.lock:
+            sizes = list(self.data.get(task_name, {}).get("sizes", []))
+        return statistics.median(sizes) if sizes else None
+
+
+class Checkpoint(JSONStateFile):
+    """Tasks completed successfully by the current or last backup run.
+
+    The state looks like the following:
+
+    {
+        "started": <timestamp of the start of the run>,
+        "finished": <whether the run finished>,
+        "tasks": {"<task name>": {"completed": <timestamp>, "results": {<results>}}}
+    }
+    """
+
+    def __init__(self, path, window):
+        """Initialise the checkpoint, a run started more than `window` seconds ago expires."""
+        super().__init__(path)
+        self.window = window
+
+    @property
+    def unfinished(self):
+        """Return True if the last run started but did not finish."""
+        with self.lock:
+            return "started" in self.data and not self.data.get("finished")
+
+    def start(self, now=None):
+        """Start a new run, forgetting the tasks completed by the previous one."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.data = {"started": now, "finished": False, "tasks": {}}
+
+    def resume(self, now=None):
+        """Resume the last run, and return the results of its completed tasks.
+
+        A run started more than `window` seconds ago, e.g. by the previous schedule, has
+        expired: none of its tasks are resumed, and the run starts afresh.
+
+        Returns:
+            results: mapping of task name to its results document
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if now - self.data.get("started", 0) >= self.window:
+                self.start(now=now)
+                return {}
+            self.data["finished"] = False
+            tasks = self.data.setdefault("tasks", {})
+            return {task_name: entry["results"] for task_name, entry in tasks.items()}
+
+    def record(self, task_name, results, now=None):
+        """Record that a task completed successfully with the given results document."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.data.setdefault("tasks", {})[task_name] = {"completed": now, "results": results}
+
+    def finish(self):
+        """Mark the run as finished."""
+        with self.lock:
+            self.data["finished"] = True
+
+
+class BackupFingerprints(JSONStateFile):
+    """Fingerprints of the inputs of the last successful backup of each task.
+
+    The state looks like the following:
+
+    {"<task name>": {"fingerprint": "<fingerprint of the inputs>", "results": {<results>}}}
+    """
+
+    def previous_results(self, task_name, fingerprint):
+        """Return the results of the last backup of a task, None if its inputs changed."""
+        with self.lock:
+            entry = self.data.get(task_name, {})
+            if entry.get("fingerprint") != fingerprint:
+                return None
+            return entry["results"]
+
+    def record(self, task_name, fingerprint, results):
+        """Record the results of a successful backup, with the fingerprint of its inputs."""
+        with self.lock:
+            self.data[task_name] = {"fingerprint": fingerprint, "results": results}
+
+
+class BackupLinks(JSONStateFile):
+    """Times the backup files linking to the content of a previous run were made.
+
+    A hard link shares the modification time of its inode, that of the first backup of
+    the content, so the time of each link is recorded to purge it with its own run.
+
+    The state looks like the following:
+
+    {"<path of the backup file>": <timestamp of the link>}
+    """
+
+    def record(self, path, now=None):
+        """Record that a backup file was linked at `now`."""
+        with self.lock:
+            self.data[str(path)] = time.time() if now is None else now
+
+    def mtime(self, path):
+        """Return the time a backup file was made, that of its link if it is one."""
+        with self.lock:
+            if str(path) in self.data:
+                return self.data[str(path)]
+        return os.stat(path).st_mtime
+
+    def purge(self, backup_dir, days_old, exclude=None, now=None):
+        """Remove the backup files made more than `days_old` days ago.
+
+        As with `find -mtime +<days_old>`, the age is rounded down to whole days. The
+        links of the removed and missing files are forgotten.
+
+        Args:
+            backup_dir: directory of the backup files
+            days_old: age of the backup files to remove, in days
+            exclude: directory within `backup_dir` left out of the purge
+            now: time the ages are counted from, by default the current time
+
+        Returns:
+            removed: number of backup files removed
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        for directory, dirnames, filenames in os.walk(backup_dir):
+            if exclude is not None:
+                dirnames[:] = [
+                    dirname
+                    for dirname in dirnames
+                    if pathlib.Path(directory, dirname) != pathlib.Path(exclude)
+                ]
+            for filename in filenames:
+                path = pathlib.Path(directory, filename)
+                if (now - self.mtime(path)) // 86400 > days_old:
+                    logger.debug("removing backup file %s", path)
+                    path.unlink()
+                    removed += 1
+
+        with self.lock:
+            for path in list(self.data):
+                if not os.path.lexists(path):
+                    del self.data[path]
+        return removed
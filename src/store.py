@@ -0,0 +1,81 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Content-addressed store deduplicating the backup files."""
+import logging
+import os
+import pathlib
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """Store of the backup files by sha256, each distinct content being kept once.
+
+    A backup file is kept as a blob "<root>/<first 2 hex digits>/<sha256>", and the
+    backup file itself is a hard link to the blob. A blob is freed once it is no longer
+    linked from any backup file, i.e. when its link count drops to 1.
+    """
+
+    def __init__(self, root):
+        """Initialise the store in `root`, which must be on the filesystem of the backups."""
+        self.root = pathlib.Path(root)
+
+    def blob_path(self, sha256):
+        """Return the path of the blob of a content."""
+        return self.root / sha256[:2] / sha256
+
+    def add(self, path, sha256):
+        """Store a backup file, replacing it by a link to the blob of the same content.
+
+        The link to a reused blob keeps the modification time of the first backup of the
+        content, the caller records its own time (see `state.BackupLinks`).
+
+        Returns:
+            deduplicated: True if the content was already stored
+        """
+        path = pathlib.Path(path)
+        blob = self.blob_path(sha256)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(path, blob)
+            return False
+        except FileExistsError:
+            pass
+
+        if os.path.samefile(path, blob):
+            return True
+        tmp_path = path.with_name(f".{path.name}.link")
+        os.link(blob, tmp_path)
+        os.replace(tmp_path, path)
+        return True
+
+    def add_results(self, results):
+        """Store the files of a results document with a "sha256".
+
+        Each stored entry records whether it was "deduplicated".
+        """
+        for backup_type, backup_entries in results.items():
+            if not backup_type.endswith("_backups"):
+                continue
+            for backup_entry in backup_entries:
+                path = pathlib.Path(backup_entry.get("download_path", ""))
+                if "sha256" not in backup_entry or not path.is_file():
+                    continue
+                backup_entry["deduplicated"] = self.add(path, backup_entry["sha256"])
+                if backup_entry["deduplicated"]:
+                    logger.debug("%s is already stored as %s", path, backup_entry["sha256"])
+        return results
+
+    def gc(self):
+        """Remove the blobs no longer linked from any backup file.
+
+        Returns:
+            removed: number of blobs removed
+        """
+        removed = 0
+        for blob in self.root.glob("*/*"):
+            if blob.stat().st_nlink == 1:
+                logger.debug("removing unreferenced blob %s", blob)
+                blob.unlink()
+                removed += 1
+        return removed
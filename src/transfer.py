@@ -0,0 +1,270 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Resumable transfers of the backup files from the units."""
+import asyncio
+import contextlib
+import functools
+import hashlib
+import logging
+import os
+import pathlib
+import shlex
+import subprocess
+import threading
+
+from juju.unit import Unit
+
+from config import TRANSFER_BLOCK_SIZE, TRANSFER_VERIFY_SIZE, Paths
+
+logger = logging.getLogger(__name__)
+
+
+class TransferError(Exception):
+    """A transfer did not complete within its retry budget."""
+
+
+class TransferCancelled(Exception):
+    """A transfer was cancelled, e.g. by the timeout of its backup task."""
+
+
+class Remote:
+    """Run the commands of a download on a unit over ssh.
+
+    The download can be cancelled from another thread: its running command is killed,
+    and it runs no other command afterwards.
+    """
+
+    def __init__(self, address, user, ssh_key=Paths.SSH_PRIVATE_KEY, ssh_opts=()):
+        """Initialise the commands, `ssh_opts` are additional options of ssh."""
+        self.address = address
+        self.user = user
+        self.ssh_key = ssh_key
+        self.ssh_opts = list(ssh_opts)
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._processes = set()
+
+    def command(self, remote_command):
+        """Return the ssh command running a command on the unit."""
+        return [
+            "ssh",
+            "-i",
+            str(self.ssh_key),
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            "ServerAliveInterval=30",
+            *self.ssh_opts,
+            f"{self.user}@{self.address}",
+            remote_command,
+        ]
+
+    @contextlib.contextmanager
+    def popen(self, remote_command):
+        """Run a command on the unit, and yield its process writing to a pipe.
+
+        Raises:
+            TransferCancelled: if the download was cancelled
+            subprocess.CalledProcessError: if the command failed
+        """
+        command = self.command(remote_command)
+        with self.unless_cancelled():
+            process = subprocess.Popen(  # pylint: disable=consider-using-with
+                command, stdout=subprocess.PIPE
+            )
+            self._processes.add(process)
+        try:
+            with process:
+                yield process
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        if self.cancelled:
+            raise TransferCancelled(f"download from {self.address} cancelled")
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+    def check_output(self, remote_command):
+        """Run a command on the unit, and return its output."""
+        with self.popen(remote_command) as process:
+            output = process.stdout.read()
+        return output.decode()
+
+    @contextlib.contextmanager
+    def unless_cancelled(self):
+        """Hold off the cancellation of the download within the context.
+
+        Raises:
+            TransferCancelled: if the download was cancelled
+        """
+        with self._lock:
+            if self.cancelled:
+                raise TransferCancelled(f"download from {self.address} cancelled")
+            yield
+
+    def cancel(self):
+        """Cancel the download, killing its running command."""
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                process.kill()
+
+
+class ResumableTransfer:
+    """Download files from the units over ssh, resuming interrupted downloads.
+
+    A file is downloaded to "<destination>.partial", and renamed to the destination
+    once complete. When the download is interrupted, it is resumed from the end of the
+    partial file, after checking that its last bytes match the file on the unit.
+
+    The files are hashed as they are downloaded, their sha256 is kept in `checksums`.
+    """
+
+    def __init__(self, retries, ssh_key=Paths.SSH_PRIVATE_KEY):
+        """Initialise the transfers, each one is resumed at most `retries` times."""
+        self.retries = retries
+        self.ssh_key = ssh_key
+        # path of each downloaded file: (sha256, size, mtime_ns), see `add_checksums`
+        self.checksums = {}
+
+    @contextlib.contextmanager
+    def installed(self):
+        """Download the files juju-backup-all copies from the units with `scp_from`.
+
+        `Unit.scp_from` is replaced within the context only, the files copied through
+        the juju api server (`proxy=True`) are still copied with scp. The `scp_opts` are
+        passed to ssh. When `scp_from` is cancelled, e.g. by the timeout of its task, the
+        download is stopped before it returns, and its file is left partial.
+        """
+        scp_from = Unit.scp_from
+        transfer = self
+
+        @functools.wraps(scp_from)
+        async def resumable_scp_from(
+            unit, source, destination, user="ubuntu", proxy=False, scp_opts=""
+        ):
+            if proxy:
+                return await scp_from(
+                    unit, source, destination, user=user, proxy=proxy, scp_opts=scp_opts
+                )
+            ssh_opts = shlex.split(scp_opts) if isinstance(scp_opts, str) else scp_opts
+            remote = Remote(unit.machine.dns_name, user, transfer.ssh_key, ssh_opts)
+            loop = asyncio.get_running_loop()
+            download = loop.run_in_executor(None, transfer.download, remote, source, destination)
+            try:
+                return await asyncio.shield(download)
+            except asyncio.CancelledError:
+                remote.cancel()
+                # the download thread must be done before the task is reported failed
+                await asyncio.wait([download])
+                raise
+
+        Unit.scp_from = resumable_scp_from
+        try:
+            yield
+        finally:
+            Unit.scp_from = scp_from
+
+    def download(self, remote, source, destination):
+        """Download the file `source` of a unit to `destination`, resuming on failures.
+
+        Raises:
+            TransferError: if the download still fails after `retries` resumptions
+            TransferCancelled: if the download was cancelled, see `Remote.cancel`
+        """
+        destination = pathlib.Path(destination)
+        if destination.is_dir():
+            destination = destination / os.path.basename(source)
+        partial = destination.with_name(destination.name + ".partial")
+
+        for attempt in range(self.retries + 1):
+            try:
+                size = int(remote.check_output(f"stat -c %s {shlex.quote(source)}"))
+                offset = self._verified_offset(remote, source, partial)
+                partial.touch()
+                digest = self._partial_digest(partial, offset)
+                if offset < size:
+                    logger.info(
+                        "downloading %s from %s at offset %d", source, remote.address, offset
+                    )
+                    self._append(remote, source, partial, offset, digest)
+                if partial.is_file() and partial.stat().st_size == size:
+                    with remote.unless_cancelled():
+                        os.replace(partial, destination)
+                    stat = destination.stat()
+                    self.checksums[str(destination)] = (
+                        digest.hexdigest(),
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                    )
+                    return
+                raise TransferError(
+                    f"{source} from {remote.address}: got {partial.stat().st_size} of {size} bytes"
+                )
+            except (subprocess.CalledProcessError, OSError, TransferError) as error:
+                logger.warning(
+                    "download of %s from %s failed (attempt %d of %d): %s",
+                    source,
+                    remote.address,
+                    attempt + 1,
+                    self.retries + 1,
+                    error,
+                )
+        raise TransferError(
+            f"download of {source} from {remote.address} failed after {self.retries} "
+            f"resumptions, the partial file is kept in {partial}"
+        )
+
+    def _verified_offset(self, remote, source, partial):
+        """Return the offset to resume a download from, 0 if the partial file is invalid.
+
+        The last bytes of the partial file are compared with the same bytes of the file
+        on the unit, which detects a file that changed on the unit since.
+        """
+        if not partial.is_file():
+            return 0
+        offset = partial.stat().st_size
+        length = min(offset, TRANSFER_VERIFY_SIZE)
+        if length == 0:
+            return 0
+
+        with open(partial, "rb") as local:
+            local.seek(offset - length)
+            local_digest = hashlib.sha256(local.read(length)).hexdigest()
+        remote_digest = remote.check_output(
+            f"tail -c +{offset - length + 1} {shlex.quote(source)} | head -c {length}"
+            " | sha256sum"
+        ).split()[0]
+        if local_digest != remote_digest:
+            logger.warning(
+                "%s does not match %s on %s, restarting", partial, source, remote.address
+            )
+            partial.unlink()
+            return 0
+        return offset
+
+    def _partial_digest(self, partial, offset):
+        """Return the sha256 of the first `offset` bytes of the partial file.
+
+        Only the partial file of a resumed download is read, the bytes downloaded from
+        now on are hashed as they are written.
+        """
+        digest = hashlib.sha256()
+        if offset > 0:
+            with open(partial, "rb") as local:
+                for block in iter(lambda: local.read(TRANSFER_BLOCK_SIZE), b""):
+                    digest.update(block)
+        return digest
+
+    def _append(self, remote, source, partial, offset, digest):
+        """Append the bytes of `source` from `offset` onwards to the partial file.
+
+        The appended bytes are added to `digest`.
+        """
+        with open(partial, "ab") as target:
+            with remote.popen(f"tail -c +{offset + 1} {shlex.quote(source)}") as process:
+                for block in iter(lambda: process.stdout.read(TRANSFER_BLOCK_SIZE), b""):
+                    digest.update(block)
+                    target.write(block)
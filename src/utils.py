@@ -3,25 +3,58 @@
 """Utils for the charm."""
 import asyncio
 import base64
+import contextlib
+import functools
 import hashlib
+import json
 import logging
+import math
 import os
 import pathlib
+import re
 import socket
 import subprocess
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
+import jujubackupall.utils
 import yaml
 from charmhelpers.contrib.charmsupport.nrpe import NRPE
 from charmhelpers.core import hookenv, host
 from charmhelpers.core.host import rsync
+from juju.client import client
 from jujubackupall.config import Config
 from jujubackupall.process import BackupProcessor
-from jujubackupall.utils import connect_controller, connect_model
 from ops.model import BlockedStatus
 from yaml.parser import ParserError
 
-from config import BACKUP_USERNAME, Paths
+from checksum import add_checksums, tree_sha256, write_manifest
+from compression import CODECS, LEVELS, Compressor, valid_level
+from config import (
+    BACKUP_CHARMS,
+    BACKUP_USERNAME,
+    BLOB_STORE_DIRNAME,
+    CLIENT_CONFIG_FILES,
+    CLIENT_CONFIG_WORKER,
+    DEFAULT_BACKUP_CONCURRENCY,
+    DEFAULT_BACKUP_CONCURRENCY_PER_CONTROLLER,
+    DEFAULT_BACKUP_CONCURRENCY_PER_MODEL,
+    DEFAULT_SSH_KEY_PUSH_CONCURRENCY,
+    MODEL_DISCOVERY_CONCURRENCY,
+    SSH_KEY_TYPE,
+    SSH_KEY_TYPES,
+    TASK_HISTORY_SIZE,
+    Paths,
+    auto_backup_results_paths,
+    controller_scoped_path,
+)
+from scheduler import AdaptiveTimeout, BackupTask, TaskScheduler, TaskSkipped
+from sharding import Shard
+from state import BackupFingerprints, BackupLinks, ModelInventory, SSHKeyCache, TaskHistory
+from store import BlobStore
+from transfer import ResumableTransfer
 
 # configure libjuju to the location of the credentials
 if "JUJUDATA_DIR" not in os.environ:
@@ -34,6 +67,273 @@ def run_async(func):
     return loop.run_until_complete(func)
 
 
+class ConnectionPool:
+    """Controller and model connections shared by every phase of a worker's job.
+
+    libjuju connections are bound to the event loop they were created in, so every
+    worker has a pool of its own (see `worker_context`), made current for its thread:
+    a planning worker shares its connections between the ssh key push and the listing
+    of the charms. juju-backup-all opens connections of its own for the backups.
+    The connections are set up once and closed when the pool is deactivated, or for
+    the model connections when they are released (see `release_models`).
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        """Initialise an empty pool."""
+        self._stack = contextlib.ExitStack()
+        self._model_stack = contextlib.ExitStack()
+        self._controllers = {}
+        self._models = {}
+
+    @classmethod
+    def current(cls):
+        """Return the pool of the current thread, if any."""
+        return getattr(cls._local, "pool", None)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make the pool current for this thread, and close its connections afterwards."""
+        ConnectionPool._local.pool = self
+        try:
+            with self._stack:
+                try:
+                    yield self
+                finally:
+                    # the models are disconnected before their controllers
+                    self.release_models()
+        finally:
+            ConnectionPool._local.pool = None
+
+    def controller(self, controller_name, *args, **kwargs):
+        """Return the pooled connection to a controller, connecting if needed."""
+        if controller_name not in self._controllers:
+            self._controllers[controller_name] = self._stack.enter_context(
+                jujubackupall.utils.connect_controller(controller_name, *args, **kwargs)
+            )
+        return self._controllers[controller_name]
+
+    def model(self, controller, model_name, *args, **kwargs):
+        """Return the pooled connection to a model, connecting if needed."""
+        key = (id(controller), model_name)
+        if key not in self._models:
+            self._models[key] = self._model_stack.enter_context(
+                jujubackupall.utils.connect_model(controller, model_name, *args, **kwargs)
+            )
+        return self._models[key]
+
+    def cached_model(self, controller, model_name):
+        """Return the pooled connection to a model if there is one."""
+        return self._models.get((id(controller), model_name))
+
+    def add_model(self, controller, model_name, model):
+        """Pool a model connected by the caller, it is disconnected with the pool."""
+        self._models[(id(controller), model_name)] = model
+        self._model_stack.callback(self._disconnect, model)
+
+    def release_models(self):
+        """Close the model connections, keeping the controller connections."""
+        model_stack, self._model_stack = self._model_stack, contextlib.ExitStack()
+        self._models = {}
+        try:
+            model_stack.close()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.error(traceback.format_exc())
+
+    @staticmethod
+    def _disconnect(connection):
+        """Disconnect without interrupting the closing of the other connections."""
+        try:
+            run_async(connection.disconnect())
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.error(traceback.format_exc())
+
+
+def _pooled(connect_name, pool_method):
+    """Wrap a jujubackupall.utils connect context manager to serve pooled connections.
+
+    The connect function is looked up when called, like the pool does, so that it can
+    be replaced after this module is imported.
+    """
+
+    @contextlib.contextmanager
+    @functools.wraps(getattr(jujubackupall.utils, connect_name))
+    def pooled_connect(*args, **kwargs):
+        pool = ConnectionPool.current()
+        if pool is None:
+            connect = getattr(jujubackupall.utils, connect_name)
+            with connect(*args, **kwargs) as connection:
+                yield connection
+        else:
+            yield getattr(pool, pool_method)(*args, **kwargs)
+
+    return pooled_connect
+
+
+connect_controller = _pooled("connect_controller", "controller")
+connect_model = _pooled("connect_model", "model")
+
+
+async def get_pooled_model(controller, model_name):
+    """Connect to a model, reusing and pooling the connection if a pool is current."""
+    pool = ConnectionPool.current()
+    model = pool.cached_model(controller, model_name) if pool is not None else None
+    if model is None:
+        logging.debug("connecting to model: '%s'", model_name)
+        model = await controller.get_model(model_name)
+        if pool is not None:
+            pool.add_model(controller, model_name, model)
+    return model
+
+
+async def release_pooled_model(model):
+    """Disconnect from a model, unless the connection is pooled."""
+    if ConnectionPool.current() is None:
+        await model.disconnect()
+
+
+@contextlib.contextmanager
+def worker_context():
+    """Set up a worker thread with an event loop and connection pool of its own.
+
+    libjuju connections are bound to the event loop they were created in, so every
+    worker gets a fresh event loop and connection pool, closed when it is done.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with ConnectionPool().activate():
+            yield
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def generate_ssh_key(private_key_path, key_type):
+    """Generate a passphrase-less ssh key pair of type `key_type` (see SSH_KEY_TYPES)."""
+    keyname = f"{BACKUP_USERNAME}@{socket.gethostname()}"
+    cmd = ["ssh-keygen", "-t", key_type]
+    if key_type == "rsa":
+        cmd += ["-b", "2048"]
+    cmd += ["-f", private_key_path, "-C", keyname, "-N", ""]
+    try:
+        subprocess.check_output(cmd)
+    except subprocess.CalledProcessError as error:
+        logging.error(error.output.decode("utf8"))
+        raise
+
+
+def ssh_key_type(raw_pubkey):
+    """Return the type (see SSH_KEY_TYPES) of a public ssh key."""
+    algorithm = raw_pubkey.split()[0]
+    for key_type, key_algorithm in SSH_KEY_TYPES.items():
+        if algorithm == key_algorithm:
+            return key_type
+    raise ValueError(f"Unsupported ssh key algorithm: {algorithm}")
+
+
+def _is_backup_key_fingerprint(fingerprint):
+    """Return True if a libjuju key fingerprint belongs to a jujubackup key."""
+    # libjuju fingerprints look like "<md5 fingerprint> (<key comment>)"
+    _fingerprint, _, comment = fingerprint.partition(" ")
+    return comment.startswith(f"({BACKUP_USERNAME}@")
+
+
+def backup_results_size(results):
+    """Return the total size in bytes of the backup files of a results document."""
+    size = 0
+    for backup_type, backup_entries in results.items():
+        if not backup_type.endswith("_backups"):
+            continue
+        for backup_entry in backup_entries:
+            try:
+                size += os.path.getsize(backup_entry["download_path"])
+            except (KeyError, OSError):
+                continue
+    return size
+
+
+def crontab_jitter_delay(key, window):
+    """Return a delay in seconds within `window` seconds, always the same for a given key."""
+    if window <= 0:
+        return 0
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:16], 16) % window
+
+
+def crontab_period(crontab):
+    """Return the hours between two runs scheduled by a crontab, at most.
+
+    The period of the crontab is bounded by its most restrictive field: a year if it
+    restricts the months, a month for the days of the month, a week for the days of
+    the week and a day otherwise.
+    """
+    fields = crontab.split()
+    period_days = 1
+    if len(fields) == 5:
+        _, _, day_of_month, month, day_of_week = fields
+        if month != "*":
+            period_days = 366
+        elif day_of_month != "*":
+            period_days = 31
+        elif day_of_week != "*":
+            period_days = 7
+    return period_days * 24
+
+
+def crontab_max_age(crontab, jitter=0):
+    """Return the hours after which the results of runs scheduled by a crontab are stale.
+
+    An hour is added to the period of the crontab for the run itself, plus the `jitter`
+    minutes the start of the runs is delayed by (see `crontab_jitter_delay`).
+    """
+    return crontab_period(crontab) + 1 + math.ceil(jitter / 60)
+
+
+def _elapsed(start):
+    """Return the seconds elapsed since `start` (from time.monotonic)."""
+    return round(time.monotonic() - start, 3)
+
+
+def run_in_workers(jobs):
+    """Run each job in its own worker thread (see `worker_context`), alongside the others.
+
+    Args:
+        jobs: mapping of job name to a callable taking no arguments
+
+    Returns:
+        results: mapping of job name to the value returned by the job
+    """
+
+    def worker(job):
+        with worker_context():
+            return job()
+
+    if not jobs:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = {name: executor.submit(worker, job) for name, job in jobs.items()}
+
+    return {name: future.result() for name, future in futures.items()}
+
+
+def merge_backup_results(backup_results):
+    """Merge several juju-backup-all results documents into a single one.
+
+    Lists (e.g. "controller_backups", "errors") are concatenated, any other entry is
+    kept from the first document it appears in.
+    """
+    merged = {}
+    for raw_results in backup_results:
+        for key, value in json.loads(raw_results).items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged.setdefault(key, value)
+    return json.dumps(merged, indent=2)
+
+
 class JujuBackupAllHelper:
     """Juju-backup-all helper object."""
 
@@ -103,6 +403,13 @@ class JujuBackupAllHelper:
         # set up the check in nagios via relation
         base_cmd = str(Paths.NAGIOS_PLUGINS_DIR / "check_auto_backup_results.py")
         check_cmd = f"{base_cmd} --backup-results-file {Paths.AUTO_BACKUP_RESULTS_PATH}"
+        # the results of each schedule are stale once a run of the schedule is missed
+        jitter = self.charm_config["crontab-jitter"]
+        max_age = crontab_max_age(self.charm_config["crontab"], jitter)
+        check_cmd += f" --backup-results-max-age {max_age}"
+        for controller_name, crontab in sorted(self.controller_crontabs.items()):
+            max_age = crontab_max_age(crontab, jitter)
+            check_cmd += f" --controller-max-age {controller_name}={max_age}"
         self.nrpe.add_check(
             shortname="juju_backup_all_results",
             description="check results file generated by auto_backup.py",
@@ -116,66 +423,313 @@ class JujuBackupAllHelper:
         Paths.JUJUDATA_COOKIES_DIR.mkdir(exist_ok=True)
 
         if not Paths.SSH_PRIVATE_KEY.exists():
-            keyname = f"{BACKUP_USERNAME}@{socket.gethostname()}"
             logging.debug("ssh key doesn't exist, creating it...")
-            cmd = [
-                "ssh-keygen",
-                "-t",
-                "rsa",
-                "-b",
-                "2048",
-                "-f",
-                Paths.SSH_PRIVATE_KEY,
-                "-C",
-                keyname,
-                "-N",
-                "",
-            ]
-            try:
-                subprocess.check_output(cmd)
-            except subprocess.CalledProcessError as error:
-                logging.error(error.output.decode("utf8"))
-                raise
+            generate_ssh_key(Paths.SSH_PRIVATE_KEY, SSH_KEY_TYPE)
 
         self._update_dir_owner(Paths.JUJUDATA_DIR)
 
     def perform_backup(self, omit_models=None):
         """Perform backups."""
-        # first ensure the ssh key is in all models, then perform the backup
-        self.push_ssh_keys()
-        backup_processor = BackupProcessor(self.config)
-        backup_results = backup_processor.process_backups(omit_models=omit_models)
+        runner = self._get_backup_runner()
+        backup_results = runner.run(omit_models=omit_models)
         logging.info("backup results = '%s'", backup_results)
         self._update_dir_owner(self.charm_config["backup-dir"])
         return backup_results
 
-    def push_ssh_keys(self):
-        """Use helper to push ssh keys."""
-        ssh_helper = SSHKeyHelper(self.config, self.accounts)
+    def plan_backup(self):
+        """Return the plan of a scheduled backup run, with its expected duration and size."""
+        omit_models = [name for name in self.charm_config["exclude-models"].split(",") if name]
+        # the plan does not push the ssh key, it needs no ssh key helper
+        runner = self._get_backup_runner(push_ssh_keys=False)
+        return json.dumps(runner.estimate(omit_models=omit_models), indent=2)
+
+    def retry_failed(self):
+        """Run again the failed tasks of the last auto backup runs, and update their results.
+
+        The results of the main runs and of the controllers backed up on a schedule of
+        their own (see `controller-crontabs`) are retried one file after the other.
+
+        Returns:
+            results: the merged results documents of the retried runs, None if the last
+                runs have no failed tasks to retry
+
+        Raises:
+            ValueError: if there are failed tasks to retry, but none is known
+        """
+        runner = None
+        retried_results, problems = [], []
+        for results_path in auto_backup_results_paths():
+            try:
+                backup_results = results_path.read_text(encoding="utf-8")
+                previous = json.loads(backup_results)
+            except (OSError, ValueError) as error:
+                problems.append(f"No valid backup results to retry: {error}")
+                continue
+            if "ERROR" in previous:
+                problems.append(
+                    f"The last backup run of {results_path.name} crashed, its failed tasks are"
+                    " unknown. Run do-backup."
+                )
+                continue
+            if not previous.get("errors"):
+                continue
+
+            runner = runner or self._get_backup_runner()
+            backup_results = runner.retry_failed(backup_results)
+            logging.info("backup results of %s = '%s'", results_path.name, backup_results)
+            results_path.write_text(backup_results, encoding="utf-8")
+            if self.charm_config["backup-checksums"]:
+                # "auto_backup_results[.<controller>].json" has a manifest of its own
+                controller_name = results_path.stem.partition(".")[2] or None
+                write_manifest(
+                    json.loads(backup_results),
+                    controller_scoped_path(Paths.AUTO_BACKUP_MANIFEST_PATH, controller_name),
+                )
+            retried_results.append(backup_results)
+
+        for problem in problems:
+            logging.warning(problem)
+        if not retried_results:
+            if problems:
+                raise ValueError(" ".join(problems))
+            return None
+        self._update_dir_owner(self.charm_config["backup-dir"])
+        return merge_backup_results(retried_results)
+
+    def _get_backup_runner(self, push_ssh_keys=True):
+        """Return a BackupRunner configured from the charm config.
+
+        Args:
+            push_ssh_keys: give the runner a ssh key helper, only a runner planning the
+                backups without running them can do without
+        """
+        return BackupRunner(
+            self._charm_config_to_datadict(),
+            self._get_ssh_key_helper() if push_ssh_keys else None,
+            lazy_ssh_key_push=self.charm_config["lazy-ssh-key-push"],
+            concurrency=self.charm_config["backup-concurrency"],
+            concurrency_per_controller=self.charm_config["backup-concurrency-per-controller"],
+            concurrency_per_model=self.charm_config["backup-concurrency-per-model"],
+            adaptive_timeout=(
+                AdaptiveTimeout(
+                    self.charm_config["adaptive-timeout-factor"],
+                    self.charm_config["adaptive-timeout-floor"],
+                    self.charm_config["adaptive-timeout-ceiling"],
+                )
+                if self.charm_config["adaptive-timeout"]
+                else None
+            ),
+            deadline=self.charm_config["run-deadline"] * 60,
+            priorities=self.backup_priorities,
+            compressor=(
+                Compressor(
+                    self.charm_config["compression"],
+                    self.charm_config["compression-level"],
+                    concurrent_tasks=self.charm_config["backup-concurrency"],
+                )
+                if self.charm_config["compression"]
+                else None
+            ),
+            checksums=self.charm_config["backup-checksums"],
+            store=(
+                BlobStore(pathlib.Path(self.charm_config["backup-dir"]) / BLOB_STORE_DIRNAME)
+                if self.charm_config["dedup-store"]
+                else None
+            ),
+            skip_unchanged=self.charm_config["skip-unchanged"],
+            transfer_retries=self.charm_config["transfer-retries"],
+        )
+
+    def push_ssh_keys(self, progress=None):
+        """Use helper to push ssh keys.
+
+        Args:
+            progress: callable receiving a message each time a controller or model is done
+
+        Returns:
+            report: json document with the timings and outcome of each controller and model
+        """
+        ssh_helper = self._get_ssh_key_helper(progress=progress)
         ssh_helper.push_ssh_keys_to_models()
-        return "success"
+        return json.dumps(ssh_helper.report, indent=2)
+
+    def gc_ssh_keys(self, dry_run=False, progress=None):
+        """Remove the stale backup ssh keys from all models.
+
+        Args:
+            dry_run: only report the stale keys, without removing them
+            progress: callable receiving a message each time a controller or model is done
+
+        Returns:
+            report: json document with the stale keys and any error of each model
+        """
+        ssh_helper = self._get_ssh_key_helper(progress=progress)
+        ssh_helper.gc_stale_ssh_keys(dry_run=dry_run)
+        return json.dumps(ssh_helper.report, indent=2)
+
+    def rotate_ssh_key(self, key_type, progress=None):
+        """Replace the backup ssh key by a new key of type `key_type` in every model.
+
+        The rollout is done in three steps, so that backups keep working throughout:
+        1. the new key is pushed to all models concurrently,
+        2. the backups are switched over to the new key,
+        3. the old key is removed from every model in parallel.
+        The rotation can be run again to resume where it stopped after a failure.
+
+        Returns:
+            rotation: dict with whether the key was "switched", whether the old key was
+                "removed" from all models, and the ssh key helper "report"
+        """
+        ssh_helper = self._get_ssh_key_helper(progress=progress)
+        rotation = ssh_helper.rotate_ssh_key(key_type)
+        self._update_dir_owner(Paths.JUJUDATA_DIR)
+        rotation["report"] = ssh_helper.report
+        return rotation
+
+    def update_shard(self, unit, units, ssh_public_keys):
+        """Write the shard of the unit among the units of the application.
+
+        The scheduled backup runs of the unit only run the tasks of its shard.
+        """
+        Shard(unit, units, ssh_public_keys).save(Paths.SHARD_PATH)
+
+    @property
+    def backup_priorities(self):
+        """Return the backup-priorities config parsed, mapping charms to priorities."""
+        return yaml.safe_load(self.charm_config["backup-priorities"] or "{}") or {}
+
+    @property
+    def controller_crontabs(self):
+        """Return the controller-crontabs config parsed, mapping controllers to crontabs."""
+        return yaml.safe_load(self.charm_config["controller-crontabs"] or "{}") or {}
 
     def update_crontab(self):
-        """Update crontab "/etc/cron.d/juju-backup-all" that runs "auto_backup.py"."""
+        """Update crontab "/etc/cron.d/juju-backup-all" that runs "auto_backup.py".
+
+        The controllers with a crontab of their own in "controller-crontabs" are backed up
+        by cron jobs of their own, and excluded from the main cron job.
+        """
         path = "PATH=/usr/bin:/bin:/snap/bin"
-        # root used because the backup script needs to write to /var/snap/{exporter_name}/common
-        cron_job = (
-            f"{path}\n{self.charm_config['crontab']} root {Paths.AUTO_BACKUP_SCRIPT_PATH} --debug"
+        controller_crontabs = self.controller_crontabs
+
+        # spread the start of the backups of the deployments sharing the same crontab, the
+        # model uuid tells apart the deployments whose model and unit names are the same
+        delay = crontab_jitter_delay(
+            f"{self.model.uuid}/{self.model.unit.name}", self.charm_config["crontab-jitter"] * 60
         )
+        command = f"sleep {delay} && " if delay else ""
+        command += f"{Paths.AUTO_BACKUP_SCRIPT_PATH} --debug"
+
+        # root used because the backup script needs to write to /var/snap/{exporter_name}/common
+        cron_job = f"{path}\n{self.charm_config['crontab']} root {command}"
+        cron_job += self._auto_backup_options(self.charm_config["crontab"])
+        for controller_name in sorted(controller_crontabs):
+            cron_job += f" --exclude-controller {controller_name}"
+        cron_job += self._omit_models_options()
+        cron_job += f" >> {Paths.AUTO_BACKUP_LOG_PATH} 2>&1\n"
+
+        for controller_name, crontab in sorted(controller_crontabs.items()):
+            cron_job += f"{crontab} root {command}"
+            cron_job += self._auto_backup_options(crontab)
+            cron_job += f" --controller {controller_name}"
+            cron_job += self._omit_models_options()
+            cron_job += f" >> {Paths.AUTO_BACKUP_LOG_PATH} 2>&1\n"
+
+        Paths.AUTO_BACKUP_CRONTAB_PATH.write_text(cron_job, encoding="utf-8")
+        self._remove_stale_controller_results(controller_crontabs)
+
+    def _auto_backup_options(self, crontab):
+        """Return the "auto_backup.py" options set from the charm config.
 
+        The runs scheduled by `crontab` only resume an unfinished run started less than
+        their period ago, less the hour of the run itself (see `crontab_max_age`).
+        """
+        options = ""
         if self.charm_config["backup-retention-period"]:
-            cron_job += f" --purge {self.charm_config['backup-retention-period']}"
+            options += f" --purge {self.charm_config['backup-retention-period']}"
 
         if self.charm_config["timeout"]:
-            cron_job += f" --task-timeout {self.charm_config['timeout']}"
+            options += f" --task-timeout {self.charm_config['timeout']}"
 
-        if self.charm_config["exclude-models"]:
-            exclude_models = self.charm_config["exclude-models"].split(",")
-            omit_model_params = " ".join([f"--omit-model {m}" for m in exclude_models])
-            cron_job += " " + omit_model_params
+        if self.charm_config["ssh-key-push-concurrency"]:
+            options += (
+                f" --ssh-key-push-concurrency {self.charm_config['ssh-key-push-concurrency']}"
+            )
 
-        cron_job += f" >> {Paths.AUTO_BACKUP_LOG_PATH} 2>&1\n"
-        Paths.AUTO_BACKUP_CRONTAB_PATH.write_text(cron_job, encoding="utf-8")
+        if self.charm_config["ssh-key-cache-ttl"]:
+            options += f" --ssh-key-cache-ttl {self.charm_config['ssh-key-cache-ttl']}"
+
+        if self.charm_config["ssh-key-full-sweep-runs"]:
+            options += f" --ssh-key-full-sweep-runs {self.charm_config['ssh-key-full-sweep-runs']}"
+
+        if self.charm_config["lazy-ssh-key-push"]:
+            options += " --lazy-ssh-key-push"
+
+        for option in (
+            "backup-concurrency",
+            "backup-concurrency-per-controller",
+            "backup-concurrency-per-model",
+        ):
+            options += f" --{option} {self.charm_config[option]}"
+
+        if self.charm_config["resume-window"]:
+            resume_window = min(self.charm_config["resume-window"], crontab_period(crontab) - 1)
+            options += f" --resume-window {resume_window}"
+
+        if self.charm_config["adaptive-timeout"]:
+            options += " --adaptive-timeout"
+            for option in (
+                "adaptive-timeout-factor",
+                "adaptive-timeout-floor",
+                "adaptive-timeout-ceiling",
+            ):
+                options += f" --{option} {self.charm_config[option]}"
+
+        if self.charm_config["run-deadline"]:
+            options += f" --run-deadline {self.charm_config['run-deadline']}"
+
+        for name, priority in sorted(self.backup_priorities.items()):
+            options += f" --backup-priority {name}={priority}"
+
+        if self.charm_config["backup-checksums"]:
+            options += " --checksums"
+
+        if self.charm_config["dedup-store"]:
+            options += " --dedup-store"
+
+        if self.charm_config["skip-unchanged"]:
+            options += " --skip-unchanged"
+
+        if self.charm_config["transfer-retries"]:
+            options += f" --transfer-retries {self.charm_config['transfer-retries']}"
+
+        if self.charm_config["compression"]:
+            options += f" --compression {self.charm_config['compression']}"
+            options += f" --compression-level {self.charm_config['compression-level']}"
+
+        return options
+
+    def _omit_models_options(self):
+        """Return the "auto_backup.py" options omitting the excluded models."""
+        if not self.charm_config["exclude-models"]:
+            return ""
+        exclude_models = self.charm_config["exclude-models"].split(",")
+        return " " + " ".join([f"--omit-model {m}" for m in exclude_models])
+
+    @staticmethod
+    def _remove_stale_controller_results(controller_crontabs):
+        """Remove the results of the controllers no longer backed up on their own schedule.
+
+        Otherwise their last results would be checked by nagios forever.
+        """
+        for results_path in auto_backup_results_paths()[1:]:
+            controller_name = results_path.stem.split(".", 1)[1]
+            if controller_name not in controller_crontabs:
+                logging.info("removing stale backup results '%s'", results_path)
+                results_path.unlink(missing_ok=True)
+                controller_scoped_path(Paths.AUTO_BACKUP_MANIFEST_PATH, controller_name).unlink(
+                    missing_ok=True
+                )
 
     def update_jujudata_config(self):
         """Update the config files in JUJU_DATA."""
@@ -214,6 +768,42 @@ class JujuBackupAllHelper:
                 logging.error(traceback.format_exc())
                 self.model.unit.status = BlockedStatus(msg)
                 return False
+
+        try:
+            controller_crontabs = self.controller_crontabs
+            assert isinstance(controller_crontabs, dict)
+            assert all(isinstance(crontab, str) for crontab in controller_crontabs.values())
+        except (ParserError, AssertionError):
+            msg = "Invalid yaml for 'controller-crontabs' option"
+            logging.error(msg)
+            logging.error(traceback.format_exc())
+            self.model.unit.status = BlockedStatus(msg)
+            return False
+
+        try:
+            backup_priorities = self.backup_priorities
+            assert isinstance(backup_priorities, dict)
+            assert all(isinstance(priority, int) for priority in backup_priorities.values())
+        except (ParserError, AssertionError):
+            msg = "Invalid yaml for 'backup-priorities' option"
+            logging.error(msg)
+            logging.error(traceback.format_exc())
+            self.model.unit.status = BlockedStatus(msg)
+            return False
+
+        if self.charm_config["compression"] and self.charm_config["compression"] not in CODECS:
+            msg = f"Invalid codec for 'compression' option, use one of: {', '.join(CODECS)}"
+            logging.error(msg)
+            self.model.unit.status = BlockedStatus(msg)
+            return False
+
+        codec = self.charm_config["compression"]
+        if codec and not valid_level(codec, self.charm_config["compression-level"]):
+            lowest, highest = LEVELS[codec]
+            msg = f"Invalid 'compression-level' option, use {lowest} to {highest} for {codec}"
+            logging.error(msg)
+            self.model.unit.status = BlockedStatus(msg)
+            return False
         return True
 
     def _charm_config_to_datadict(self):
@@ -234,6 +824,17 @@ class JujuBackupAllHelper:
             "backup_location_on_etcd": self.charm_config["backup-location-on-etcd"],
         }
 
+    def _get_ssh_key_helper(self, progress=None):
+        """Return a SSHKeyHelper configured from the charm config."""
+        return SSHKeyHelper(
+            self.config,
+            self.accounts,
+            concurrency=self.charm_config["ssh-key-push-concurrency"],
+            cache_ttl=self.charm_config["ssh-key-cache-ttl"],
+            full_sweep_runs=self.charm_config["ssh-key-full-sweep-runs"],
+            progress=progress,
+        )
+
     def _update_dir_owner(self, path):
         """Set the right owner for the jujudata directory."""
         host.chownr(
@@ -244,48 +845,981 @@ class JujuBackupAllHelper:
         )
 
 
-class SSHKeyHelper:  # pylint: disable=too-few-public-methods
+class BackupRunner:
+    """Run the backups as independent tasks, many of them in parallel.
+
+    The backups are split into tasks (see `BackupTask`): the juju client config, each
+    controller, and each backed up charm of each model. The tasks of every controller
+    are planned by a worker of their own, which also pushes the ssh key to the models,
+    then the tasks are run by the `TaskScheduler` within the concurrency caps.
+
+    The tasks are started by decreasing priority, then longest first according to
+    their duration history, so that a long task does not start last and delay the end
+    of the run. If the run has a deadline, the tasks that are not expected to be done
+    by then are skipped, and reported as failed.
+    """
+
+    def __init__(
+        self,
+        config_data,
+        ssh_helper,
+        lazy_ssh_key_push=False,
+        concurrency=DEFAULT_BACKUP_CONCURRENCY,
+        concurrency_per_controller=DEFAULT_BACKUP_CONCURRENCY_PER_CONTROLLER,
+        concurrency_per_model=DEFAULT_BACKUP_CONCURRENCY_PER_MODEL,
+        adaptive_timeout=None,
+        checkpoint=None,
+        shard=None,
+        deadline=0,
+        priorities=None,
+        compressor=None,
+        checksums=False,
+        store=None,
+        skip_unchanged=False,
+        transfer_retries=0,
+    ):  # pylint: disable=too-many-arguments
+        """Initialise the runner.
+
+        Args:
+            config_data: juju-backup-all config as a dict (see `Config`)
+            ssh_helper: SSHKeyHelper used to push the ssh key before the backups, None
+                if the runner only estimates the backups
+            lazy_ssh_key_push: do not push the ssh key before the backups, but only to
+                the models where a backup failed and the key is missing, before retrying
+                it (see `SSHKeyHelper.repair_ssh_key`)
+            concurrency: maximum number of tasks running at any given time
+            concurrency_per_controller: maximum number of tasks of a controller running at
+                any given time, 0 for no cap
+            concurrency_per_model: maximum number of tasks of a model running at any given
+                time, 0 for no cap
+            adaptive_timeout: AdaptiveTimeout deriving the timeout of each task from its
+                duration history, None to use the configured timeout for every task
+            checkpoint: Checkpoint recording each completed task so that an interrupted
+                run can be resumed, None to always run every task
+            shard: Shard of this unit, only its tasks are run, None to run all tasks
+            deadline: seconds from the start of the run after which no task should be
+                running, 0 for no deadline
+            priorities: mapping of charm name, "controller" or "juju-client-config" to
+                the priority of its tasks, the higher the sooner, 0 by default
+            compressor: Compressor of the files downloaded by each task, None to keep
+                them as they are
+            checksums: record the sha256 of the files of each task in its results
+            store: BlobStore deduplicating the files of each task, which are then always
+                checksummed, None to keep a copy of every file
+            skip_unchanged: link the files of the last backup of the juju client config
+                instead of backing it up again, if it did not change since
+            transfer_retries: number of times the download of a file from a unit is
+                resumed before the task fails, 0 to download the files with scp
+        """
+        self.config_data = config_data
+        self.ssh_helper = ssh_helper
+        self.lazy_ssh_key_push = lazy_ssh_key_push
+        self.scheduler = TaskScheduler(
+            concurrency,
+            max_per_controller=concurrency_per_controller,
+            max_per_model=concurrency_per_model,
+            worker_context=worker_context,
+        )
+        self.adaptive_timeout = adaptive_timeout
+        self.checkpoint = checkpoint
+        self.shard = shard
+        self.deadline = deadline
+        self.priorities = priorities or {}
+        self.compressor = compressor
+        self.checksums = checksums
+        self.store = store
+        self.skip_unchanged = skip_unchanged
+        self.fingerprints = BackupFingerprints(Paths.BACKUP_FINGERPRINTS_PATH)
+        self.links = BackupLinks(Paths.BACKUP_LINKS_PATH)
+        self.transfer = ResumableTransfer(transfer_retries) if transfer_retries > 0 else None
+        self.history = TaskHistory(Paths.TASK_HISTORY_PATH, TASK_HISTORY_SIZE)
+        # models of each controller, and charm of each backed up application of each
+        # model, as listed when planning the tasks
+        self._models = {}
+        self._app_charms = {}
+
+    def run(self, omit_models=None, resume=False):
+        """Perform the backups and return the merged results document.
+
+        Args:
+            omit_models: names of the models not to back up
+            resume: skip the tasks the last run completed within the checkpoint window,
+                this is implied if the last run did not finish
+        """
+        deadline = time.monotonic() + self.deadline if self.deadline > 0 else None
+        tasks, errors = self.plan(omit_models=omit_models)
+        completed = self._resume_checkpoint(resume)
+        pending = [task for task in tasks if task.name not in completed]
+        if completed:
+            logging.info("resuming, skipping %d completed tasks", len(tasks) - len(pending))
+
+        durations = {task.name: self.history.expected_duration(task.name) for task in pending}
+        try:
+            with self._downloads():
+                results = self.scheduler.run(
+                    self._longest_first(pending),
+                    self._run_task,
+                    deadline=deadline,
+                    durations=durations,
+                )
+        finally:
+            self.history.save()
+        for task in pending:
+            if isinstance(results[task.name], TaskSkipped):
+                results[task.name] = self._skipped(task, results[task.name])
+        if self.checkpoint is not None:
+            self.checkpoint.finish()
+            self.checkpoint.save()
+
+        # any "errors" entry, even empty, marks the backups as failed
+        planning_results = [json.dumps({"errors": errors})] if errors else []
+        completed_results = [
+            json.dumps(completed[task.name]) for task in tasks if task.name in completed
+        ]
+        return merge_backup_results([*planning_results, *completed_results, *results.values()])
+
+    def estimate(self, omit_models=None):
+        """Plan the backups without running them, and estimate their duration and size.
+
+        Returns:
+            estimate: dict with the planned "tasks" in the order they would start, each
+                with its expected duration and size from the history, the "eta" of the
+                run in seconds, the "expected_bytes" and the planning "errors". Tasks
+                without history count as instantaneous and empty.
+        """
+        tasks, errors = self.plan(omit_models=omit_models, push_ssh_keys=False)
+        tasks = self._longest_first(tasks)
+        durations = {task.name: self.history.expected_duration(task.name) for task in tasks}
+        sizes = {task.name: self.history.expected_size(task.name) for task in tasks}
+        return {
+            "tasks": [
+                {
+                    "task": task.name,
+                    "expected_duration": durations[task.name],
+                    "expected_bytes": sizes[task.name],
+                }
+                for task in tasks
+            ],
+            "tasks_without_history": sum(duration is None for duration in durations.values()),
+            "eta": round(self.scheduler.estimate(tasks, durations), 3),
+            "expected_bytes": sum(size for size in sizes.values() if size is not None),
+            "errors": errors,
+        }
+
+    def retry_failed(self, backup_results):
+        """Run again the tasks that failed in a results document, and merge their outcome.
+
+        The failed tasks are found from the "errors" entries: an entry tagged with a
+        task only retries that task, otherwise all tasks of the controller, model or
+        application of the entry are retried.
+
+        Returns:
+            results: the results document, with the errors replaced by the outcome of the
+                retried tasks
+        """
+        results = json.loads(backup_results)
+        errors = results.pop("errors", [])
+        controller_names = sorted(
+            {error["controller"] for error in errors if error.get("controller") is not None}
+        )
+        tasks, planning_errors = self.plan(controller_names=controller_names)
+        failed = [task for task in tasks if any(self._failed(task, error) for error in errors)]
+        logging.info("retrying failed backup tasks: %s", [task.name for task in failed])
+        # the retried tasks are no longer skipped, whatever their outcome
+        retried = {task.name for task in failed}
+        skipped_tasks = [name for name in results.pop("skipped_tasks", []) if name not in retried]
+        if skipped_tasks:
+            results["skipped_tasks"] = skipped_tasks
+
+        try:
+            with self._downloads():
+                retry_results = self.scheduler.run(self._longest_first(failed), self._run_task)
+        finally:
+            self.history.save()
+
+        # any "errors" entry, even empty, marks the backups as failed
+        planning_results = [json.dumps({"errors": planning_errors})] if planning_errors else []
+        return merge_backup_results(
+            [json.dumps(results), *planning_results, *retry_results.values()]
+        )
+
+    def _downloads(self):
+        """Return the context the tasks download their files in, see ResumableTransfer."""
+        if self.transfer is None:
+            return contextlib.nullcontext()
+        return self.transfer.installed()
+
+    def _failed(self, task, error):
+        """Return True if the error entry of a results document belongs to the task."""
+        if "task" in error:
+            return error["task"] == task.name
+        if error.get("controller") != task.controller:
+            return False
+        if error.get("model") is None:
+            return True
+        if error["model"] != task.model:
+            return False
+        charm = self._app_charms.get((task.controller, task.model), {}).get(error.get("app"))
+        return charm is None or task.charm is None or charm == task.charm
+
+    def plan(self, omit_models=None, controller_names=None, push_ssh_keys=True):
+        """Return the backup tasks, and the errors of the controllers that failed planning.
+
+        Args:
+            omit_models: names of the models not to back up
+            controller_names: only plan these controllers instead of all configured ones
+            push_ssh_keys: push the ssh key to the models of the controllers, unless the
+                key is pushed lazily
+        """
+        omit_models = set(omit_models or [])
+        if controller_names is None:
+            controller_names = BackupProcessor(Config(args=self.config_data)).controller_names
+        jobs = {
+            controller_name: functools.partial(
+                self._plan_controller, controller_name, omit_models, push_ssh_keys
+            )
+            for controller_name in controller_names
+        }
+
+        tasks, errors = [], []
+        if self.config_data["backup_juju_client_config"] and self._owns(BackupTask()):
+            tasks.append(BackupTask())
+        for controller_name, (controller_tasks, error) in run_in_workers(jobs).items():
+            tasks.extend(controller_tasks)
+            if error is not None:
+                errors.append({"controller": controller_name, "error_reason": error})
+
+        if self.shard is not None:
+            logging.info("%d backup tasks assigned to unit %s", len(tasks), self.shard.unit)
+        return tasks, errors
+
+    def _owns(self, task):
+        """Return True if the task is in the shard of this unit, or there is no sharding."""
+        return self.shard is None or self.shard.owns(task)
+
+    def _plan_controller(self, controller_name, omit_models, push_ssh_keys=True):
+        """Ensure the ssh key is in all models, and return the tasks of a controller.
+
+        Only the models in the shard of this unit get the key and have their charms listed.
+
+        Returns:
+            (tasks, error): the tasks of the controller, and the error message if the
+                controller could not be planned
+        """
+        if push_ssh_keys and not self.lazy_ssh_key_push:
+            self.ssh_helper.push_ssh_keys_to_controller(controller_name, shard=self.shard)
+
+        try:
+            with connect_controller(controller_name) as controller:
+                model_names = run_async(controller.list_models())
+                self._models[controller_name] = model_names
+                model_charms = run_async(
+                    self._list_models_backup_charms(
+                        controller,
+                        controller_name,
+                        [
+                            name
+                            for name in model_names
+                            if name not in omit_models
+                            and self._owns(BackupTask(controller_name, name))
+                        ],
+                    )
+                )
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logging.error(traceback.format_exc())
+            return [], str(error)
+
+        tasks = []
+        if self.config_data["backup_controller"] and self._owns(BackupTask(controller_name)):
+            tasks.append(BackupTask(controller_name))
+        for model_name, charms in model_charms.items():
+            if charms is None:
+                # the charms could not be listed, let juju-backup-all handle the model
+                tasks.append(BackupTask(controller_name, model_name))
+                continue
+            tasks.extend(BackupTask(controller_name, model_name, charm) for charm in charms)
+        return tasks, None
+
+    async def _list_models_backup_charms(self, controller, controller_name, model_names):
+        """Return the backed up charms deployed in each model, None if they can't be listed."""
+        semaphore = asyncio.Semaphore(MODEL_DISCOVERY_CONCURRENCY)
+        excluded_charms = set(self.config_data["excluded_charms"])
+
+        async def list_charms(model_name):
+            async with semaphore:
+                model = await get_pooled_model(controller, model_name)
+                try:
+                    app_charms = {
+                        app_name: app.charm_name
+                        for app_name, app in model.applications.items()
+                        if app.charm_name in BACKUP_CHARMS
+                        and app.charm_name not in excluded_charms
+                    }
+                finally:
+                    await release_pooled_model(model)
+            self._app_charms[(controller_name, model_name)] = app_charms
+            return sorted(set(app_charms.values()))
+
+        results = await asyncio.gather(
+            *(list_charms(model_name) for model_name in model_names), return_exceptions=True
+        )
+
+        model_charms = {}
+        for model_name, result in zip(model_names, results):
+            if isinstance(result, Exception):
+                logging.warning("failed to list the charms of model '%s': %s", model_name, result)
+                result = None
+            model_charms[model_name] = result
+        return model_charms
+
+    def _resume_checkpoint(self, resume):
+        """Start or resume the checkpoint, and return the results of the completed tasks."""
+        if self.checkpoint is None:
+            return {}
+        if resume or self.checkpoint.unfinished:
+            completed = self.checkpoint.resume()
+        else:
+            self.checkpoint.start()
+            completed = {}
+        self.checkpoint.save()
+        return completed
+
+    def _longest_first(self, tasks):
+        """Sort the tasks by decreasing priority, then expected duration, never run first."""
+
+        def sort_key(task):
+            expected_duration = self.history.expected_duration(task.name)
+            return (
+                self._priority(task),
+                float("inf") if expected_duration is None else expected_duration,
+            )
+
+        return sorted(tasks, key=sort_key, reverse=True)
+
+    def _priority(self, task):
+        """Return the priority of a task, from that of its charm or kind of backup."""
+        if task.controller is None:
+            return self.priorities.get(CLIENT_CONFIG_WORKER, 0)
+        if task.model is None:
+            return self.priorities.get("controller", 0)
+        return self.priorities.get(task.charm, 0)
+
+    @staticmethod
+    def _skipped(task, skip):
+        """Return the results document of a task skipped for the deadline of the run.
+
+        The task is reported as failed, so that it is alerted on and can be retried.
+        """
+        error_entry = {"task": task.name, "error_reason": f"skipped: {skip}"}
+        if task.controller is not None:
+            error_entry["controller"] = task.controller
+        if task.model is not None:
+            error_entry["model"] = task.model
+        return json.dumps({"skipped_tasks": [task.name], "errors": [error_entry]})
+
+    def _run_task(self, task):
+        """Run a backup task, record its duration if it succeeded, and return its results."""
+        logging.info("running backup task: %s", task.name)
+        start = time.monotonic()
+        try:
+            fingerprint = self._fingerprint(task)
+            backup_results = self._unchanged_backup(task, fingerprint)
+            if backup_results is not None:
+                return backup_results
+
+            backup_results = self._backup(task)
+            if task.model is not None and "errors" in json.loads(backup_results):
+                backup_results = self._retry_missing_ssh_key(task, backup_results)
+            results = json.loads(backup_results)
+            if self.compressor is not None:
+                results = self.compressor.compress_results(results)
+            if self.checksums or self.store is not None:
+                # the files downloaded by the resumable transfers are already hashed
+                known = self.transfer.checksums if self.transfer is not None else None
+                results = add_checksums(results, known=known)
+            if self.store is not None:
+                results = self.store.add_results(results)
+                self._record_links(results)
+            backup_results = json.dumps(results)
+            if "errors" not in results:
+                self.history.record(
+                    task.name, time.monotonic() - start, size=backup_results_size(results)
+                )
+                if self.checkpoint is not None:
+                    self.checkpoint.record(task.name, results)
+                    self.checkpoint.save()
+                if fingerprint is not None:
+                    self.fingerprints.record(task.name, fingerprint, results)
+                    self.fingerprints.save()
+                return backup_results
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logging.error(traceback.format_exc())
+            error_entry = {"error_reason": str(error)}
+            if task.controller is not None:
+                error_entry["controller"] = task.controller
+            if task.model is not None:
+                error_entry["model"] = task.model
+            results = {"errors": [error_entry]}
+        finally:
+            # the worker keeps its controller connections for its next tasks, e.g. to
+            # repair the ssh key, but not the model connections
+            pool = ConnectionPool.current()
+            if pool is not None:
+                pool.release_models()
+
+        # tag the errors with their task, so that the task can be retried on its own
+        for error_entry in results["errors"]:
+            error_entry["task"] = task.name
+        return json.dumps(results, indent=2)
+
+    def _fingerprint(self, task):
+        """Return the fingerprint of the inputs of a task, None if it is always backed up.
+
+        Only the juju client config can be fingerprinted before it is backed up, the
+        controllers have no cheap and reliable fingerprint of their database.
+        """
+        if not self.skip_unchanged or task.controller is not None:
+            return None
+        return tree_sha256(Paths.JUJUDATA_DIR, CLIENT_CONFIG_FILES)
+
+    def _unchanged_backup(self, task, fingerprint):
+        """Link the files of the last backup of a task if its inputs did not change.
+
+        Each file gets a new link, whose time is recorded so that the backup is not
+        purged with the previous one (see `state.BackupLinks`).
+
+        Returns:
+            backup_results: the results document of the links, with their entries marked
+                "unchanged", None if the task has to be backed up
+        """
+        if fingerprint is None:
+            return None
+        previous = self.fingerprints.previous_results(task.name, fingerprint)
+        if previous is None:
+            return None
+        entries = [
+            backup_entry
+            for backup_type, backup_entries in previous.items()
+            if backup_type.endswith("_backups")
+            for backup_entry in backup_entries
+        ]
+        if not entries or not all(os.path.isfile(entry["download_path"]) for entry in entries):
+            return None
+
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        for backup_entry in entries:
+            path = pathlib.Path(backup_entry["download_path"])
+            # name the link after the original file, not after a previous link
+            name = re.sub(r"\.unchanged-\d{8}-\d{6}", "", path.name)
+            stem, dot, suffix = name.partition(".")
+            link = path.with_name(f"{stem}.unchanged-{timestamp}{dot}{suffix}")
+            if not link.exists():
+                os.link(path, link)
+            backup_entry["download_path"] = str(link)
+            backup_entry["unchanged"] = True
+        self._record_links(previous)
+
+        logging.info("inputs of task %s unchanged, linked its last backup", task.name)
+        if self.checkpoint is not None:
+            self.checkpoint.record(task.name, previous)
+            self.checkpoint.save()
+        self.fingerprints.record(task.name, fingerprint, previous)
+        self.fingerprints.save()
+        return json.dumps(previous)
+
+    def _record_links(self, results):
+        """Record the time of the backup files linking to the content of a previous run."""
+        for backup_type, backup_entries in results.items():
+            if not backup_type.endswith("_backups"):
+                continue
+            for backup_entry in backup_entries:
+                if backup_entry.get("unchanged") or backup_entry.get("deduplicated"):
+                    self.links.record(backup_entry["download_path"])
+        self.links.save()
+
+    def _retry_missing_ssh_key(self, task, backup_results):
+        """Push the ssh key to the model of a failed task if it is missing, and retry.
+
+        libjuju does not tell why a file could not be copied from a unit (the error
+        only reads "command failed after 10 attempts: [...]"), so the key is checked in
+        the model itself. The task is retried once, and the outcome of the retry
+        replaces its results.
+        """
+        if not self.ssh_helper.repair_ssh_key(task.controller, task.model):
+            return backup_results
+
+        logging.info("ssh key was missing, retrying backup task: %s", task.name)
+        return self._backup(task)
+
+    def _task_timeout(self, task):
+        """Return the timeout of a task, adapted to its duration history if enabled."""
+        timeout = self.config_data["timeout"]
+        if self.adaptive_timeout is not None:
+            timeout = self.adaptive_timeout.timeout(self.history.durations(task.name), timeout)
+            logging.debug("timeout of backup task %s: %ss", task.name, timeout)
+        return timeout
+
+    def _backup(self, task):
+        """Back up the scope of a task with juju-backup-all."""
+        timeout = self._task_timeout(task)
+        if task.controller is None:
+            config = self._config(
+                all_controllers=False, controllers=[], backup_controller=False, timeout=timeout
+            )
+            return BackupProcessor(config).process_backups()
+
+        overrides = {
+            "timeout": timeout,
+            "all_controllers": False,
+            "controllers": [task.controller],
+            "backup_controller": task.model is None,
+            "backup_juju_client_config": False,
+        }
+        if task.charm is not None:
+            overrides["excluded_charms"] = [
+                charm for charm in BACKUP_CHARMS if charm != task.charm
+            ]
+        omit_models = [name for name in self._models[task.controller] if name != task.model]
+        return BackupProcessor(self._config(**overrides)).process_backups(omit_models=omit_models)
+
+    def _config(self, **overrides):
+        """Return a juju-backup-all Config with some options overridden."""
+        return Config(args=dict(self.config_data, **overrides))
+
+
+class SSHKeyHelper:
     """Deal with SSH key operations."""
 
-    def __init__(self, config, accounts):
-        """Initialise the helper."""
+    def __init__(
+        self,
+        config,
+        accounts,
+        concurrency=DEFAULT_SSH_KEY_PUSH_CONCURRENCY,
+        cache_ttl=0,
+        full_sweep_runs=1,
+        progress=None,
+    ):  # pylint: disable=too-many-arguments
+        """Initialise the helper.
+
+        Args:
+            config: juju-backup-all Config
+            accounts: the controllers section of the juju accounts.yaml
+            concurrency: maximum number of models of a controller processed concurrently
+            cache_ttl: hours during which a model where the key was confirmed is skipped,
+                0 disables the key cache
+            full_sweep_runs: number of runs between two sweeps of all models, in between
+                only the new models or those whose uuid changed are processed
+            progress: callable receiving a message each time a controller or model is done
+        """
         self.config = config
         self.accounts = accounts
+        self.concurrency = max(1, concurrency)
+        self.key_cache = (
+            SSHKeyCache(Paths.SSH_KEY_CACHE_PATH, ttl=cache_ttl * 3600) if cache_ttl > 0 else None
+        )
+        self.model_inventory = (
+            ModelInventory(Paths.MODEL_INVENTORY_PATH, full_sweep_runs)
+            if full_sweep_runs > 1
+            else None
+        )
+        self.progress = progress
+        # per controller and model timings and outcome of the key push, see `report`
+        self._report = {}
+
+    @property
+    def report(self):
+        """Return the report of the key pushes done by the helper.
+
+        The report looks like the following (times are in seconds):
+
+        {
+            "<controller name>": {
+                "connect_time": 0.52,
+                "error": "<only present if the controller failed>",
+                "models": {
+                    "<model name>": {
+                        "key_check": "<cache|model>",
+                        "connect_time": 0.31,
+                        "key_check_time": 0.05,
+                        "key_added": false,
+                        "error": "<only present if the model failed>"
+                    }
+                }
+            }
+        }
+        """
+        return self._report
+
+    def push_ssh_keys_to_models(self, public_key_path=None, full_sweep=False):
+        """Add jujubackup ssh keys to all relevant models.
+
+        Each controller is handled by its own worker, and the models of each controller
+        are processed concurrently on the worker's event loop, with at most `concurrency`
+        models being handled at any given time.
+
+        Args:
+            public_key_path: path of the public key to push, defaults to the backup key
+            full_sweep: push the key to all models, regardless of the model inventory
+
+        Returns:
+            failures: mapping of "controller" or "controller/model" to the error message
+        """
+        return self._run_per_controller(
+            self.push_ssh_keys_to_controller,
+            public_key_path=public_key_path,
+            full_sweep=full_sweep,
+        )
+
+    def push_ssh_keys_to_controller(
+        self,
+        controller_name,
+        model_names=None,
+        public_key_path=None,
+        full_sweep=False,
+        shard=None,
+    ):
+        """Add jujubackup ssh keys to all models of a controller.
+
+        Args:
+            controller_name: name of the controller
+            model_names: only push the key to these models, regardless of the model
+                inventory, instead of all models of the controller
+            public_key_path: path of the public key to push, defaults to the backup key
+            full_sweep: push the key to all models, regardless of the model inventory
+            shard: only push the key to the models in this shard, None for all models
+
+        Returns:
+            failures: mapping of "controller" or "controller/model" to the error message
+        """
+        public_key_path = public_key_path or Paths.SSH_PUBLIC_KEY
+        pubkey = public_key_path.read_text().strip()
+        fingerprint = self._gen_libjuju_ssh_key_fingerprint(pubkey)
+        controller_report = self._report.setdefault(controller_name, {"models": {}})
+        try:
+            start = time.monotonic()
+            with connect_controller(controller_name) as controller:
+                controller_report["connect_time"] = _elapsed(start)
+                self._log_progress(
+                    f"{controller_name}: connected in {controller_report['connect_time']}s"
+                )
+                models = run_async(controller.model_uuids())
+                if model_names is not None:
+                    models = {name: uuid for name, uuid in models.items() if name in model_names}
+                elif self.model_inventory is not None and not full_sweep:
+                    models = self.model_inventory.select(controller_name, models)
+                if shard is not None:
+                    models = {
+                        name: uuid
+                        for name, uuid in models.items()
+                        if shard.owns(BackupTask(controller_name, name))
+                    }
+                return run_async(
+                    self._push_ssh_keys_to_controller_models(
+                        controller, controller_name, models, pubkey, fingerprint
+                    )
+                )
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logging.error(traceback.format_exc())
+            controller_report["error"] = str(error)
+            self._log_progress(f"{controller_name}: failed: {error}")
+            return {controller_name: str(error)}
+        finally:
+            for state in (self.key_cache, self.model_inventory):
+                if state is not None:
+                    state.save()
+
+    def remove_ssh_keys_from_models(self, raw_pubkey):
+        """Remove a public ssh key from all relevant models, in parallel.
+
+        Returns:
+            failures: mapping of "controller" or "controller/model" to the error message
+        """
+        fingerprint = self._gen_libjuju_ssh_key_fingerprint(raw_pubkey)
+
+        async def remove(model, username, model_report):
+            present = fingerprint in await self._get_model_ssh_key_fingeprints(model)
+            if present:
+                await model.remove_ssh_key(username, raw_pubkey)
+            model_report["key_removed"] = present
+            return f"old key {'removed' if present else 'absent'}"
+
+        return self._run_per_controller(self._sweep_controller_models, remove)
+
+    def gc_stale_ssh_keys(self, dry_run=False):
+        """Remove the stale backup ssh keys from all relevant models, in parallel.
+
+        The keys of the backup user are recognised by their "jujubackup@<host>" comment,
+        those that are neither the current backup key of a unit of the application nor a
+        key being rolled out by a key rotation are stale.
+
+        Args:
+            dry_run: only report the stale keys, without removing them
+
+        Returns:
+            failures: mapping of "controller" or "controller/model" to the error message
+        """
+        keep = {
+            self._gen_libjuju_ssh_key_fingerprint(path.read_text().strip())
+            for path in (Paths.SSH_PUBLIC_KEY, Paths.SSH_NEW_PUBLIC_KEY)
+            if path.exists()
+        }
+        # the other units of the application have keys of their own
+        shard = Shard.load(Paths.SHARD_PATH)
+        if shard is not None:
+            keep.update(
+                self._gen_libjuju_ssh_key_fingerprint(pubkey) for pubkey in shard.ssh_public_keys
+            )
+
+        async def collect(model, username, model_report):
+            stale = [
+                fingerprint
+                for fingerprint in await self._get_model_ssh_key_fingeprints(model)
+                if fingerprint not in keep and _is_backup_key_fingerprint(fingerprint)
+            ]
+            model_report["stale_keys"] = stale
+            if stale and not dry_run:
+                key_facade = client.KeyManagerFacade.from_connection(model.connection())
+                # the keys are deleted by fingerprint, without the comment
+                await key_facade.DeleteKeys(
+                    ssh_keys=[fingerprint.split()[0] for fingerprint in stale], user=username
+                )
+            action = "found" if dry_run else "removed"
+            return f"{len(stale)} stale keys {action}"
+
+        return self._run_per_controller(self._sweep_controller_models, collect)
+
+    def rotate_ssh_key(self, key_type):
+        """Replace the backup ssh key by a new key of type `key_type` in every model.
+
+        See `JujuBackupAllHelper.rotate_ssh_key` for the rollout steps.
+
+        Returns:
+            rotation: dict with whether the key was "switched" and the old key "removed"
+        """
+        rotation = {"switched": False, "removed": False}
+        current_type = ssh_key_type(Paths.SSH_PUBLIC_KEY.read_text())
+        if current_type != key_type:
+            new_private_key, new_public_key = Paths.SSH_NEW_PRIVATE_KEY, Paths.SSH_NEW_PUBLIC_KEY
+            if not new_public_key.exists() or ssh_key_type(new_public_key.read_text()) != key_type:
+                new_private_key.unlink(missing_ok=True)
+                new_public_key.unlink(missing_ok=True)
+                generate_ssh_key(new_private_key, key_type)
+
+            self._log_progress(f"pushing the new {key_type} key to all models")
+            failures = self.push_ssh_keys_to_models(
+                public_key_path=new_public_key, full_sweep=True
+            )
+            if failures:
+                self._log_progress("the new key could not be pushed to all models, aborting")
+                return rotation
 
-    def push_ssh_keys_to_models(self):
-        """Add jujubackup ssh keys to all relevant models."""
-        pubkey = Paths.SSH_PUBLIC_KEY.read_text().strip()
+            self._log_progress("switching the backups over to the new key")
+            os.replace(Paths.SSH_PRIVATE_KEY, Paths.SSH_OLD_PRIVATE_KEY)
+            os.replace(Paths.SSH_PUBLIC_KEY, Paths.SSH_OLD_PUBLIC_KEY)
+            os.replace(new_private_key, Paths.SSH_PRIVATE_KEY)
+            os.replace(new_public_key, Paths.SSH_PUBLIC_KEY)
+        rotation["switched"] = True
 
+        if Paths.SSH_OLD_PUBLIC_KEY.exists():
+            self._log_progress("removing the old key from all models")
+            old_pubkey = Paths.SSH_OLD_PUBLIC_KEY.read_text().strip()
+            if self.remove_ssh_keys_from_models(old_pubkey):
+                self._log_progress("the old key could not be removed from all models")
+                return rotation
+            Paths.SSH_OLD_PRIVATE_KEY.unlink(missing_ok=True)
+            Paths.SSH_OLD_PUBLIC_KEY.unlink()
+        rotation["removed"] = True
+
+        return rotation
+
+    def repair_ssh_key(self, controller_name, model_name):
+        """Check the ssh key is in a model where a backup failed, and push it if missing.
+
+        The cached key presence and inventory entry of the model are invalidated first,
+        so that the next run checks the model again if it can't be checked now.
+
+        Returns:
+            added: True if the key was missing from the model and has been pushed
+        """
+        for state in (self.key_cache, self.model_inventory):
+            if state is not None:
+                state.invalidate(controller_name, model_name)
+        self._report.get(controller_name, {}).get("models", {}).pop(model_name, None)
+
+        failures = self.push_ssh_keys_to_controller(controller_name, model_names=[model_name])
+        if failures:
+            logging.warning("cannot check the ssh key of model '%s': %s", model_name, failures)
+            return False
+        added = self._report[controller_name]["models"].get(model_name, {}).get("key_added", False)
+        if added:
+            logging.warning("ssh key was missing from model '%s', pushed it", model_name)
+        return added
+
+    async def _push_ssh_keys_to_controller_models(
+        self, controller, controller_name, models, pubkey, fingerprint
+    ):  # pylint: disable=too-many-arguments
+        """Push the ssh key to the models (a mapping of name to uuid) of a controller."""
+        # the semaphore needs to be created inside the running loop (python < 3.10)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        username = self.accounts[controller_name]["user"]
+
+        fresh_models = set()
+        if self.key_cache is not None:
+            fresh_models = {
+                model_name
+                for model_name, model_uuid in models.items()
+                if self.key_cache.is_fresh(model_uuid, fingerprint)
+            }
+        controller_report = self._report[controller_name]
+
+        async def push(model_name):
+            model_uuid = models[model_name]
+            model_report = controller_report["models"].setdefault(
+                model_name, {"key_check": "model", "key_added": False}
+            )
+            if model_name in fresh_models:
+                logging.debug("key recently confirmed in model '%s', skipping", model_name)
+                model_report["key_check"] = "cache"
+            else:
+                async with semaphore:
+                    await self._push_ssh_key_to_model(
+                        controller, model_name, username, pubkey, fingerprint, model_report
+                    )
+
+            if self.key_cache is not None and model_name not in fresh_models:
+                self.key_cache.confirm(model_uuid, fingerprint, controller_name, model_name)
+            if self.model_inventory is not None:
+                self.model_inventory.record(controller_name, model_name, model_uuid)
+            self._log_progress(
+                f"{controller_name}/{model_name}: "
+                f"key {'added' if model_report['key_added'] else 'present'}"
+                f" (checked by {model_report['key_check']})"
+            )
+
+        model_names = sorted(models)
+
+        results = await asyncio.gather(
+            *(push(model_name) for model_name in model_names), return_exceptions=True
+        )
+
+        failures = {}
+        for model_name, result in zip(model_names, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    "failed to push ssh key to model '%s': %s",
+                    model_name,
+                    "".join(
+                        traceback.format_exception(type(result), result, result.__traceback__)
+                    ),
+                )
+                failures[f"{controller_name}/{model_name}"] = str(result)
+                controller_report["models"].setdefault(model_name, {})["error"] = str(result)
+                self._log_progress(f"{controller_name}/{model_name}: failed: {result}")
+        return failures
+
+    async def _push_ssh_key_to_model(
+        self, controller, model_name, username, pubkey, fingerprint, model_report=None
+    ):  # pylint: disable=too-many-arguments
+        """Add the ssh key to a single model if not present already.
+
+        When a connection pool is current, the model connection is pooled so that it
+        can be reused to list the charms of the model. Timings and outcome are added to
+        `model_report`.
+        """
+        model_report = {} if model_report is None else model_report
+        start = time.monotonic()
+        model = await get_pooled_model(controller, model_name)
+        model_report["connect_time"] = _elapsed(start)
+
+        try:
+            logging.debug("processing model: %s", model_name)
+            # check if the fingerprint is present, if not add it
+            start = time.monotonic()
+            known_fingerprints = await self._get_model_ssh_key_fingeprints(model)
+            model_report["key_check_time"] = _elapsed(start)
+            if fingerprint not in known_fingerprints:
+                logging.debug("ssh key missing for user '%s', adding it", username)
+                await model.add_ssh_keys(username, pubkey)
+                model_report["key_added"] = True
+            else:
+                logging.debug("key for user '%s' already present, skipping", username)
+        finally:
+            await release_pooled_model(model)
+
+    def _sweep_controller_models(self, controller_name, process):
+        """Run `process(model, username, model_report)` on all models of a controller.
+
+        The models are processed concurrently, at most `concurrency` at a time, and the
+        message returned by `process` is logged as progress.
+
+        Returns:
+            failures: mapping of "controller" or "controller/model" to the error message
+        """
+        controller_report = self._report.setdefault(controller_name, {"models": {}})
+        try:
+            with connect_controller(controller_name) as controller:
+                model_names = run_async(controller.list_models())
+                return run_async(
+                    self._sweep_models(controller, controller_name, model_names, process)
+                )
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logging.error(traceback.format_exc())
+            controller_report["error"] = str(error)
+            self._log_progress(f"{controller_name}: failed: {error}")
+            return {controller_name: str(error)}
+
+    async def _sweep_models(self, controller, controller_name, model_names, process):
+        """Run `process` on the models of a controller concurrently."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        username = self.accounts[controller_name]["user"]
+        models_report = self._report[controller_name]["models"]
+
+        async def sweep(model_name):
+            model_report = models_report.setdefault(model_name, {})
+            async with semaphore:
+                model = await get_pooled_model(controller, model_name)
+                try:
+                    message = await process(model, username, model_report)
+                finally:
+                    await release_pooled_model(model)
+            self._log_progress(f"{controller_name}/{model_name}: {message}")
+
+        results = await asyncio.gather(
+            *(sweep(model_name) for model_name in model_names), return_exceptions=True
+        )
+
+        failures = {}
+        for model_name, result in zip(model_names, results):
+            if isinstance(result, Exception):
+                logging.error("failed to process model '%s': %s", model_name, result)
+                failures[f"{controller_name}/{model_name}"] = str(result)
+                models_report.setdefault(model_name, {})["error"] = str(result)
+                self._log_progress(f"{controller_name}/{model_name}: failed: {result}")
+        return failures
+
+    def _run_per_controller(self, func, *args, **kwargs):
+        """Run `func(controller_name, *args, **kwargs)` for each controller in parallel.
+
+        Returns:
+            failures: the merged failures returned by `func` for each controller
+        """
         backup_processor = BackupProcessor(self.config)
 
-        fingerprint = self._gen_libjuju_ssh_key_fingerprint()
-        # go over each controller we are configured to touch, and push the
-        # jujubackup key to each model if not present already
-        for controller_name in backup_processor.controller_names:
-            try:
-                with connect_controller(controller_name) as controller:
-                    logging.debug("processing controller: %s", controller_name)
-                    model_names = run_async(controller.list_models())
-                    for model_name in model_names:
-                        try:
-                            logging.debug("connecting to model: '%s'", model_name)
-                            with connect_model(controller, model_name) as model:
-                                logging.debug("processing model: %s", model_name)
-                                # check if the fingerprint is present, if not add it
-                                username = self.accounts[controller_name]["user"]
-                                if fingerprint not in self._get_model_ssh_key_fingeprints(model):
-                                    logging.debug(
-                                        "ssh key missing for user '%s', adding it", username
-                                    )
-                                    run_async(model.add_ssh_keys(username, pubkey))
-                                else:
-                                    logging.debug(
-                                        "key for user '%s' already present, skipping", username
-                                    )
-                        except Exception:  # pylint: disable=broad-exception-caught
-                            logging.error(traceback.format_exc())
-            except Exception:  # pylint: disable=broad-exception-caught
-                logging.error(traceback.format_exc())
+        # go over each controller we are configured to touch
+        jobs = {
+            controller_name: functools.partial(func, controller_name, *args, **kwargs)
+            for controller_name in backup_processor.controller_names
+        }
+        failures = {}
+        for controller_failures in run_in_workers(jobs).values():
+            failures.update(controller_failures)
+        return failures
+
+    def _log_progress(self, message):
+        """Log the progress of the key push, and report it to the progress callback."""
+        logging.info(message)
+        if self.progress is not None:
+            self.progress(message)
 
     def _gen_libjuju_ssh_key_fingerprint(self, raw_pubkey=None):
         """Generate a pubkey fingerprint in the same format as libjuju Model.get_ssh_keys.  # noqa
@@ -310,9 +1844,9 @@ class SSHKeyHelper:  # pylint: disable=too-few-public-methods
         key_fp = ":".join(a + b for a, b in zip(key_fp_plain[::2], key_fp_plain[1::2]))
         return f"{key_fp} ({key_comment})"
 
-    def _get_model_ssh_key_fingeprints(self, model):
+    async def _get_model_ssh_key_fingeprints(self, model):
         """Extract libjuju ssh keys from a model."""
-        libjuju_keyinfo = run_async(model.get_ssh_keys())
+        libjuju_keyinfo = await model.get_ssh_keys()
         logging.debug("get_ssh_keys received: '%s'", libjuju_keyinfo)
         fingerprints = libjuju_keyinfo.get("results")[0]["result"]
         # handle the case where there are no keys
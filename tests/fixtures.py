@@ -29,6 +29,7 @@ controllers:
 """
 
 MOCK_CONFIG = {
+    "accounts": ACCOUNTS_YAML,
     "controller-names": "",
     "exclude-controller-backup": False,
     "exclude-juju-client-config-backup": False,
@@ -36,11 +37,33 @@ MOCK_CONFIG = {
     "backup-dir": "/opt/backups",
     "timeout": 60,
     "crontab": "10 20 * *",
+    "controller-crontabs": "",
+    "crontab-jitter": 0,
     "backup-retention-period": 7,
     "exclude-models": "",
     "backup-location-on-postgresql": "/home/ubuntu",
     "backup-location-on-mysql": "/var/backups/mysql",
     "backup-location-on-etcd": "/home/ubuntu/etcd-snapshots",
+    "ssh-key-push-concurrency": 10,
+    "ssh-key-cache-ttl": 0,
+    "ssh-key-full-sweep-runs": 1,
+    "lazy-ssh-key-push": False,
+    "backup-concurrency": 8,
+    "backup-concurrency-per-controller": 4,
+    "backup-concurrency-per-model": 1,
+    "resume-window": 12,
+    "run-deadline": 0,
+    "backup-priorities": "",
+    "backup-checksums": False,
+    "dedup-store": False,
+    "skip-unchanged": False,
+    "transfer-retries": 0,
+    "compression": "",
+    "compression-level": 6,
+    "adaptive-timeout": False,
+    "adaptive-timeout-factor": 2.0,
+    "adaptive-timeout-floor": 60,
+    "adaptive-timeout-ceiling": 7200,
 }
 
 SSH_FINGERPRINT = (
@@ -48,6 +71,11 @@ SSH_FINGERPRINT = (
 )
 RAW_PUBKEY = "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDWyOIKxjS6ev/Fn94ULqWFtEjXc9xk0SLR7CNXZI/21dBC2vkqD2rekR6DTeGplIuhpoCTjlW13r2V2LVbR56Ne4+n4BfSU8J+3EgOAck0t5T21anMN8Z6Bj5G1gSfWpvq1Yo1y2vkqbUEA3NECEaPI69hH/afEEBFiKy5z6jmybqdqT7Kmt15GzTiVyPtnZQsAhiSW+fX/mFSp3K3cDMgWN5h5hwmQEmldiDmd5G28rTmSeO1ycvjDPhemNGxFFREm7bkXA7BlxUsBgkOVCHrw88BfZ3oFgIY4arCFmH2HLwhQbBPGpA+0JFuQFQPEVgR+y+K8+NQcuGwdoFN41q1 jujubackup@juju-deb4b2-tmp-7"  # noqa E501
 
+SSH_ED25519_FINGERPRINT = (
+    "2a:e3:c7:e1:85:62:ec:67:c3:de:6c:23:87:2a:ba:8f (jujubackup@juju-deb4b2-tmp-7)"  # noqa E501
+)
+RAW_ED25519_PUBKEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIEvU+jVe8yp9K27Zc+nPhvRSxSdIJRzsSJuM7oZ1Oiig jujubackup@juju-deb4b2-tmp-7"  # noqa E501
+
 
 class AsyncMock(Mock):
     """Helper to mock async calls."""
@@ -61,7 +89,8 @@ class AsyncMock(Mock):
 class MockController:
     """Mock controller for testing."""
 
-    list_models = AsyncMock(return_value=["test-model"])
+    model_uuids = AsyncMock(return_value={"test-model": "7e1b5ff7-e35b-4c9f-8bd5-1f1c4e3ee4d6"})
+    get_model = AsyncMock()
 
 
 class MockModel:
@@ -69,3 +98,7 @@ class MockModel:
 
     get_ssh_keys = AsyncMock(return_value={"results": [{"result": SSH_FINGERPRINT}]})
     add_ssh_keys = AsyncMock(return_value=None)
+    disconnect = AsyncMock(return_value=None)
+
+
+MockController.get_model.return_value = MockModel
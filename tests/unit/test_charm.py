@@ -1,6 +1,7 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import json
 import pathlib
 import tempfile
 import unittest
@@ -170,12 +171,9 @@ class TestCharm(unittest.TestCase):
             "Unit is ready",
         )
 
-    @mock.patch("utils.SSHKeyHelper.push_ssh_keys_to_models")
-    @mock.patch("jujubackupall.process.BackupProcessor.process_backups")
+    @mock.patch("utils.BackupRunner.run")
     @mock.patch("charmhelpers.core.host.chownr")
-    def test_20_do_backup_action_all_models(
-        self, mock_chownr, mock_process_backups, mock_push_ssh_keys
-    ):
+    def test_20_do_backup_action_all_models(self, mock_chownr, mock_run):
         """Test the do_backup action."""
         self.harness.update_config(
             {
@@ -187,21 +185,17 @@ class TestCharm(unittest.TestCase):
         action_event = mock.Mock(params={})
         action_event.params = {}
         mock_results = '{"mock_results": true}'
-        mock_process_backups.return_value = mock_results
+        mock_run.return_value = mock_results
 
         self.harness.begin()
         self.harness.charm._on_do_backup_action(action_event)
 
-        mock_process_backups.assert_called_once_with(omit_models=[])
-        mock_push_ssh_keys.assert_called_once()
+        mock_run.assert_called_once_with(omit_models=[])
         action_event.set_results.assert_called_once_with({"result": mock_results})
 
-    @mock.patch("utils.SSHKeyHelper.push_ssh_keys_to_models")
-    @mock.patch("jujubackupall.process.BackupProcessor.process_backups")
+    @mock.patch("utils.BackupRunner.run")
     @mock.patch("charmhelpers.core.host.chownr")
-    def test_20_do_backup_action_omit_single_model(
-        self, mock_chownr, mock_process_backups, mock_push_ssh_keys
-    ):
+    def test_20_do_backup_action_omit_single_model(self, mock_chownr, mock_run):
         """Test the do_backup action."""
         self.harness.update_config(
             {
@@ -213,21 +207,17 @@ class TestCharm(unittest.TestCase):
         action_event = mock.Mock(params={})
         action_event.params = {"omit-models": "omit-me"}
         mock_results = '{"mock_results": true}'
-        mock_process_backups.return_value = mock_results
+        mock_run.return_value = mock_results
 
         self.harness.begin()
         self.harness.charm._on_do_backup_action(action_event)
 
-        mock_process_backups.assert_called_once_with(omit_models=["omit-me"])
-        mock_push_ssh_keys.assert_called_once()
+        mock_run.assert_called_once_with(omit_models=["omit-me"])
         action_event.set_results.assert_called_once_with({"result": mock_results})
 
-    @mock.patch("utils.SSHKeyHelper.push_ssh_keys_to_models")
-    @mock.patch("jujubackupall.process.BackupProcessor.process_backups")
+    @mock.patch("utils.BackupRunner.run")
     @mock.patch("charmhelpers.core.host.chownr")
-    def test_20_do_backup_action_omit_models(
-        self, mock_chownr, mock_process_backups, mock_push_ssh_keys
-    ):
+    def test_20_do_backup_action_omit_models(self, mock_chownr, mock_run):
         """Test the do_backup action."""
         self.harness.update_config(
             {
@@ -239,18 +229,31 @@ class TestCharm(unittest.TestCase):
         action_event = mock.Mock(params={})
         action_event.params = {"omit-models": "omit-me,and-me-too"}
         mock_results = '{"mock_results": true}'
-        mock_process_backups.return_value = mock_results
+        mock_run.return_value = mock_results
 
         self.harness.begin()
         self.harness.charm._on_do_backup_action(action_event)
 
-        mock_process_backups.assert_called_once_with(omit_models=["omit-me", "and-me-too"])
-        mock_push_ssh_keys.assert_called_once()
+        mock_run.assert_called_once_with(omit_models=["omit-me", "and-me-too"])
         action_event.set_results.assert_called_once_with({"result": mock_results})
 
+    @mock.patch("utils.JujuBackupAllHelper.retry_failed")
+    def test_21_retry_failed_action(self, mock_retry_failed):
+        """Test the retry-failed action."""
+        action_event = mock.Mock(params={})
+        self.harness.begin()
+
+        mock_retry_failed.return_value = '{"mock_results": true}'
+        self.harness.charm._on_retry_failed_action(action_event)
+        action_event.set_results.assert_called_once_with({"result": '{"mock_results": true}'})
+
+        mock_retry_failed.side_effect = ValueError("The last backup run crashed")
+        self.harness.charm._on_retry_failed_action(action_event)
+        action_event.fail.assert_called_once_with("The last backup run crashed")
+
     @mock.patch("utils.SSHKeyHelper")
     def test_22_push_ssh_keys_action(self, mock_ssh_keys_helper):
-        """Test the do_backup action."""
+        """Test the push_ssh_keys action."""
         self.harness.update_config(
             {
                 "controllers": CONTROLLERS_YAML,
@@ -259,12 +262,85 @@ class TestCharm(unittest.TestCase):
         )
 
         action_event = mock.Mock(params={})
+        report = {"test-controller": {"connect_time": 0.1, "models": {}}}
+        mock_ssh_keys_helper.return_value.report = report
 
         self.harness.begin()
         self.harness.charm._on_push_ssh_keys_action(action_event)
 
+        self.assertEqual(mock_ssh_keys_helper.call_args[1]["progress"], action_event.log)
         mock_ssh_keys_helper.return_value.push_ssh_keys_to_models.assert_called_once()
-        action_event.set_results.assert_called_once_with({"result": "success"})
+        action_event.set_results.assert_called_once_with({"result": json.dumps(report, indent=2)})
+
+    @mock.patch("utils.host")
+    @mock.patch("utils.SSHKeyHelper")
+    def test_23_rotate_ssh_key_action(self, mock_ssh_keys_helper, _mock_host):
+        """Test the rotate-ssh-key action."""
+        self.harness.update_config(
+            {
+                "controllers": CONTROLLERS_YAML,
+                "accounts": ACCOUNTS_YAML,
+            }
+        )
+
+        action_event = mock.Mock(params={"key-type": "ed25519"})
+        report = {"test-controller": {"models": {"test-model": {"key_removed": True}}}}
+        mock_ssh_keys_helper.return_value.report = report
+        mock_rotate = mock_ssh_keys_helper.return_value.rotate_ssh_key
+        mock_rotate.return_value = {"switched": True, "removed": True}
+
+        self.harness.begin()
+        self.harness.charm._on_rotate_ssh_key_action(action_event)
+
+        mock_rotate.assert_called_once_with("ed25519")
+        action_event.set_results.assert_called_once_with({"result": json.dumps(report, indent=2)})
+        action_event.fail.assert_not_called()
+
+        # the action fails when the old key could not be removed from all models
+        mock_rotate.return_value = {"switched": True, "removed": False}
+        self.harness.charm._on_rotate_ssh_key_action(action_event)
+        action_event.fail.assert_called_once()
+
+    @mock.patch("utils.SSHKeyHelper")
+    def test_24_gc_ssh_keys_action(self, mock_ssh_keys_helper):
+        """Test the gc-ssh-keys action."""
+        self.harness.update_config(
+            {
+                "controllers": CONTROLLERS_YAML,
+                "accounts": ACCOUNTS_YAML,
+            }
+        )
+
+        action_event = mock.Mock(params={"dry-run": True})
+        report = {"test-controller": {"models": {"test-model": {"stale_keys": []}}}}
+        mock_ssh_keys_helper.return_value.report = report
+
+        self.harness.begin()
+        self.harness.charm._on_gc_ssh_keys_action(action_event)
+
+        mock_ssh_keys_helper.return_value.gc_stale_ssh_keys.assert_called_once_with(dry_run=True)
+        action_event.set_results.assert_called_once_with({"result": json.dumps(report, indent=2)})
+
+    @mock.patch("utils.BackupRunner.estimate")
+    def test_25_plan_backup_action(self, mock_estimate):
+        """Test the plan-backup action."""
+        self.harness.update_config(
+            {
+                "controllers": CONTROLLERS_YAML,
+                "accounts": ACCOUNTS_YAML,
+                "exclude-models": "omit-me,and-me-too",
+            }
+        )
+        action_event = mock.Mock(params={})
+        mock_estimate.return_value = {"tasks": [], "eta": 0, "expected_bytes": 0}
+        self.harness.begin()
+
+        self.harness.charm._on_plan_backup_action(action_event)
+
+        mock_estimate.assert_called_once_with(omit_models=["omit-me", "and-me-too"])
+        action_event.set_results.assert_called_once_with(
+            {"result": json.dumps(mock_estimate.return_value, indent=2)}
+        )
 
     # @mock.patch("utils.rsync")
     @mock.patch("utils.NRPE")
@@ -284,6 +360,30 @@ class TestCharm(unittest.TestCase):
         self.assertEqual(kwargs["shortname"], "juju_backup_all_results")
         self.harness.charm.helper.nrpe.write.assert_called_once()
 
+    @mock.patch("utils.JujuBackupAllHelper.update_shard")
+    def test_40_peers_changed(self, mock_update_shard):
+        """Test the leader shares the backups among the units."""
+        self.harness.set_leader(True)
+        self.harness.begin()
+        relation_id = self.harness.add_relation("cluster", "juju-backup-all")
+        self.harness.add_relation_unit(relation_id, "juju-backup-all/1")
+        self.harness.update_relation_data(
+            relation_id, "juju-backup-all/1", {"ssh-public-key": "ssh-ed25519 AAAA unit1"}
+        )
+
+        units = ["juju-backup-all/0", "juju-backup-all/1"]
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "juju-backup-all")["units"],
+            json.dumps(units),
+        )
+        mock_update_shard.assert_called_with(
+            "juju-backup-all/0", units, ["ssh-ed25519 AAAA unit1"]
+        )
+
+        # the shares are reassigned when a unit goes away
+        self.harness.remove_relation_unit(relation_id, "juju-backup-all/1")
+        mock_update_shard.assert_called_with("juju-backup-all/0", ["juju-backup-all/0"], [])
+
     @mock.patch("utils.Paths")
     @mock.patch("subprocess.check_output")
     def test_80_init_jujudata_dir_exception(self, mock_check_output, mock_paths):
@@ -0,0 +1,94 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Checksum unit tests."""
+import hashlib
+import pathlib
+import subprocess
+import tempfile
+import unittest
+
+from checksum import add_checksums, file_sha256, tree_sha256, write_manifest
+
+
+class TestChecksum(unittest.TestCase):
+    """Test the checksums of the backup files."""
+
+    def setUp(self):
+        """Set up backup files."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = pathlib.Path(tmpdir.name)
+        self.dump = self.dir / "dump.sql"
+        self.dump.write_bytes(b"dump" * 1000000)
+        self.archive = self.dir / "controller.tar.gz"
+        self.archive.write_bytes(b"archive")
+
+    def test_file_sha256(self):
+        """Test the digest of a file spanning several blocks."""
+        self.assertEqual(
+            file_sha256(self.dump), hashlib.sha256(self.dump.read_bytes()).hexdigest()
+        )
+
+    def test_tree_sha256(self):
+        """Test any change to the files changes the digest."""
+        (self.dir / "ssh").mkdir()
+        (self.dir / "ssh" / "key").write_text("key")
+        names = ("ssh", "controller.tar.gz", "missing.yaml")
+        digest = tree_sha256(self.dir, names)
+
+        self.assertEqual(tree_sha256(self.dir, names), digest)
+        (self.dir / "ssh" / "key").write_text("new key")
+        self.assertNotEqual(tree_sha256(self.dir, names), digest)
+        digest = tree_sha256(self.dir, names)
+        (self.dir / "ssh" / "key").rename(self.dir / "ssh" / "other-key")
+        self.assertNotEqual(tree_sha256(self.dir, names), digest)
+        digest = tree_sha256(self.dir, names)
+        (self.dir / "missing.yaml").write_text("")
+        self.assertNotEqual(tree_sha256(self.dir, names), digest)
+        # files not named are ignored
+        digest = tree_sha256(self.dir, names)
+        self.dump.write_text("changed")
+        self.assertEqual(tree_sha256(self.dir, names), digest)
+
+    def test_add_checksums(self):
+        """Test only the backup entries without checksum are hashed."""
+        results = {
+            "app_backups": [{"download_path": str(self.dump)}, {"download_path": str(self.dir)}],
+            "controller_backups": [{"download_path": str(self.archive), "sha256": "known"}],
+            "errors": [{"error_reason": "boom"}],
+        }
+
+        results = add_checksums(results)
+
+        self.assertEqual(results["app_backups"][0]["sha256"], file_sha256(self.dump))
+        self.assertNotIn("sha256", results["app_backups"][1])
+        self.assertEqual(results["controller_backups"][0]["sha256"], "known")
+        self.assertEqual(results["errors"], [{"error_reason": "boom"}])
+
+    def test_add_known_checksums(self):
+        """Test the files hashed as they were downloaded are not read again."""
+        stat = self.dump.stat()
+        known = {str(self.dump): ("downloaded", stat.st_size, stat.st_mtime_ns)}
+
+        results = add_checksums({"app_backups": [{"download_path": str(self.dump)}]}, known)
+        self.assertEqual(results["app_backups"][0]["sha256"], "downloaded")
+
+        # a file modified since it was hashed is read again
+        known = {str(self.dump): ("downloaded", stat.st_size + 1, stat.st_mtime_ns)}
+        results = add_checksums({"app_backups": [{"download_path": str(self.dump)}]}, known)
+        self.assertEqual(results["app_backups"][0]["sha256"], file_sha256(self.dump))
+
+    def test_write_manifest(self):
+        """Test the manifest can be checked by sha256sum."""
+        results = add_checksums(
+            {
+                "app_backups": [{"download_path": str(self.dump)}],
+                "controller_backups": [{"download_path": str(self.archive)}],
+            }
+        )
+        manifest = self.dir / "manifest.sha256"
+
+        write_manifest(results, manifest)
+
+        self.assertEqual(len(manifest.read_text().splitlines()), 2)
+        subprocess.run(["sha256sum", "--check", "--quiet", str(manifest)], check=True)
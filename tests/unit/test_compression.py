@@ -0,0 +1,102 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Compression unit tests."""
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from compression import Compressor
+
+
+class TestCompressor(unittest.TestCase):
+    """Test Compressor."""
+
+    def setUp(self):
+        """Set up a backup file spanning several blocks."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = pathlib.Path(tmpdir.name)
+        self.data = b"".join(os.urandom(64) * 100 for _ in range(50))
+        self.path = self.dir / "dump.sql"
+        self.path.write_bytes(self.data)
+
+    def test_compress_file(self):
+        """Test each codec compresses the blocks into a single decompressible file."""
+        for codec, decompress in (
+            ("gzip", gzip.decompress),
+            ("bzip2", bz2.decompress),
+            ("xz", lzma.decompress),
+        ):
+            with self.subTest(codec=codec):
+                self.path.write_bytes(self.data)
+                compressor = Compressor(codec, 1, threads=3, block_size=10000)
+
+                compressed_path, sha256 = compressor.compress_file(self.path)
+
+                self.assertFalse(self.path.exists())
+                self.assertEqual(compressed_path.parent, self.dir)
+                self.assertTrue(compressed_path.name.startswith("dump.sql."))
+                self.assertEqual(decompress(compressed_path.read_bytes()), self.data)
+                self.assertEqual(sha256, hashlib.sha256(compressed_path.read_bytes()).hexdigest())
+                self.assertEqual(sorted(self.dir.iterdir()), [compressed_path])
+                compressed_path.unlink()
+
+    def test_compress_empty_file(self):
+        """Test an empty file is compressed into a valid stream."""
+        self.path.write_bytes(b"")
+
+        compressed_path, _ = Compressor("gzip", 6).compress_file(self.path)
+
+        self.assertEqual(gzip.decompress(compressed_path.read_bytes()), b"")
+
+    def test_compress_results(self):
+        """Test the results entries point to the compressed files, with their sizes."""
+        archive = self.dir / "config.tar.gz"
+        archive.write_bytes(b"already compressed")
+        results = {
+            "app_backups": [{"download_path": str(self.path)}],
+            "config_backups": [{"download_path": str(archive)}],
+            "errors": [{"download_path": "not a backup entry"}],
+        }
+
+        results = Compressor("gzip", 6).compress_results(results)
+
+        entry = results["app_backups"][0]
+        self.assertEqual(entry["download_path"], str(self.path) + ".gz")
+        self.assertEqual(entry["compression"]["codec"], "gzip")
+        self.assertEqual(entry["compression"]["size"], len(self.data))
+        self.assertEqual(
+            entry["compression"]["compressed_size"], os.path.getsize(entry["download_path"])
+        )
+        self.assertGreater(entry["compression"]["ratio"], 1)
+        self.assertEqual(
+            entry["sha256"],
+            hashlib.sha256(self.path.with_suffix(".sql.gz").read_bytes()).hexdigest(),
+        )
+        self.assertEqual(results["config_backups"], [{"download_path": str(archive)}])
+
+    def test_unsupported_codec(self):
+        """Test an unknown codec is rejected."""
+        with self.assertRaises(ValueError):
+            Compressor("lz4", 6)
+
+    def test_unsupported_level(self):
+        """Test the levels out of the range of the codec are rejected."""
+        for codec, level in (("bzip2", 0), ("gzip", 10), ("xz", -1)):
+            with self.assertRaises(ValueError):
+                Compressor(codec, level)
+        Compressor("gzip", 0)
+
+    @mock.patch("compression.os.cpu_count", return_value=16)
+    def test_threads(self, _):
+        """Test the cores are shared among the tasks compressing at the same time."""
+        self.assertEqual(Compressor("gzip", 6).threads, 16)
+        self.assertEqual(Compressor("gzip", 6, concurrent_tasks=4).threads, 4)
+        self.assertEqual(Compressor("gzip", 6, concurrent_tasks=32).threads, 1)
+        self.assertEqual(Compressor("gzip", 6, threads=3, concurrent_tasks=4).threads, 3)
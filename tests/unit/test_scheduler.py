@@ -0,0 +1,172 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Scheduler unit tests."""
+import threading
+import time
+import unittest
+
+from scheduler import AdaptiveTimeout, BackupTask, TaskScheduler, TaskSkipped
+
+
+class TestBackupTask(unittest.TestCase):
+    """Test BackupTask."""
+
+    def test_name(self):
+        """Test the name of each kind of task."""
+        self.assertEqual(BackupTask().name, "juju-client-config")
+        self.assertEqual(BackupTask("c1").name, "c1")
+        self.assertEqual(BackupTask("c1", "m1").name, "c1/m1")
+        self.assertEqual(BackupTask("c1", "m1", "etcd").name, "c1/m1/etcd")
+
+
+class TestTaskScheduler(unittest.TestCase):
+    """Test TaskScheduler."""
+
+    def _run_tracking_concurrency(self, scheduler, tasks):
+        """Run the tasks, and return the maximum number of tasks running per scope."""
+        lock = threading.Lock()
+        running, peaks = {}, {}
+
+        def func(task):
+            scopes = ("total", task.controller, (task.controller, task.model))
+            with lock:
+                for scope in scopes:
+                    running[scope] = running.get(scope, 0) + 1
+                    peaks[scope] = max(peaks.get(scope, 0), running[scope])
+            time.sleep(0.01)
+            with lock:
+                for scope in scopes:
+                    running[scope] -= 1
+            return task.name
+
+        results = scheduler.run(tasks, func)
+        self.assertEqual(results, {task.name: task.name for task in tasks})
+        return peaks
+
+    def test_run_within_caps(self):
+        """Test the caps on the tasks running in total, per controller and per model."""
+        tasks = [
+            BackupTask(controller, model, charm)
+            for controller in ("c1", "c2")
+            for model in ("m1", "m2", "m3")
+            for charm in ("etcd", "postgresql")
+        ]
+        scheduler = TaskScheduler(4, max_per_controller=3, max_per_model=1)
+
+        peaks = self._run_tracking_concurrency(scheduler, tasks)
+
+        self.assertLessEqual(peaks["total"], 4)
+        self.assertLessEqual(peaks["c1"], 3)
+        self.assertLessEqual(peaks["c2"], 3)
+        for controller in ("c1", "c2"):
+            for model in ("m1", "m2", "m3"):
+                self.assertEqual(peaks[(controller, model)], 1)
+
+    def test_run_no_caps(self):
+        """Test tasks of the same model run in parallel without caps."""
+        tasks = [BackupTask("c1", "m1", charm) for charm in ("a", "b", "c")]
+        barrier = threading.Barrier(3, timeout=5)
+
+        results = TaskScheduler(3).run(tasks, lambda task: barrier.wait() is not None)
+
+        self.assertEqual(results, {"c1/m1/a": True, "c1/m1/b": True, "c1/m1/c": True})
+
+    def test_run_failure(self):
+        """Test a failed task does not prevent the others from running."""
+
+        def func(task):
+            if task.controller == "c1":
+                raise ValueError("boom")
+            return "ok"
+
+        results = TaskScheduler(1).run([BackupTask("c1"), BackupTask("c2")], func)
+
+        self.assertIsInstance(results["c1"], ValueError)
+        self.assertEqual(results["c2"], "ok")
+
+    def test_run_deadline(self):
+        """Test the tasks not expected to be done before the deadline are skipped."""
+        tasks = [BackupTask("c1"), BackupTask("c2"), BackupTask("c3"), BackupTask("c4")]
+        durations = {"c1": 0.01, "c2": 60, "c3": None}
+
+        def func(task):
+            time.sleep(0.01)
+            return task.name
+
+        results = TaskScheduler(1).run(
+            tasks, func, deadline=time.monotonic() + 30, durations=durations
+        )
+
+        self.assertEqual(results["c1"], "c1")
+        self.assertIsInstance(results["c2"], TaskSkipped)
+        self.assertEqual(results["c3"], "c3")
+        self.assertEqual(results["c4"], "c4")
+
+    def test_run_past_deadline(self):
+        """Test no task is started once the deadline has passed."""
+        tasks = [BackupTask("c1"), BackupTask("c2")]
+
+        results = TaskScheduler(2).run(tasks, str, deadline=time.monotonic() - 1)
+
+        self.assertIsInstance(results["c1"], TaskSkipped)
+        self.assertIsInstance(results["c2"], TaskSkipped)
+
+    def test_worker_context(self):
+        """Test each worker runs its tasks in the worker context."""
+        contexts = []
+
+        class Context:
+            def __enter__(self):
+                contexts.append(threading.current_thread().name)
+
+            def __exit__(self, *args):
+                pass
+
+        TaskScheduler(2, worker_context=Context).run([BackupTask("c1"), BackupTask("c2")], str)
+
+        self.assertEqual(len(contexts), 2)
+
+
+class TestAdaptiveTimeout(unittest.TestCase):
+    """Test AdaptiveTimeout."""
+
+    def test_timeout(self):
+        """Test the timeout is derived from the 99th percentile of the durations."""
+        adaptive_timeout = AdaptiveTimeout(factor=2, floor=60, ceiling=3600, min_samples=3)
+
+        # too few durations
+        self.assertEqual(adaptive_timeout.timeout([100, 100], 600), 600)
+        # p99 of a small sample is the longest duration
+        self.assertEqual(adaptive_timeout.timeout([100, 150, 120], 600), 300)
+        # within the floor and ceiling
+        self.assertEqual(adaptive_timeout.timeout([1, 2, 3], 600), 60)
+        self.assertEqual(adaptive_timeout.timeout([5000, 5000, 5000], 600), 3600)
+
+    def test_timeout_ignores_outliers(self):
+        """Test a single outlier in a large sample is above the 99th percentile."""
+        adaptive_timeout = AdaptiveTimeout(factor=1.5, floor=0, ceiling=10000)
+
+        self.assertEqual(adaptive_timeout.timeout([100] * 199 + [9000], 600), 150)
+
+
+class TestTaskSchedulerEstimate(unittest.TestCase):
+    """Test TaskScheduler.estimate."""
+
+    def test_estimate(self):
+        """Test the run duration is simulated with the workers and caps."""
+        tasks = [BackupTask("c1", "m1", "etcd"), BackupTask("c1", "m1", "mysql"), BackupTask("c2")]
+        durations = {"c1/m1/etcd": 100, "c1/m1/mysql": 50, "c2": 120}
+
+        # the tasks of m1 run one after the other, alongside c2
+        self.assertEqual(TaskScheduler(3, max_per_model=1).estimate(tasks, durations), 150)
+        # everything runs in parallel
+        self.assertEqual(TaskScheduler(3).estimate(tasks, durations), 120)
+        # a single worker runs everything one after the other
+        self.assertEqual(TaskScheduler(1).estimate(tasks, durations), 270)
+
+    def test_estimate_unknown_durations(self):
+        """Test tasks without expected duration are counted as instantaneous."""
+        tasks = [BackupTask("c1"), BackupTask("c2")]
+
+        self.assertEqual(TaskScheduler(1).estimate(tasks, {"c1": 10, "c2": None}), 10)
+        self.assertEqual(TaskScheduler(1).estimate([], {}), 0)
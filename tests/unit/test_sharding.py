@@ -0,0 +1,80 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Sharding unit tests."""
+import pathlib
+import tempfile
+import unittest
+
+from scheduler import BackupTask
+from sharding import HashRing, Shard
+
+
+class TestHashRing(unittest.TestCase):
+    """Test HashRing."""
+
+    def setUp(self):
+        """Set up tests."""
+        self.keys = [f"controller/model-{i}" for i in range(1000)]
+
+    def test_node(self):
+        """Test the keys are spread over all the nodes."""
+        ring = HashRing(["unit/0", "unit/1", "unit/2"])
+
+        assignment = [ring.node(key) for key in self.keys]
+
+        for node in ("unit/0", "unit/1", "unit/2"):
+            self.assertGreater(assignment.count(node), 200)
+        self.assertEqual(assignment, [ring.node(key) for key in self.keys])
+
+    def test_node_removed(self):
+        """Test only the keys of a removed node are reassigned."""
+        before = HashRing(["unit/0", "unit/1", "unit/2"])
+        after = HashRing(["unit/0", "unit/2"])
+
+        for key in self.keys:
+            if before.node(key) != "unit/1":
+                self.assertEqual(after.node(key), before.node(key))
+
+    def test_empty(self):
+        """Test an empty ring assigns no node."""
+        self.assertIsNone(HashRing([]).node("key"))
+
+
+class TestShard(unittest.TestCase):
+    """Test Shard."""
+
+    def test_owns(self):
+        """Test each task is owned by a single unit, the tasks of a model by the same one."""
+        units = ["unit/0", "unit/1"]
+        shards = [Shard(unit, units) for unit in units]
+        tasks = [BackupTask(), BackupTask("c1")] + [
+            BackupTask("c1", f"m{i}", charm) for i in range(20) for charm in ("etcd", "mysql")
+        ]
+
+        for task in tasks:
+            self.assertEqual(sum(shard.owns(task) for shard in shards), 1)
+        for i in range(20):
+            self.assertEqual(
+                shards[0].owns(BackupTask("c1", f"m{i}", "etcd")),
+                shards[0].owns(BackupTask("c1", f"m{i}", "mysql")),
+            )
+
+    def test_save_load(self):
+        """Test the shard is saved and loaded back."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = pathlib.Path(tmpdir) / "shard.json"
+            self.assertIsNone(Shard.load(path))
+
+            Shard("unit/1", ["unit/1", "unit/0"], ["ssh-ed25519 AAAA unit1"]).save(path)
+            shard = Shard.load(path)
+
+            self.assertEqual(shard.unit, "unit/1")
+            self.assertEqual(shard.units, ["unit/0", "unit/1"])
+            self.assertEqual(shard.ssh_public_keys, ["ssh-ed25519 AAAA unit1"])
+
+            path.write_text("invalid")
+            self.assertIsNone(Shard.load(path))
+
+            for data in ('{"unit": "unit/1"}', '["unit/1"]', '{"unit": "unit/1", "units": 1}'):
+                path.write_text(data)
+                self.assertIsNone(Shard.load(path))
@@ -0,0 +1,307 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import pathlib
+import tempfile
+import unittest
+
+from state import (
+    BackupFingerprints,
+    BackupLinks,
+    Checkpoint,
+    JSONStateFile,
+    ModelInventory,
+    SSHKeyCache,
+    TaskHistory,
+)
+
+
+class TestJSONStateFile(unittest.TestCase):
+    """Test JSONStateFile's methods."""
+
+    def setUp(self):
+        """Set up tests."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = pathlib.Path(tmpdir.name) / "state.json"
+
+    def test_missing_file(self):
+        """Test a missing state file gives an empty state."""
+        self.assertEqual(JSONStateFile(self.path).data, {})
+
+    def test_invalid_file(self):
+        """Test an invalid state file gives an empty state."""
+        for content in ["not json", "[]"]:
+            with self.subTest(content):
+                self.path.write_text(content)
+                self.assertEqual(JSONStateFile(self.path).data, {})
+
+    def test_save(self):
+        """Test the state is saved and loaded back."""
+        state = JSONStateFile(self.path)
+        state.data["key"] = "value"
+        state.save()
+
+        self.assertEqual(JSONStateFile(self.path).data, {"key": "value"})
+        self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+    def test_save_concurrent_changes(self):
+        """Test the entries changed by another process meanwhile are kept."""
+        state = JSONStateFile(self.path)
+        state.data.update(kept="value", removed="value", changed="value")
+        state.save()
+
+        other = JSONStateFile(self.path)
+        other.data["other"] = "value"
+        other.data["changed"] = "other value"
+        other.save()
+        del state.data["removed"]
+        state.data["new"] = "value"
+        state.save()
+
+        expected = {"kept": "value", "changed": "other value", "other": "value", "new": "value"}
+        self.assertEqual(state.data, expected)
+        self.assertEqual(JSONStateFile(self.path).data, expected)
+
+
+class TestSSHKeyCache(unittest.TestCase):
+    """Test SSHKeyCache's methods."""
+
+    def setUp(self):
+        """Set up tests."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.cache = SSHKeyCache(pathlib.Path(tmpdir.name) / "cache.json", ttl=100)
+
+    def test_is_fresh(self):
+        """Test key confirmations expire after the ttl."""
+        self.assertFalse(self.cache.is_fresh("uuid", "fp", now=1000))
+
+        self.cache.confirm("uuid", "fp", "controller", "model", now=1000)
+
+        self.assertTrue(self.cache.is_fresh("uuid", "fp", now=1050))
+        self.assertFalse(self.cache.is_fresh("uuid", "fp", now=1100))
+        self.assertFalse(self.cache.is_fresh("uuid", "other-fp", now=1050))
+        self.assertFalse(self.cache.is_fresh("other-uuid", "fp", now=1050))
+
+    def test_invalidate(self):
+        """Test invalidating a model by its name."""
+        self.cache.confirm("uuid", "fp", "controller", "model", now=1000)
+        self.cache.confirm("uuid2", "fp", "controller", "model2", now=1000)
+
+        self.cache.invalidate("controller", "model")
+
+        self.assertFalse(self.cache.is_fresh("uuid", "fp", now=1050))
+        self.assertTrue(self.cache.is_fresh("uuid2", "fp", now=1050))
+
+
+class TestModelInventory(unittest.TestCase):
+    """Test ModelInventory's methods."""
+
+    def setUp(self):
+        """Set up tests."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.inventory = ModelInventory(pathlib.Path(tmpdir.name) / "models.json", 3)
+
+    def test_select(self):
+        """Test only new or changed models are selected between full sweeps."""
+        models = {"m1": "uuid1", "m2": "uuid2"}
+
+        # first run is a full sweep
+        self.assertEqual(self.inventory.select("c1", models), models)
+        self.inventory.record("c1", "m1", "uuid1")
+        self.inventory.record("c1", "m2", "uuid2")
+
+        # m2 was re-created and m3 is new
+        models = {"m1": "uuid1", "m2": "uuid2-new", "m3": "uuid3"}
+        self.assertEqual(self.inventory.select("c1", models), {"m2": "uuid2-new", "m3": "uuid3"})
+        # m3 was not processed successfully, it is selected again
+        self.inventory.record("c1", "m2", "uuid2-new")
+        self.assertEqual(self.inventory.select("c1", models), {"m3": "uuid3"})
+        self.inventory.record("c1", "m3", "uuid3")
+
+        # full sweep is due every 3 runs
+        self.assertEqual(self.inventory.select("c1", models), models)
+        self.assertEqual(self.inventory.select("c1", models), {})
+
+    def test_select_removed_models(self):
+        """Test removed models are forgotten."""
+        self.inventory.select("c1", {"m1": "uuid1"})
+        self.inventory.record("c1", "m1", "uuid1")
+
+        self.inventory.select("c1", {})
+
+        self.assertEqual(self.inventory.data["c1"]["models"], {})
+
+    def test_invalidate(self):
+        """Test an invalidated model is selected again between full sweeps."""
+        models = {"m1": "uuid1", "m2": "uuid2"}
+        self.inventory.select("c1", models)
+        self.inventory.record("c1", "m1", "uuid1")
+        self.inventory.record("c1", "m2", "uuid2")
+
+        self.inventory.invalidate("c1", "m2")
+        self.inventory.invalidate("c2", "m1")
+
+        self.assertEqual(self.inventory.select("c1", models), {"m2": "uuid2"})
+
+    def test_full_sweep_every_run(self):
+        """Test every model is selected when full sweeps happen every run."""
+        inventory = ModelInventory(self.inventory.path, 1)
+        inventory.select("c1", {"m1": "uuid1"})
+        inventory.record("c1", "m1", "uuid1")
+
+        self.assertEqual(inventory.select("c1", {"m1": "uuid1"}), {"m1": "uuid1"})
+
+
+class TestTaskHistory(unittest.TestCase):
+    """Test TaskHistory's methods."""
+
+    def setUp(self):
+        """Set up tests."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.history = TaskHistory(pathlib.Path(tmpdir.name) / "history.json", 3)
+
+    def test_record(self):
+        """Test only the last durations are kept."""
+        for duration in (1, 2, 3, 4):
+            self.history.record("c1/m1/etcd", duration)
+
+        self.assertEqual(self.history.durations("c1/m1/etcd"), [2, 3, 4])
+        self.assertEqual(self.history.durations("c1/m1/mysql"), [])
+
+    def test_expected_duration(self):
+        """Test the expected duration is the median of the recorded durations."""
+        self.assertIsNone(self.history.expected_duration("c1"))
+        for duration in (10, 500, 12):
+            self.history.record("c1", duration)
+
+        self.assertEqual(self.history.expected_duration("c1"), 12)
+
+    def test_expected_size(self):
+        """Test the expected size is the median of the recorded sizes."""
+        self.history.record("c1", 10)
+        self.assertIsNone(self.history.expected_size("c1"))
+
+        for size in (1000, 3000):
+            self.history.record("c1", 10, size=size)
+
+        self.assertEqual(self.history.expected_size("c1"), 2000)
+
+
+class TestCheckpoint(unittest.TestCase):
+    """Test Checkpoint's methods."""
+
+    def setUp(self):
+        """Set up tests."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = pathlib.Path(tmpdir.name) / "checkpoint.json"
+
+    def test_unfinished(self):
+        """Test a run is unfinished until it is marked as finished."""
+        checkpoint = Checkpoint(self.path, 3600)
+        self.assertFalse(checkpoint.unfinished)
+
+        checkpoint.start()
+        checkpoint.save()
+        self.assertTrue(Checkpoint(self.path, 3600).unfinished)
+
+        checkpoint.finish()
+        checkpoint.save()
+        self.assertFalse(Checkpoint(self.path, 3600).unfinished)
+
+    def test_resume(self):
+        """Test only a run started within the window is resumed."""
+        checkpoint = Checkpoint(self.path, 3600)
+        checkpoint.start(now=0)
+        checkpoint.record("c1", {"controller_backups": []}, now=100)
+        checkpoint.record("c1/m1/etcd", {"app_backups": []}, now=3000)
+        checkpoint.save()
+
+        checkpoint = Checkpoint(self.path, 3600)
+        self.assertEqual(
+            checkpoint.resume(now=3500),
+            {"c1": {"controller_backups": []}, "c1/m1/etcd": {"app_backups": []}},
+        )
+
+        # e.g. the run of the next schedule, which starts afresh
+        checkpoint = Checkpoint(self.path, 3600)
+        self.assertEqual(checkpoint.resume(now=3600), {})
+        self.assertEqual(checkpoint.data["started"], 3600)
+
+    def test_start(self):
+        """Test a new run forgets the completed tasks."""
+        checkpoint = Checkpoint(self.path, 3600)
+        checkpoint.start(now=0)
+        checkpoint.record("c1", {}, now=100)
+
+        checkpoint.start(now=200)
+
+        self.assertEqual(checkpoint.resume(now=300), {})
+
+
+class TestBackupFingerprints(unittest.TestCase):
+    """Test BackupFingerprints."""
+
+    def test_previous_results(self):
+        """Test the previous results are only returned for the same fingerprint."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = pathlib.Path(tmpdir.name) / "fingerprints.json"
+        fingerprints = BackupFingerprints(path)
+        results = {"config_backups": [{"download_path": "/a/path"}]}
+
+        self.assertIsNone(fingerprints.previous_results("juju-client-config", "abc"))
+        fingerprints.record("juju-client-config", "abc", results)
+        fingerprints.save()
+
+        fingerprints = BackupFingerprints(path)
+        self.assertEqual(fingerprints.previous_results("juju-client-config", "abc"), results)
+        self.assertIsNone(fingerprints.previous_results("juju-client-config", "def"))
+
+
+class TestBackupLinks(unittest.TestCase):
+    """Test BackupLinks."""
+
+    def test_purge(self):
+        """Test the backup files are purged on their own age, links included."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        backup_dir = pathlib.Path(tmpdir.name) / "backups"
+        (backup_dir / ".store").mkdir(parents=True)
+        now = 100 * 86400
+        first = backup_dir / "run1.tar.gz"
+        first.write_bytes(b"config")
+        os.utime(first, (now - 10 * 86400, now - 10 * 86400))
+        blob = backup_dir / ".store" / "blob"
+        os.link(first, blob)
+        link = backup_dir / "run2.tar.gz"
+        os.link(first, link)
+        recent = backup_dir / "run3.tar.gz"
+        recent.write_bytes(b"new config")
+        os.utime(recent, (now - 3 * 86400, now - 3 * 86400))
+        links = BackupLinks(pathlib.Path(tmpdir.name) / "links.json")
+        links.record(link, now=now - 86400)
+        links.record(backup_dir / "missing.tar.gz", now=now)
+
+        self.assertEqual(links.mtime(link), now - 86400)
+        self.assertEqual(links.mtime(first), now - 10 * 86400)
+        self.assertEqual(links.purge(backup_dir, 7, exclude=backup_dir / ".store", now=now), 1)
+        self.assertFalse(first.exists())
+        self.assertTrue(blob.exists())
+        self.assertTrue(link.exists())
+        self.assertTrue(recent.exists())
+        self.assertEqual(links.data, {str(link): now - 86400})
+
+        # the link ages as the run that made it
+        self.assertEqual(links.purge(backup_dir, 7, exclude=backup_dir / ".store", now=now), 0)
+        self.assertEqual(
+            links.purge(backup_dir, 7, exclude=backup_dir / ".store", now=now + 7 * 86400), 2
+        )
+        self.assertFalse(link.exists())
+        self.assertFalse(recent.exists())
+        self.assertEqual(links.data, {})
@@ -0,0 +1,65 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Blob store unit tests."""
+import os
+import pathlib
+import tempfile
+import unittest
+
+from checksum import add_checksums
+from store import BlobStore
+
+
+class TestBlobStore(unittest.TestCase):
+    """Test BlobStore."""
+
+    def setUp(self):
+        """Set up a store in a backup directory."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.backup_dir = pathlib.Path(tmpdir.name)
+        self.store = BlobStore(self.backup_dir / ".store")
+
+    def _backup(self, run, content):
+        """Write a backup file of a run, and return its results document."""
+        path = self.backup_dir / run / "juju-client-config.tar.gz"
+        path.parent.mkdir()
+        path.write_bytes(content)
+        return add_checksums({"config_backups": [{"download_path": str(path)}]})
+
+    def test_add_results(self):
+        """Test identical backup files are stored once."""
+        first = self.store.add_results(self._backup("run1", b"config"))
+        os.utime(first["config_backups"][0]["download_path"], (86400, 86400))
+        second = self.store.add_results(self._backup("run2", b"config"))
+        third = self.store.add_results(self._backup("run3", b"new config"))
+
+        self.assertFalse(first["config_backups"][0]["deduplicated"])
+        self.assertTrue(second["config_backups"][0]["deduplicated"])
+        self.assertFalse(third["config_backups"][0]["deduplicated"])
+        first_path = first["config_backups"][0]["download_path"]
+        second_path = second["config_backups"][0]["download_path"]
+        self.assertTrue(os.path.samefile(first_path, second_path))
+        self.assertEqual(pathlib.Path(second_path).read_bytes(), b"config")
+        self.assertEqual(len(list(self.store.root.glob("*/*"))), 2)
+        # the blob keeps the time of the first backup, see BackupLinks
+        self.assertEqual(os.stat(second_path).st_mtime, 86400)
+
+        # adding a file again is a no-op
+        self.assertTrue(self.store.add_results(second)["config_backups"][0]["deduplicated"])
+
+    def test_gc(self):
+        """Test only the blobs no longer linked from a backup file are removed."""
+        first = self.store.add_results(self._backup("run1", b"config"))
+        self.store.add_results(self._backup("run2", b"config"))
+        third = self.store.add_results(self._backup("run3", b"new config"))
+
+        os.unlink(first["config_backups"][0]["download_path"])
+        self.assertEqual(self.store.gc(), 0)
+
+        os.unlink(self.backup_dir / "run2" / "juju-client-config.tar.gz")
+        self.assertEqual(self.store.gc(), 1)
+        self.assertEqual(
+            list(self.store.root.glob("*/*")),
+            [self.store.blob_path(third["config_backups"][0]["sha256"])],
+        )
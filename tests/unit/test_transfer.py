@@ -0,0 +1,227 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Resumable transfer unit tests."""
+import asyncio
+import hashlib
+import os
+import pathlib
+import subprocess
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from juju.unit import Unit
+
+from transfer import Remote, ResumableTransfer, TransferCancelled, TransferError
+
+
+class TestResumableTransfer(unittest.TestCase):
+    """Test ResumableTransfer, running the "remote" commands locally."""
+
+    def setUp(self):
+        """Set up a file on the "unit"."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = pathlib.Path(tmpdir.name)
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        self.source = self.dir / "dump.sql"
+        self.source.write_bytes(self.data)
+        self.destination = self.dir / "backups" / "dump.sql"
+        self.destination.parent.mkdir()
+        self.partial = self.destination.with_name("dump.sql.partial")
+
+        self.remote = Remote("10.0.0.1", "ubuntu")
+        ssh_command_patcher = mock.patch.object(
+            Remote, "command", side_effect=lambda command: ["sh", "-c", command]
+        )
+        ssh_command_patcher.start()
+        self.addCleanup(ssh_command_patcher.stop)
+
+    def test_download(self):
+        """Test a file is downloaded to its destination, without partial file left."""
+        transfer = ResumableTransfer(0)
+        transfer.download(self.remote, str(self.source), self.destination)
+
+        self.assertEqual(self.destination.read_bytes(), self.data)
+        self.assertFalse(self.partial.exists())
+        # the file is hashed as it is downloaded
+        self.assertEqual(
+            transfer.checksums[str(self.destination)],
+            (
+                hashlib.sha256(self.data).hexdigest(),
+                len(self.data),
+                self.destination.stat().st_mtime_ns,
+            ),
+        )
+
+    def test_download_to_directory(self):
+        """Test a file downloaded to a directory keeps its name."""
+        ResumableTransfer(0).download(self.remote, str(self.source), self.destination.parent)
+
+        self.assertEqual(self.destination.read_bytes(), self.data)
+
+    def test_download_resumed(self):
+        """Test an interrupted download is resumed from the end of the partial file."""
+        self.partial.write_bytes(self.data[:2000000])
+        transfer = ResumableTransfer(0)
+
+        with mock.patch.object(transfer, "_append", wraps=transfer._append) as append:
+            transfer.download(self.remote, str(self.source), self.destination)
+
+        append.assert_called_once_with(
+            self.remote, str(self.source), self.partial, 2000000, mock.ANY
+        )
+        self.assertEqual(self.destination.read_bytes(), self.data)
+        self.assertEqual(
+            transfer.checksums[str(self.destination)][0], hashlib.sha256(self.data).hexdigest()
+        )
+
+    def test_download_restarted(self):
+        """Test a partial file not matching the file on the unit is downloaded again."""
+        self.partial.write_bytes(b"another dump")
+
+        ResumableTransfer(0).download(self.remote, str(self.source), self.destination)
+
+        self.assertEqual(self.destination.read_bytes(), self.data)
+
+    def test_download_retries(self):
+        """Test a failing download is resumed within the retry budget, then fails."""
+        transfer = ResumableTransfer(2)
+        calls = []
+
+        def interrupted_append(remote, source, partial, offset, digest):
+            calls.append(offset)
+            end = offset + 1000000
+            with open(partial, "ab") as target:
+                target.write(self.data[offset:end])
+            if end < len(self.data):
+                raise subprocess.CalledProcessError(255, "ssh")
+
+        with mock.patch.object(transfer, "_append", side_effect=interrupted_append):
+            with self.assertRaises(TransferError):
+                transfer.download(self.remote, str(self.source), self.destination)
+
+            self.assertEqual(calls, [0, 1000000, 2000000])
+            self.assertEqual(self.partial.stat().st_size, 3000000)
+
+            # the next download resumes where the last one stopped
+            transfer.download(self.remote, str(self.source), self.destination)
+
+        self.assertEqual(calls[-1], 3000000)
+        self.assertEqual(self.destination.read_bytes(), self.data)
+
+    def test_download_cancelled(self):
+        """Test a cancelled download kills its ssh command, and leaves its file partial."""
+        with mock.patch.object(
+            Remote,
+            "command",
+            side_effect=lambda command: [
+                "sh",
+                "-c",
+                "exec sleep 30" if "tail" in command else command,
+            ],
+        ):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                download = executor.submit(
+                    ResumableTransfer(2).download, self.remote, str(self.source), self.destination
+                )
+                time.sleep(0.5)
+                self.remote.cancel()
+                with self.assertRaises(TransferCancelled):
+                    download.result(timeout=5)
+
+        self.assertFalse(self.destination.exists())
+        self.assertTrue(self.partial.exists())
+
+
+class TestResumableScpFrom(unittest.TestCase):
+    """Test the `scp_from` of the units within ResumableTransfer.installed."""
+
+    def setUp(self):
+        """Set up a unit, and the original scp_from."""
+        self.unit = mock.MagicMock()
+        self.unit.machine.dns_name = "10.0.0.1"
+        self.scp_from = mock.AsyncMock()
+        scp_from_patcher = mock.patch.object(Unit, "scp_from", self.scp_from)
+        scp_from_patcher.start()
+        self.addCleanup(scp_from_patcher.stop)
+        self.transfer = ResumableTransfer(2)
+
+    def _run(self, coroutine):
+        """Run a coroutine on a dedicated event loop.
+
+        asyncio.run would unset the event loop of the main thread, used by other tests.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_download(self):
+        """Test juju-backup-all's scp_from call downloads the file, with its scp options."""
+        with mock.patch.object(self.transfer, "download") as download:
+            with self.transfer.installed():
+                self._run(
+                    Unit.scp_from(
+                        self.unit, "/tmp/dump.sql", "/backups", scp_opts="-o ProxyJump=bastion"
+                    )
+                )
+
+        download.assert_called_once_with(mock.ANY, "/tmp/dump.sql", "/backups")
+        remote = download.call_args.args[0]
+        self.assertEqual((remote.address, remote.user), ("10.0.0.1", "ubuntu"))
+        self.assertEqual(remote.ssh_opts, ["-o", "ProxyJump=bastion"])
+        self.scp_from.assert_not_called()
+
+    def test_proxy(self):
+        """Test the files copied through the juju api server are still copied with scp."""
+        with mock.patch.object(self.transfer, "download") as download:
+            with self.transfer.installed():
+                self._run(
+                    Unit.scp_from(
+                        self.unit, "/tmp/dump.sql", "/backups", proxy=True, scp_opts="-C"
+                    )
+                )
+
+        download.assert_not_called()
+        self.scp_from.assert_awaited_once_with(
+            self.unit, "/tmp/dump.sql", "/backups", user="ubuntu", proxy=True, scp_opts="-C"
+        )
+
+    def test_cancelled(self):
+        """Test a cancelled scp_from stops its download before it returns."""
+        stopped = []
+
+        def download(remote, source, destination):
+            while not remote.cancelled:
+                time.sleep(0.01)
+            stopped.append(source)
+            raise TransferCancelled("cancelled")
+
+        with mock.patch.object(self.transfer, "download", side_effect=download):
+            with self.transfer.installed():
+                with self.assertRaises(asyncio.TimeoutError):
+                    self._run(
+                        asyncio.wait_for(
+                            Unit.scp_from(self.unit, "/tmp/dump.sql", "/backups"), 0.1
+                        )
+                    )
+                self.assertEqual(stopped, ["/tmp/dump.sql"])
+
+    def test_ssh_opts(self):
+        """Test the ssh options are given to ssh before the destination."""
+        command = Remote("10.0.0.1", "ubuntu", ssh_opts=["-p", "2222"]).command("true")
+
+        self.assertEqual(command[-4:], ["-p", "2222", "ubuntu@10.0.0.1", "true"])
+
+    def test_restored(self):
+        """Test the original scp_from is restored when leaving the context, on errors too."""
+        with self.assertRaises(RuntimeError):
+            with self.transfer.installed():
+                self.assertIsNot(Unit.scp_from, self.scp_from)
+                raise RuntimeError("interrupted")
+
+        self.assertIs(Unit.scp_from, self.scp_from)
@@ -1,22 +1,49 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import asyncio
+import hashlib
+import json
+import os
 import pathlib
+import tempfile
+import time
 import unittest
 from unittest import mock
 
 import yaml
+from juju.unit import Unit
 from jujubackupall.config import Config
 
+import utils
+from scheduler import AdaptiveTimeout, BackupTask
+from sharding import Shard
+from state import BackupLinks, Checkpoint
 from tests.fixtures import (
     ACCOUNTS_YAML,
     MOCK_CONFIG,
+    RAW_ED25519_PUBKEY,
     RAW_PUBKEY,
+    SSH_ED25519_FINGERPRINT,
     SSH_FINGERPRINT,
+    AsyncMock,
     MockController,
     MockModel,
 )
-from utils import JujuBackupAllHelper, SSHKeyHelper
+from utils import (
+    BackupRunner,
+    ConnectionPool,
+    JujuBackupAllHelper,
+    SSHKeyHelper,
+    backup_results_size,
+    connect_controller,
+    connect_model,
+    crontab_jitter_delay,
+    crontab_max_age,
+    merge_backup_results,
+    run_in_workers,
+    ssh_key_type,
+)
 
 
 class TestJujuBackupAllHelper(unittest.TestCase):
@@ -35,10 +62,9 @@ class TestJujuBackupAllHelper(unittest.TestCase):
         cls.addClassCleanup(charm_dir_patcher.stop)
         patch.return_value = "/a/directory/"
 
-    @mock.patch("utils.BackupProcessor.process_backups")
     @mock.patch("utils.JujuBackupAllHelper._update_dir_owner")
-    @mock.patch("utils.JujuBackupAllHelper.push_ssh_keys")
-    def test_perform_backup(self, process_backups, update_dir_owner, push_ssh_keys):
+    @mock.patch("utils.BackupRunner")
+    def test_perform_backup(self, backup_runner, update_dir_owner):
         """Test perform_backup calls the right methods."""
         model = mock.MagicMock()
         model.config = MOCK_CONFIG
@@ -46,10 +72,25 @@ class TestJujuBackupAllHelper(unittest.TestCase):
 
         backup_helper.perform_backup()
 
-        push_ssh_keys.assert_called_once()
-        process_backups.assert_called_once()
+        backup_runner.assert_called_once()
+        backup_runner.return_value.run.assert_called_once_with(omit_models=None)
         update_dir_owner.assert_called_once_with(MOCK_CONFIG["backup-dir"])
 
+    @mock.patch("utils.JujuBackupAllHelper._get_ssh_key_helper")
+    @mock.patch("utils.BackupRunner")
+    def test_plan_backup(self, backup_runner, get_ssh_key_helper):
+        """Test plan_backup estimates the backups without a ssh key helper."""
+        model = mock.MagicMock()
+        model.config = dict(MOCK_CONFIG, **{"exclude-models": "m1,m2"})
+        backup_runner.return_value.estimate.return_value = {"tasks": []}
+        backup_helper = JujuBackupAllHelper(model)
+
+        self.assertEqual(json.loads(backup_helper.plan_backup()), {"tasks": []})
+
+        get_ssh_key_helper.assert_not_called()
+        self.assertIsNone(backup_runner.call_args[0][1])
+        backup_runner.return_value.estimate.assert_called_once_with(omit_models=["m1", "m2"])
+
     @mock.patch("pathlib.Path.write_text")
     def test_update_crontab_all_models(self, cronjob_write_text):
         """Test update_crontab properly renders the cronjob."""
@@ -61,16 +102,50 @@ class TestJujuBackupAllHelper(unittest.TestCase):
 
         backup_helper.update_crontab()
 
-        expected_cron_job = "PATH=/usr/bin:/bin:/snap/bin\n{} {} {} --debug --purge {} --task-timeout {} >> {} 2>&1\n".format(  # noqa E501
+        expected_cron_job = "PATH=/usr/bin:/bin:/snap/bin\n{} {} {} --debug --purge {} --task-timeout {} --ssh-key-push-concurrency {} --ssh-key-full-sweep-runs {} --backup-concurrency {} --backup-concurrency-per-controller {} --backup-concurrency-per-model {} --resume-window {} >> {} 2>&1\n".format(  # noqa E501
             MOCK_CONFIG["crontab"],
             "root",
             config.Paths.AUTO_BACKUP_SCRIPT_PATH,
             MOCK_CONFIG["backup-retention-period"],
             MOCK_CONFIG["timeout"],
+            MOCK_CONFIG["ssh-key-push-concurrency"],
+            MOCK_CONFIG["ssh-key-full-sweep-runs"],
+            MOCK_CONFIG["backup-concurrency"],
+            MOCK_CONFIG["backup-concurrency-per-controller"],
+            MOCK_CONFIG["backup-concurrency-per-model"],
+            MOCK_CONFIG["resume-window"],
             config.Paths.AUTO_BACKUP_LOG_PATH,
         )
         cronjob_write_text.assert_called_once_with(expected_cron_job, encoding="utf-8")
 
+    @mock.patch("pathlib.Path.write_text")
+    def test_update_crontab_ssh_key_cache_ttl(self, cronjob_write_text):
+        """Test update_crontab renders the ssh key cache ttl."""
+        model = mock.MagicMock()
+        model.config = dict(MOCK_CONFIG, **{"ssh-key-cache-ttl": 24})
+        backup_helper = JujuBackupAllHelper(model)
+
+        backup_helper.update_crontab()
+
+        cron_job = cronjob_write_text.call_args[0][0]
+        self.assertIn(" --ssh-key-cache-ttl 24 ", cron_job)
+
+    @mock.patch("pathlib.Path.write_text")
+    def test_update_crontab_adaptive_timeout(self, cronjob_write_text):
+        """Test update_crontab renders the adaptive timeout options."""
+        model = mock.MagicMock()
+        model.config = dict(MOCK_CONFIG, **{"adaptive-timeout": True})
+        backup_helper = JujuBackupAllHelper(model)
+
+        backup_helper.update_crontab()
+
+        cron_job = cronjob_write_text.call_args[0][0]
+        self.assertIn(
+            " --adaptive-timeout --adaptive-timeout-factor 2.0 --adaptive-timeout-floor 60"
+            " --adaptive-timeout-ceiling 7200 ",
+            cron_job,
+        )
+
     @mock.patch("pathlib.Path.write_text")
     def test_update_crontab_exclude_model(self, cronjob_write_text):
         """Test update_crontab properly renders the cronjob."""
@@ -83,12 +158,18 @@ class TestJujuBackupAllHelper(unittest.TestCase):
 
         backup_helper.update_crontab()
 
-        expected_cron_job = "PATH=/usr/bin:/bin:/snap/bin\n{} {} {} --debug --purge {} --task-timeout {} --omit-model omit-me >> {} 2>&1\n".format(  # noqa E501
+        expected_cron_job = "PATH=/usr/bin:/bin:/snap/bin\n{} {} {} --debug --purge {} --task-timeout {} --ssh-key-push-concurrency {} --ssh-key-full-sweep-runs {} --backup-concurrency {} --backup-concurrency-per-controller {} --backup-concurrency-per-model {} --resume-window {} --omit-model omit-me >> {} 2>&1\n".format(  # noqa E501
             MOCK_CONFIG["crontab"],
             "root",
             config.Paths.AUTO_BACKUP_SCRIPT_PATH,
             MOCK_CONFIG["backup-retention-period"],
             MOCK_CONFIG["timeout"],
+            MOCK_CONFIG["ssh-key-push-concurrency"],
+            MOCK_CONFIG["ssh-key-full-sweep-runs"],
+            MOCK_CONFIG["backup-concurrency"],
+            MOCK_CONFIG["backup-concurrency-per-controller"],
+            MOCK_CONFIG["backup-concurrency-per-model"],
+            MOCK_CONFIG["resume-window"],
             config.Paths.AUTO_BACKUP_LOG_PATH,
         )
         cronjob_write_text.assert_called_once_with(expected_cron_job, encoding="utf-8")
@@ -105,16 +186,820 @@ class TestJujuBackupAllHelper(unittest.TestCase):
 
         backup_helper.update_crontab()
 
-        expected_cron_job = "PATH=/usr/bin:/bin:/snap/bin\n{} {} {} --debug --purge {} --task-timeout {} --omit-model omit-me --omit-model and-me-too >> {} 2>&1\n".format(  # noqa E501
+        expected_cron_job = "PATH=/usr/bin:/bin:/snap/bin\n{} {} {} --debug --purge {} --task-timeout {} --ssh-key-push-concurrency {} --ssh-key-full-sweep-runs {} --backup-concurrency {} --backup-concurrency-per-controller {} --backup-concurrency-per-model {} --resume-window {} --omit-model omit-me --omit-model and-me-too >> {} 2>&1\n".format(  # noqa E501
             MOCK_CONFIG["crontab"],
             "root",
             config.Paths.AUTO_BACKUP_SCRIPT_PATH,
             MOCK_CONFIG["backup-retention-period"],
             MOCK_CONFIG["timeout"],
+            MOCK_CONFIG["ssh-key-push-concurrency"],
+            MOCK_CONFIG["ssh-key-full-sweep-runs"],
+            MOCK_CONFIG["backup-concurrency"],
+            MOCK_CONFIG["backup-concurrency-per-controller"],
+            MOCK_CONFIG["backup-concurrency-per-model"],
+            MOCK_CONFIG["resume-window"],
             config.Paths.AUTO_BACKUP_LOG_PATH,
         )
         cronjob_write_text.assert_called_once_with(expected_cron_job, encoding="utf-8")
 
+    @mock.patch("pathlib.Path.write_text")
+    def test_update_crontab_controller_crontabs(self, cronjob_write_text):
+        """Test update_crontab renders a cron job per controller with a crontab of its own."""
+        import config
+
+        model = mock.MagicMock()
+        model.config = dict(
+            MOCK_CONFIG, **{"controller-crontabs": 'c2: "0 2 * * *"\nc1: "0 14 * * 6"'}
+        )
+        backup_helper = JujuBackupAllHelper(model)
+
+        backup_helper.update_crontab()
+
+        lines = cronjob_write_text.call_args[0][0].splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith(f"{MOCK_CONFIG['crontab']} root "))
+        self.assertIn(" --exclude-controller c1 --exclude-controller c2 >> ", lines[1])
+        self.assertTrue(
+            lines[2].startswith(f"0 14 * * 6 root {config.Paths.AUTO_BACKUP_SCRIPT_PATH}")
+        )
+        self.assertIn(" --controller c1 >> ", lines[2])
+        self.assertTrue(lines[3].startswith("0 2 * * * root "))
+        self.assertIn(" --controller c2 >> ", lines[3])
+
+    @mock.patch("pathlib.Path.write_text")
+    def test_update_crontab_jitter(self, cronjob_write_text):
+        """Test update_crontab delays the backups by the same jitter on every render."""
+        model = mock.MagicMock()
+        model.uuid = "507e8c03-d300-4fff-9903-2c780541479c"
+        model.unit.name = "juju-backup-all/0"
+        model.config = dict(
+            MOCK_CONFIG, **{"crontab-jitter": 30, "controller-crontabs": 'c1: "0 2 * * *"'}
+        )
+        backup_helper = JujuBackupAllHelper(model)
+
+        backup_helper.update_crontab()
+        backup_helper.update_crontab()
+
+        delay = crontab_jitter_delay(f"{model.uuid}/{model.unit.name}", 1800)
+        self.assertGreater(delay, 0)
+        first, second = [call[0][0] for call in cronjob_write_text.call_args_list]
+        self.assertEqual(first, second)
+        lines = first.splitlines()
+        self.assertTrue(lines[1].startswith(f"{MOCK_CONFIG['crontab']} root sleep {delay} && "))
+        self.assertTrue(lines[2].startswith(f"0 2 * * * root sleep {delay} && "))
+
+    def test_crontab_jitter_delay(self):
+        """Test the jitter delay is stable, within the window, and differs between keys."""
+        delays = [crontab_jitter_delay(f"uuid/juju-backup-all/{i}", 1800) for i in range(20)]
+
+        self.assertEqual(
+            delays, [crontab_jitter_delay(f"uuid/juju-backup-all/{i}", 1800) for i in range(20)]
+        )
+        self.assertTrue(all(0 <= delay < 1800 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertEqual(crontab_jitter_delay("uuid/juju-backup-all/0", 0), 0)
+
+    @mock.patch("pathlib.Path.write_text")
+    def test_update_crontab_resume_window(self, cronjob_write_text):
+        """Test the resume window of each cron job is shorter than the period of its crontab."""
+        model = mock.MagicMock()
+        model.config = dict(
+            MOCK_CONFIG, **{"resume-window": 48, "controller-crontabs": 'c1: "0 14 * * 6"'}
+        )
+        backup_helper = JujuBackupAllHelper(model)
+
+        backup_helper.update_crontab()
+
+        lines = cronjob_write_text.call_args[0][0].splitlines()
+        self.assertIn(" --resume-window 23 ", lines[1])
+        self.assertIn(" --resume-window 48 ", lines[2])
+
+    def test_crontab_max_age(self):
+        """Test the max age of the results follows the period of the crontab."""
+        self.assertEqual(crontab_max_age("10 20 * * *"), 25)
+        self.assertEqual(crontab_max_age("0 */6 * * *", jitter=30), 26)
+        self.assertEqual(crontab_max_age("0 14 * * 6"), 7 * 24 + 1)
+        self.assertEqual(crontab_max_age("0 2 1 * *"), 31 * 24 + 1)
+        self.assertEqual(crontab_max_age("0 2 1 1 *"), 366 * 24 + 1)
+        self.assertEqual(crontab_max_age("@daily"), 25)
+
+    @mock.patch("utils.rsync")
+    def test_configure_nrpe(self, _):
+        """Test the results of each schedule are checked against its own max age."""
+        model = mock.MagicMock()
+        model.config = dict(
+            MOCK_CONFIG,
+            crontab="0 2 * * *",
+            **{"controller-crontabs": 'c1: "0 14 * * 6"', "crontab-jitter": 90},
+        )
+        backup_helper = JujuBackupAllHelper(model)
+
+        backup_helper.configure_nrpe()
+
+        check_cmd = backup_helper.nrpe.add_check.call_args[1]["check_cmd"]
+        self.assertIn(" --backup-results-max-age 27", check_cmd)
+        self.assertIn(" --controller-max-age c1=171", check_cmd)
+
+    def test_remove_stale_controller_results(self):
+        """Test the results of the controllers no longer on their own schedule are removed."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        jujudata_dir = pathlib.Path(tmpdir.name)
+        for name in ("auto_backup_results", "auto_backup_results.c1", "auto_backup_results.c2"):
+            (jujudata_dir / f"{name}.json").write_text("{}")
+
+        with mock.patch("config.Paths.JUJUDATA_DIR", jujudata_dir), mock.patch(
+            "config.Paths.AUTO_BACKUP_RESULTS_PATH", jujudata_dir / "auto_backup_results.json"
+        ):
+            JujuBackupAllHelper._remove_stale_controller_results({"c1": "0 2 * * *"})
+
+        self.assertEqual(
+            sorted(path.name for path in jujudata_dir.iterdir()),
+            ["auto_backup_results.c1.json", "auto_backup_results.json"],
+        )
+
+    @mock.patch("utils.JujuBackupAllHelper._update_dir_owner")
+    @mock.patch("utils.BackupRunner")
+    def test_retry_failed(self, backup_runner, _):
+        """Test the failed tasks of the main and per-controller runs are retried."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        jujudata_dir = pathlib.Path(tmpdir.name)
+        results = {
+            "auto_backup_results": {"errors": [{"controller": "c0", "task": "c0"}]},
+            "auto_backup_results.c1": {"errors": [{"controller": "c1", "task": "c1"}]},
+            "auto_backup_results.c2": {"controller_backups": []},
+            "auto_backup_results.c3": {"ERROR": "Traceback"},
+        }
+        for name, backup_results in results.items():
+            (jujudata_dir / f"{name}.json").write_text(json.dumps(backup_results))
+        backup_runner.return_value.retry_failed.side_effect = lambda backup_results: json.dumps(
+            {
+                "controller_backups": [
+                    {"download_path": json.loads(backup_results)["errors"][0]["task"]}
+                ]
+            }
+        )
+        model = mock.MagicMock()
+        model.config = dict(MOCK_CONFIG, **{"backup-checksums": True})
+        backup_helper = JujuBackupAllHelper(model)
+
+        with mock.patch("config.Paths.JUJUDATA_DIR", jujudata_dir), mock.patch(
+            "config.Paths.AUTO_BACKUP_RESULTS_PATH", jujudata_dir / "auto_backup_results.json"
+        ), mock.patch(
+            "config.Paths.AUTO_BACKUP_MANIFEST_PATH", jujudata_dir / "auto_backup_manifest.sha256"
+        ):
+            retried = json.loads(backup_helper.retry_failed())
+
+        self.assertEqual(
+            retried, {"controller_backups": [{"download_path": "c0"}, {"download_path": "c1"}]}
+        )
+        self.assertEqual(backup_runner.return_value.retry_failed.call_count, 2)
+        self.assertNotIn(
+            "errors", json.loads((jujudata_dir / "auto_backup_results.c1.json").read_text())
+        )
+        self.assertTrue((jujudata_dir / "auto_backup_manifest.c1.sha256").is_file())
+        self.assertTrue((jujudata_dir / "auto_backup_manifest.sha256").is_file())
+
+    def test_validate_config_controller_crontabs(self):
+        """Test an invalid controller-crontabs option blocks the charm."""
+        model = mock.MagicMock()
+        model.config = dict(
+            MOCK_CONFIG,
+            controllers="controllers: {}",
+            accounts="controllers: {}",
+            **{"controller-crontabs": "- not a mapping"},
+        )
+        backup_helper = JujuBackupAllHelper(model)
+
+        self.assertFalse(backup_helper.validate_config())
+
+    def test_validate_config_compression_level(self):
+        """Test a compression level out of the range of the codec blocks the charm."""
+        model = mock.MagicMock()
+        for codec, level, valid in (("bzip2", 0, False), ("gzip", 0, True), ("xz", 10, False)):
+            model.config = dict(
+                MOCK_CONFIG,
+                controllers="controllers: {}",
+                accounts="controllers: {}",
+                **{"compression": codec, "compression-level": level},
+            )
+            backup_helper = JujuBackupAllHelper(model)
+
+            self.assertEqual(backup_helper.validate_config(), valid)
+
+
+class TestBackupRunner(unittest.TestCase):
+    """Test BackupRunner's methods."""
+
+    def setUp(self):
+        """Set up tests."""
+        self.config_data = {
+            "all_controllers": True,
+            "backup_controller": True,
+            "backup_juju_client_config": True,
+            "controllers": [""],
+            "excluded_charms": [""],
+            "timeout": 60,
+        }
+        self.ssh_helper = mock.MagicMock()
+        self.ssh_helper.repair_ssh_key.return_value = False
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        history_path = pathlib.Path(tmpdir.name) / "task_history.json"
+        history_patcher = mock.patch("utils.Paths.TASK_HISTORY_PATH", history_path)
+        history_patcher.start()
+        self.addCleanup(history_patcher.stop)
+        links_path = pathlib.Path(tmpdir.name) / "backup_links.json"
+        links_patcher = mock.patch("utils.Paths.BACKUP_LINKS_PATH", links_path)
+        links_patcher.start()
+        self.addCleanup(links_patcher.stop)
+
+    @mock.patch("utils.connect_controller")
+    @mock.patch("utils.Config")
+    @mock.patch("utils.BackupProcessor")
+    def test_run(self, mock_backup_processor, mock_config, mock_connect_controller):
+        """Test the backups are split in tasks run in parallel."""
+        mock_backup_processor.return_value.controller_names = ["c1", "c2"]
+        mock_backup_processor.return_value.process_backups.return_value = json.dumps(
+            {"app_backups": [{"download_path": "/a/path"}]}
+        )
+        controller = mock.MagicMock()
+        controller.list_models = AsyncMock(return_value=["m1", "m2", "omit-me"])
+        model = mock.MagicMock()
+        model.applications = {
+            "mysql": mock.Mock(charm_name="mysql-innodb-cluster"),
+            "db": mock.Mock(charm_name="postgresql"),
+            "ubuntu": mock.Mock(charm_name="ubuntu"),
+        }
+        controller.get_model = AsyncMock(return_value=model)
+        mock_connect_controller.return_value.__enter__.return_value = controller
+        runner = BackupRunner(self.config_data, self.ssh_helper)
+
+        tasks, errors = runner.plan(omit_models=["omit-me"])
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            [task.name for task in tasks],
+            [
+                "juju-client-config",
+                "c1",
+                "c1/m1/mysql-innodb-cluster",
+                "c1/m1/postgresql",
+                "c1/m2/mysql-innodb-cluster",
+                "c1/m2/postgresql",
+                "c2",
+                "c2/m1/mysql-innodb-cluster",
+                "c2/m1/postgresql",
+                "c2/m2/mysql-innodb-cluster",
+                "c2/m2/postgresql",
+            ],
+        )
+
+        results = json.loads(runner.run(omit_models=["omit-me"]))
+
+        self.assertEqual(len(results["app_backups"]), 11)
+        self.ssh_helper.push_ssh_keys_to_controller.assert_has_calls(
+            [mock.call("c1", shard=None), mock.call("c2", shard=None)], any_order=True
+        )
+        mock_backup_processor.return_value.process_backups.assert_any_call(
+            omit_models=["m2", "omit-me"]
+        )
+        mock_config.assert_any_call(
+            args=dict(
+                self.config_data,
+                all_controllers=False,
+                controllers=["c1"],
+                backup_controller=False,
+                backup_juju_client_config=False,
+                excluded_charms=["etcd", "mysql-innodb-cluster", "percona-cluster"],
+            )
+        )
+        mock_config.assert_any_call(
+            args=dict(
+                self.config_data,
+                all_controllers=False,
+                controllers=[],
+                backup_controller=False,
+            )
+        )
+
+    @mock.patch("utils.connect_controller")
+    @mock.patch("utils.BackupProcessor")
+    def test_run_controller_failure(self, mock_backup_processor, mock_connect_controller):
+        """Test a controller that can't be planned is reported as an error."""
+        self.config_data["backup_juju_client_config"] = False
+        mock_backup_processor.return_value.controller_names = ["c1"]
+        mock_connect_controller.return_value.__enter__.side_effect = Exception("unreachable")
+        runner = BackupRunner(self.config_data, self.ssh_helper)
+
+        results = json.loads(runner.run())
+
+        self.assertEqual(
+            results, {"errors": [{"controller": "c1", "error_reason": "unreachable"}]}
+        )
+        mock_backup_processor.return_value.process_backups.assert_not_called()
+
+    @mock.patch("utils.connect_controller")
+    @mock.patch("utils.Config")
+    @mock.patch("utils.BackupProcessor")
+    def test_run_lazy_ssh_key_push(
+        self, mock_backup_processor, mock_config, mock_connect_controller
+    ):
+        """Test the ssh key is only pushed to the models of failed backups missing it."""
+        self.config_data["backup_juju_client_config"] = False
+        self.config_data["backup_controller"] = False
+        # libjuju does not report why scp failed
+        auth_error = {
+            "controller": "c1",
+            "model": "m1",
+            "app": "mysql",
+            "error_reason": "command failed after 10 attempts: ['scp', '-i', "
+            "'/var/lib/jujubackupall/ssh/juju_id_rsa', '-o', 'StrictHostKeyChecking=no', "
+            "'-q', '-B', 'ubuntu@10.5.0.20:/var/backups/mysql/mysqldump.gz', '/opt/backups']",
+        }
+        mock_backup_processor.return_value.controller_names = ["c1"]
+        mock_backup_processor.return_value.process_backups.side_effect = [
+            json.dumps({"app_backups": [], "errors": [auth_error]}),
+            json.dumps({"app_backups": [{"download_path": "/a/path"}]}),
+        ]
+        controller = mock.MagicMock()
+        controller.list_models = AsyncMock(return_value=["m1"])
+        model = mock.MagicMock()
+        model.applications = {"mysql": mock.Mock(charm_name="mysql-innodb-cluster")}
+        controller.get_model = AsyncMock(return_value=model)
+        mock_connect_controller.return_value.__enter__.return_value = controller
+        self.ssh_helper.repair_ssh_key.return_value = True
+        runner = BackupRunner(self.config_data, self.ssh_helper, lazy_ssh_key_push=True)
+
+        results = json.loads(runner.run())
+
+        self.assertEqual(results, {"app_backups": [{"download_path": "/a/path"}]})
+        self.ssh_helper.push_ssh_keys_to_controller.assert_not_called()
+        self.ssh_helper.repair_ssh_key.assert_called_once_with("c1", "m1")
+        self.assertEqual(mock_backup_processor.return_value.process_backups.call_count, 2)
+
+        # the key was in the model, the failure is not retried
+        self.ssh_helper.repair_ssh_key.return_value = False
+        mock_backup_processor.return_value.process_backups.side_effect = None
+        mock_backup_processor.return_value.process_backups.return_value = json.dumps(
+            {"errors": [auth_error]}
+        )
+
+        results = json.loads(runner.run())
+
+        self.assertEqual(results["errors"][0]["error_reason"], auth_error["error_reason"])
+        self.assertEqual(mock_backup_processor.return_value.process_backups.call_count, 3)
+
+    @mock.patch("utils.connect_controller")
+    @mock.patch("utils.BackupProcessor")
+    def test_plan_shard(self, mock_backup_processor, mock_connect_controller):
+        """Test only the models in the shard of the unit are planned."""
+        mock_backup_processor.return_value.controller_names = ["c1"]
+        model_names = [f"m{i}" for i in range(10)]
+        controller = mock.MagicMock()
+        controller.list_models = AsyncMock(return_value=model_names)
+        model = mock.MagicMock()
+        model.applications = {"mysql": mock.Mock(charm_name="mysql-innodb-cluster")}
+        controller.get_model = AsyncMock(return_value=model)
+        mock_connect_controller.return_value.__enter__.return_value = controller
+        shard = Shard("unit/0", ["unit/0", "unit/1"])
+        runner = BackupRunner(self.config_data, self.ssh_helper, shard=shard)
+
+        tasks, errors = runner.plan()
+
+        self.assertEqual(errors, [])
+        all_tasks = [BackupTask(), BackupTask("c1")] + [
+            BackupTask("c1", name, "mysql-innodb-cluster") for name in model_names
+        ]
+        self.assertEqual(
+            [task.name for task in tasks],
+            [task.name for task in all_tasks if shard.owns(task)],
+        )
+        owned_models = [name for name in model_names if shard.owns(BackupTask("c1", name))]
+        self.assertTrue(0 < len(owned_models) < len(model_names))
+        # the charms of the other models are not listed
+        self.assertEqual(
+            sorted(call.args[0] for call in controller.get_model.call_args_list), owned_models
+        )
+        self.ssh_helper.push_ssh_keys_to_controller.assert_called_once_with("c1", shard=shard)
+
+    def test_run_longest_first(self):
+        """Test the tasks start longest first, and their durations are recorded."""
+        runner = BackupRunner(self.config_data, self.ssh_helper, concurrency=1)
+        runner.history.record("c1", 10)
+        runner.history.record("c2", 300)
+        runner._models = {"c1": [], "c2": [], "c3": []}
+        tasks = [BackupTask("c1"), BackupTask("c2"), BackupTask("c3")]
+
+        started = []
+        with mock.patch.object(runner, "plan", return_value=(tasks, [])):
+            with mock.patch.object(
+                runner, "_backup", side_effect=lambda task: started.append(task.name) or "{}"
+            ):
+                runner.run()
+
+        # c3 was never run, its duration is unknown
+        self.assertEqual(started, ["c3", "c2", "c1"])
+        self.assertEqual(len(runner.history.durations("c1")), 2)
+        self.assertTrue(utils.Paths.TASK_HISTORY_PATH.is_file())
+
+    def test_run_priorities(self):
+        """Test the tasks start by decreasing priority, then longest first."""
+        runner = BackupRunner(
+            self.config_data,
+            self.ssh_helper,
+            concurrency=1,
+            priorities={"controller": 10, "mysql-innodb-cluster": 5},
+        )
+        runner.history.record("c1/m1/etcd", 300)
+        runner.history.record("c1/m1/mysql-innodb-cluster", 10)
+        runner._models = {"c1": ["m1"]}
+        tasks = [
+            BackupTask(),
+            BackupTask("c1", "m1", "etcd"),
+            BackupTask("c1", "m1", "mysql-innodb-cluster"),
+            BackupTask("c1"),
+        ]
+
+        started = []
+        with mock.patch.object(runner, "plan", return_value=(tasks, [])):
+            with mock.patch.object(
+                runner, "_backup", side_effect=lambda task: started.append(task.name) or "{}"
+            ):
+                runner.run()
+
+        self.assertEqual(
+            started, ["c1", "c1/m1/mysql-innodb-cluster", "juju-client-config", "c1/m1/etcd"]
+        )
+
+    def test_run_deadline(self):
+        """Test the tasks not expected to be done before the deadline are reported skipped."""
+        runner = BackupRunner(self.config_data, self.ssh_helper, concurrency=1, deadline=60)
+        runner.history.record("c1", 10)
+        runner.history.record("c2", 3600)
+        runner._models = {"c1": [], "c2": []}
+        tasks = [BackupTask("c1"), BackupTask("c2")]
+
+        with mock.patch.object(runner, "plan", return_value=(tasks, [])):
+            with mock.patch.object(runner, "_backup", return_value="{}") as backup:
+                results = json.loads(runner.run())
+
+        backup.assert_called_once()
+        self.assertEqual(results["skipped_tasks"], ["c2"])
+        self.assertEqual(len(results["errors"]), 1)
+        self.assertEqual(results["errors"][0]["task"], "c2")
+        self.assertEqual(results["errors"][0]["controller"], "c2")
+
+    def test_run_compression(self):
+        """Test the files of each task are compressed, before its size is recorded."""
+        compressor = mock.MagicMock()
+        compressor.compress_results.side_effect = lambda results: dict(results, compressed=True)
+        runner = BackupRunner(self.config_data, self.ssh_helper, compressor=compressor)
+        runner._models = {"c1": []}
+
+        with mock.patch.object(runner, "plan", return_value=([BackupTask("c1")], [])):
+            with mock.patch.object(runner, "_backup", return_value='{"controller_backups": []}'):
+                results = json.loads(runner.run())
+
+        compressor.compress_results.assert_called_once_with({"controller_backups": []})
+        self.assertTrue(results["compressed"])
+        self.assertEqual(len(runner.history.durations("c1")), 1)
+
+    def test_run_checksums(self):
+        """Test the sha256 of the files of each task are recorded in its results."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        backup_path = pathlib.Path(tmpdir.name) / "controller.tar.gz"
+        backup_path.write_bytes(b"backup")
+        runner = BackupRunner(self.config_data, self.ssh_helper, checksums=True)
+        runner._models = {"c1": []}
+        controller_results = {"controller_backups": [{"download_path": str(backup_path)}]}
+
+        with mock.patch.object(runner, "plan", return_value=([BackupTask("c1")], [])):
+            with mock.patch.object(runner, "_backup", return_value=json.dumps(controller_results)):
+                results = json.loads(runner.run())
+
+        self.assertEqual(
+            results["controller_backups"][0]["sha256"], hashlib.sha256(b"backup").hexdigest()
+        )
+
+    def test_run_dedup_store(self):
+        """Test the files of each task are checksummed and added to the store."""
+        store = mock.MagicMock()
+        store.add_results.side_effect = lambda results: {
+            "controller_backups": [
+                {"download_path": "/a/path", "deduplicated": True},
+                {"download_path": "/another/path", "deduplicated": False},
+            ]
+        }
+        runner = BackupRunner(self.config_data, self.ssh_helper, store=store)
+        runner._models = {"c1": []}
+
+        with mock.patch.object(runner, "plan", return_value=([BackupTask("c1")], [])):
+            with mock.patch.object(runner, "_backup", return_value='{"controller_backups": []}'):
+                with mock.patch(
+                    "utils.add_checksums", side_effect=lambda r, known=None: r
+                ) as checksums:
+                    results = json.loads(runner.run())
+
+        checksums.assert_called_once()
+        store.add_results.assert_called_once_with({"controller_backups": []})
+        self.assertEqual(len(results["controller_backups"]), 2)
+        # only the link to a previous content is aged from the time of its link
+        links = BackupLinks(utils.Paths.BACKUP_LINKS_PATH)
+        self.assertEqual(set(links.data), {"/a/path"})
+
+    def test_run_resumable_transfers(self):
+        """Test the units' scp_from is only replaced while the tasks run."""
+        scp_from = Unit.scp_from
+        runner = BackupRunner(self.config_data, self.ssh_helper, transfer_retries=2)
+        runner._models = {"c1": []}
+        self.assertIs(Unit.scp_from, scp_from)
+
+        def backup(task):
+            self.assertIsNot(Unit.scp_from, scp_from)
+            return '{"controller_backups": []}'
+
+        with mock.patch.object(runner, "plan", return_value=([BackupTask("c1")], [])):
+            with mock.patch.object(runner, "_backup", side_effect=backup) as mock_backup:
+                results = json.loads(runner.run())
+
+        mock_backup.assert_called_once()
+        self.assertNotIn("errors", results)
+        self.assertIs(Unit.scp_from, scp_from)
+
+    def test_run_skip_unchanged(self):
+        """Test the last juju client config backup is linked if the config did not change."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        jujudata_dir = pathlib.Path(tmpdir.name)
+        (jujudata_dir / "accounts.yaml").write_text("accounts")
+        backup_path = jujudata_dir / "juju-client-config-20260101.tar.gz"
+        backup_path.write_bytes(b"backup")
+        mtime = time.time() - 10 * 86400
+        os.utime(backup_path, (mtime, mtime))
+        config_results = {"config_backups": [{"download_path": str(backup_path)}]}
+        tasks = [BackupTask()]
+
+        def run():
+            runner = BackupRunner(self.config_data, self.ssh_helper, skip_unchanged=True)
+            with mock.patch.object(runner, "plan", return_value=(tasks, [])):
+                with mock.patch.object(
+                    runner, "_backup", return_value=json.dumps(config_results)
+                ) as backup:
+                    results = json.loads(runner.run())
+            return results, backup
+
+        with mock.patch("utils.Paths.JUJUDATA_DIR", jujudata_dir), mock.patch(
+            "utils.Paths.BACKUP_FINGERPRINTS_PATH", jujudata_dir / "fingerprints.json"
+        ):
+            results, backup = run()
+            backup.assert_called_once()
+            self.assertEqual(results, config_results)
+
+            results, backup = run()
+            backup.assert_not_called()
+            entry = results["config_backups"][0]
+            self.assertTrue(entry["unchanged"])
+            self.assertRegex(
+                entry["download_path"], r"juju-client-config-20260101\.unchanged-[\d-]+\.tar\.gz$"
+            )
+            self.assertTrue(os.path.samefile(entry["download_path"], backup_path))
+            # the link keeps the time of the original file, its own time is recorded
+            self.assertEqual(os.stat(entry["download_path"]).st_mtime, mtime)
+            links = BackupLinks(utils.Paths.BACKUP_LINKS_PATH)
+            self.assertAlmostEqual(links.mtime(entry["download_path"]), time.time(), delta=60)
+
+            (jujudata_dir / "accounts.yaml").write_text("new accounts")
+            results, backup = run()
+            backup.assert_called_once()
+
+        """Test the tasks completed by an unfinished run are skipped."""
+        checkpoint = Checkpoint(utils.Paths.TASK_HISTORY_PATH.with_name("checkpoint.json"), 3600)
+        runner = BackupRunner(self.config_data, self.ssh_helper, checkpoint=checkpoint)
+        runner._models = {"c1": [], "c2": []}
+        tasks = [BackupTask("c1"), BackupTask("c2")]
+        controller_results = {"controller_backups": [{"download_path": "/a/path"}]}
+
+        backed_up = []
+
+        def backup(task):
+            backed_up.append(task.name)
+            if task.name == "c2":
+                raise Exception("interrupted")
+            return json.dumps(controller_results)
+
+        with mock.patch.object(runner, "plan", return_value=(tasks, [])):
+            with mock.patch.object(runner, "_backup", side_effect=backup):
+                # the first run is interrupted after backing up c1
+                with mock.patch.object(checkpoint, "finish", side_effect=KeyboardInterrupt):
+                    with self.assertRaises(KeyboardInterrupt):
+                        runner.run()
+                self.assertTrue(checkpoint.unfinished)
+
+                backed_up.clear()
+                results = json.loads(runner.run())
+
+        self.assertEqual(backed_up, ["c2"])
+        self.assertEqual(results["controller_backups"], controller_results["controller_backups"])
+        self.assertFalse(checkpoint.unfinished)
+
+    def test_retry_failed(self):
+        """Test only the failed tasks are run again, and their outcome merged."""
+        runner = BackupRunner(self.config_data, self.ssh_helper)
+        runner._models = {"c1": ["m1", "m2"]}
+        runner._app_charms = {("c1", "m2"): {"db": "postgresql", "etcd": "etcd"}}
+        tasks = [
+            BackupTask("c1"),
+            BackupTask("c1", "m1", "etcd"),
+            BackupTask("c1", "m2", "etcd"),
+            BackupTask("c1", "m2", "postgresql"),
+        ]
+        backup_results = json.dumps(
+            {
+                "app_backups": [{"download_path": "/a/path"}],
+                "skipped_tasks": ["c1/m1/etcd"],
+                "errors": [
+                    {"controller": "c1", "model": "m1", "task": "c1/m1/etcd"},
+                    # an error without task is matched by its application
+                    {"controller": "c1", "model": "m2", "app": "db"},
+                ],
+            }
+        )
+
+        with mock.patch.object(runner, "plan", return_value=(tasks, [])) as mock_plan:
+            with mock.patch.object(
+                runner,
+                "_backup",
+                side_effect=lambda task: json.dumps(
+                    {"app_backups": [{"download_path": task.name}]}
+                ),
+            ) as mock_backup:
+                results = json.loads(runner.retry_failed(backup_results))
+
+        mock_plan.assert_called_once_with(controller_names=["c1"])
+        self.assertEqual(
+            sorted(call[0][0].name for call in mock_backup.call_args_list),
+            ["c1/m1/etcd", "c1/m2/postgresql"],
+        )
+        self.assertEqual(len(results["app_backups"]), 3)
+        self.assertNotIn("errors", results)
+        self.assertNotIn("skipped_tasks", results)
+
+    def test_estimate(self):
+        """Test the estimate of a run from the task history."""
+        runner = BackupRunner(self.config_data, self.ssh_helper, concurrency=1)
+        runner.history.record("c1", 10, size=1000)
+        runner.history.record("c1/m1/etcd", 30, size=500)
+        tasks = [BackupTask("c1"), BackupTask("c1", "m1", "etcd"), BackupTask("c2")]
+
+        with mock.patch.object(runner, "plan", return_value=(tasks, [])) as mock_plan:
+            estimate = runner.estimate(omit_models=["m2"])
+
+        mock_plan.assert_called_once_with(omit_models=["m2"], push_ssh_keys=False)
+        self.assertEqual([task["task"] for task in estimate["tasks"]], ["c2", "c1/m1/etcd", "c1"])
+        self.assertEqual(estimate["tasks"][0]["expected_duration"], None)
+        self.assertEqual(estimate["tasks_without_history"], 1)
+        self.assertEqual(estimate["eta"], 40)
+        self.assertEqual(estimate["expected_bytes"], 1500)
+
+    def test_backup_results_size(self):
+        """Test the size of the backup files of a results document."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backup_file = pathlib.Path(tmpdir) / "backup.tar.gz"
+            backup_file.write_bytes(b"x" * 100)
+            results = {
+                "app_backups": [{"download_path": str(backup_file)}, {"app": "no path"}],
+                "controller_backups": [{"download_path": "/does/not/exist"}],
+                "errors": [],
+            }
+
+            self.assertEqual(backup_results_size(results), 100)
+
+    def test_task_timeout(self):
+        """Test the task timeout is adapted to the history of the task."""
+        runner = BackupRunner(
+            self.config_data, self.ssh_helper, adaptive_timeout=AdaptiveTimeout(2, 30, 3600)
+        )
+        for _ in range(5):
+            runner.history.record("c1/m1/etcd", 100)
+
+        self.assertEqual(runner._task_timeout(BackupTask("c1", "m1", "etcd")), 200)
+        # too little history, the configured timeout is used
+        self.assertEqual(runner._task_timeout(BackupTask("c1", "m1", "mysql")), 60)
+
+    def test_run_task_releases_models(self):
+        """Test the model connections of a worker are released after each task."""
+        runner = BackupRunner(self.config_data, self.ssh_helper)
+        with ConnectionPool().activate() as pool:
+            with mock.patch.object(pool, "release_models") as mock_release_models:
+                with mock.patch.object(runner, "_backup", side_effect=Exception("failed")):
+                    runner._run_task(BackupTask("c1", "m1", "etcd"))
+
+        mock_release_models.assert_called_once_with()
+
+    def test_merge_backup_results(self):
+        """Test results documents are merged."""
+        results = merge_backup_results(
+            [
+                json.dumps({"controller_backups": [{"download_path": "a"}]}),
+                json.dumps(
+                    {
+                        "controller_backups": [{"download_path": "b"}],
+                        "errors": [{"controller": "c2"}],
+                    }
+                ),
+            ]
+        )
+        self.assertEqual(
+            json.loads(results),
+            {
+                "controller_backups": [{"download_path": "a"}, {"download_path": "b"}],
+                "errors": [{"controller": "c2"}],
+            },
+        )
+
+    def test_run_in_workers(self):
+        """Test jobs run in their own event loop."""
+        results = run_in_workers(
+            {
+                "first": lambda: asyncio.get_event_loop().run_until_complete(asyncio.sleep(0, 1)),
+                "second": lambda: 2,
+            }
+        )
+        self.assertEqual(results, {"first": 1, "second": 2})
+
+
+class TestConnectionPool(unittest.TestCase):
+    """Test ConnectionPool's methods."""
+
+    @mock.patch("jujubackupall.utils.connect_model")
+    @mock.patch("jujubackupall.utils.connect_controller")
+    def test_connections_are_shared(self, mock_connect_controller, mock_connect_model):
+        """Test connections are set up once while the pool is active."""
+        with ConnectionPool().activate() as pool:
+            self.assertIs(ConnectionPool.current(), pool)
+            with connect_controller("c1") as controller:
+                with connect_model(controller, "m1") as model:
+                    pass
+            with connect_controller("c1") as other_controller:
+                with connect_model(other_controller, "m1") as other_model:
+                    pass
+
+            self.assertIs(controller, other_controller)
+            self.assertIs(model, other_model)
+            mock_connect_controller.return_value.__exit__.assert_not_called()
+
+        self.assertIsNone(ConnectionPool.current())
+        mock_connect_controller.assert_called_once_with("c1")
+        mock_connect_model.assert_called_once_with(controller, "m1")
+        mock_connect_controller.return_value.__exit__.assert_called_once()
+        mock_connect_model.return_value.__exit__.assert_called_once()
+
+    @mock.patch("jujubackupall.utils.connect_controller")
+    def test_no_pool(self, mock_connect_controller):
+        """Test connections are not shared without an active pool."""
+        with connect_controller("c1"):
+            pass
+        with connect_controller("c1"):
+            pass
+
+        self.assertEqual(mock_connect_controller.call_count, 2)
+        self.assertEqual(mock_connect_controller.return_value.__exit__.call_count, 2)
+
+    @mock.patch("jujubackupall.utils.connect_model")
+    @mock.patch("jujubackupall.utils.connect_controller")
+    def test_release_models(self, mock_connect_controller, mock_connect_model):
+        """Test the model connections are closed, and the controllers kept."""
+        with ConnectionPool().activate() as pool:
+            with connect_controller("c1") as controller:
+                with connect_model(controller, "m1"):
+                    pass
+            pool.release_models()
+
+            mock_connect_model.return_value.__exit__.assert_called_once()
+            mock_connect_controller.return_value.__exit__.assert_not_called()
+            with connect_controller("c1") as controller:
+                with connect_model(controller, "m1"):
+                    pass
+
+        mock_connect_controller.assert_called_once_with("c1")
+        self.assertEqual(mock_connect_model.call_count, 2)
+        self.assertEqual(mock_connect_model.return_value.__exit__.call_count, 2)
+
+    def test_add_model(self):
+        """Test models connected by the caller are disconnected with the pool."""
+        controller = mock.MagicMock()
+        model = mock.MagicMock()
+        model.disconnect = AsyncMock()
+        with ConnectionPool().activate() as pool:
+            self.assertIsNone(pool.cached_model(controller, "m1"))
+            pool.add_model(controller, "m1", model)
+            self.assertIs(pool.cached_model(controller, "m1"), model)
+            model.disconnect.assert_not_called()
+
+        model.disconnect.assert_called_once()
+
 
 class TestSSHKeyHelper(unittest.TestCase):
     """Test SSHKeyHelper's methods."""
@@ -139,6 +1024,93 @@ class TestSSHKeyHelper(unittest.TestCase):
             yaml.safe_load(ACCOUNTS_YAML)["controllers"],
         )
 
+    @mock.patch("utils.BackupProcessor")
+    @mock.patch("utils.connect_controller")
+    @mock.patch("utils.Paths")
+    def test_push_ssh_keys_to_models_incremental(
+        self,
+        mock_paths,
+        mock_connect_controller,
+        mock_backup_processor,
+    ):
+        """Test only new models are processed between full sweeps."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mock_paths.MODEL_INVENTORY_PATH = pathlib.Path(tmpdir) / "models.json"
+            mock_paths.SSH_PUBLIC_KEY.read_text.return_value = RAW_PUBKEY
+            mock_backup_processor.return_value.controller_names = ["test-controller"]
+            mock_connect_controller.return_value.__enter__.return_value = MockController
+            helper = SSHKeyHelper(
+                Config(args=MOCK_CONFIG),
+                yaml.safe_load(ACCOUNTS_YAML)["controllers"],
+                full_sweep_runs=3,
+            )
+
+            for _ in range(4):
+                helper.push_ssh_keys_to_models()
+
+            # the model is processed during the full sweeps of the 1st and 4th runs
+            self.assertEqual(MockController.get_model.call_count, 2)
+            self.assertTrue(mock_paths.MODEL_INVENTORY_PATH.is_file())
+
+        MockController.model_uuids.reset_mock()
+        MockController.get_model.reset_mock()
+        MockModel.get_ssh_keys.reset_mock()
+        MockModel.disconnect.reset_mock()
+
+    @mock.patch("utils.BackupProcessor")
+    @mock.patch("utils.connect_controller")
+    @mock.patch("utils.Paths")
+    def test_push_ssh_keys_to_models_cached(
+        self,
+        mock_paths,
+        mock_connect_controller,
+        mock_backup_processor,
+    ):
+        """Test models where the key was recently confirmed are skipped."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mock_paths.SSH_KEY_CACHE_PATH = pathlib.Path(tmpdir) / "cache.json"
+            mock_paths.MODEL_INVENTORY_PATH = pathlib.Path(tmpdir) / "models.json"
+            mock_paths.SSH_PUBLIC_KEY.read_text.return_value = RAW_PUBKEY
+            mock_backup_processor.return_value.controller_names = ["test-controller"]
+            mock_connect_controller.return_value.__enter__.return_value = MockController
+            helper = SSHKeyHelper(
+                Config(args=MOCK_CONFIG),
+                yaml.safe_load(ACCOUNTS_YAML)["controllers"],
+                cache_ttl=1,
+                full_sweep_runs=3,
+            )
+
+            # first run checks the model and caches the result, second run skips it
+            helper.push_ssh_keys_to_models()
+            helper.push_ssh_keys_to_models()
+
+            MockController.get_model.assert_called_once_with("test-model")
+            self.assertTrue(mock_paths.SSH_KEY_CACHE_PATH.is_file())
+
+            # the key was removed from the model and its backup failed: the key is
+            # checked regardless of the cache and pushed again
+            MockModel.get_ssh_keys.return_value = {"results": [{"result": None}]}
+            self.assertTrue(helper.repair_ssh_key("test-controller", "test-model"))
+            MockModel.add_ssh_keys.assert_called_once_with("admin", RAW_PUBKEY)
+            MockModel.get_ssh_keys.return_value = {"results": [{"result": SSH_FINGERPRINT}]}
+            self.assertFalse(helper.repair_ssh_key("test-controller", "test-model"))
+            self.assertEqual(MockController.get_model.call_count, 3)
+
+            # the key could not be checked: the cache and the inventory are invalidated,
+            # the model is checked again by the next run, which is not a full sweep
+            mock_connect_controller.return_value.__enter__.side_effect = Exception("down")
+            self.assertFalse(helper.repair_ssh_key("test-controller", "test-model"))
+            mock_connect_controller.return_value.__enter__.side_effect = None
+            helper.push_ssh_keys_to_models()
+
+            self.assertEqual(MockController.get_model.call_count, 4)
+
+        MockController.model_uuids.reset_mock()
+        MockController.get_model.reset_mock()
+        MockModel.get_ssh_keys.reset_mock()
+        MockModel.add_ssh_keys.reset_mock()
+        MockModel.disconnect.reset_mock()
+
     def test_gen_libjuju_ssh_key_fingerprint_invalid(self):
         """Test the ssh fingerprint generation."""
         with self.assertRaises(ValueError):
@@ -151,25 +1123,169 @@ class TestSSHKeyHelper(unittest.TestCase):
             SSH_FINGERPRINT,
         )
 
-    @mock.patch("utils.run_async")
-    def test_get_model_ssh_key_fingeprints(self, mock_run_async):
-        """Test the getting the model ssh fingerprint."""
-        result = "mock fingerprint"
-        mock_run_async.return_value = {"results": [{"result": result}]}
+    def test_gen_libjuju_ssh_key_fingerprint_ed25519(self):
+        """Test the ssh fingerprint generation of an ed25519 key."""
         self.assertEqual(
-            self.helper._get_model_ssh_key_fingeprints(self.model),
-            result,
+            self.helper._gen_libjuju_ssh_key_fingerprint(raw_pubkey=RAW_ED25519_PUBKEY),
+            SSH_ED25519_FINGERPRINT,
         )
 
+    def test_ssh_key_type(self):
+        """Test the detection of the ssh key type."""
+        self.assertEqual(ssh_key_type(RAW_PUBKEY), "rsa")
+        self.assertEqual(ssh_key_type(RAW_ED25519_PUBKEY), "ed25519")
+        with self.assertRaises(ValueError):
+            ssh_key_type("ssh-dss AAAA comment")
+
+    @mock.patch("utils.generate_ssh_key")
+    @mock.patch("utils.Paths")
+    def test_rotate_ssh_key(self, mock_paths, mock_generate_ssh_key):
+        """Test the ssh key rotation rollout."""
+
+        def generate_ssh_key(private_key_path, _key_type):
+            private_key_path.write_text("new private key")
+            mock_paths.SSH_NEW_PUBLIC_KEY.write_text(RAW_ED25519_PUBKEY)
+
+        mock_generate_ssh_key.side_effect = generate_ssh_key
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ssh_dir = pathlib.Path(tmpdir)
+            for name, filename in (
+                ("SSH_PRIVATE_KEY", "juju_id_rsa"),
+                ("SSH_PUBLIC_KEY", "juju_id_rsa.pub"),
+                ("SSH_NEW_PRIVATE_KEY", "juju_id_rsa.new"),
+                ("SSH_NEW_PUBLIC_KEY", "juju_id_rsa.new.pub"),
+                ("SSH_OLD_PRIVATE_KEY", "juju_id_rsa.old"),
+                ("SSH_OLD_PUBLIC_KEY", "juju_id_rsa.old.pub"),
+            ):
+                setattr(mock_paths, name, ssh_dir / filename)
+            mock_paths.SSH_PRIVATE_KEY.write_text("old private key")
+            mock_paths.SSH_PUBLIC_KEY.write_text(RAW_PUBKEY)
+
+            with mock.patch.object(self.helper, "push_ssh_keys_to_models") as mock_push:
+                with mock.patch.object(self.helper, "remove_ssh_keys_from_models") as mock_remove:
+                    # the new key cannot be pushed everywhere, the old key is kept
+                    mock_push.return_value = {"test-controller/test-model": "error"}
+                    rotation = self.helper.rotate_ssh_key("ed25519")
+                    self.assertEqual(rotation, {"switched": False, "removed": False})
+                    self.assertEqual(mock_paths.SSH_PUBLIC_KEY.read_text(), RAW_PUBKEY)
+                    mock_remove.assert_not_called()
+
+                    # the old key cannot be removed everywhere, it is kept for a retry
+                    mock_push.return_value = {}
+                    mock_remove.return_value = {"test-controller/test-model": "error"}
+                    rotation = self.helper.rotate_ssh_key("ed25519")
+                    self.assertEqual(rotation, {"switched": True, "removed": False})
+                    mock_push.assert_called_with(
+                        public_key_path=mock_paths.SSH_NEW_PUBLIC_KEY, full_sweep=True
+                    )
+                    self.assertEqual(mock_paths.SSH_PUBLIC_KEY.read_text(), RAW_ED25519_PUBKEY)
+                    self.assertEqual(mock_paths.SSH_PRIVATE_KEY.read_text(), "new private key")
+                    self.assertTrue(mock_paths.SSH_OLD_PUBLIC_KEY.exists())
+
+                    # the rotation resumes with the removal of the old key
+                    mock_push.reset_mock()
+                    mock_remove.return_value = {}
+                    rotation = self.helper.rotate_ssh_key("ed25519")
+                    self.assertEqual(rotation, {"switched": True, "removed": True})
+                    mock_push.assert_not_called()
+                    mock_remove.assert_called_with(RAW_PUBKEY)
+                    self.assertFalse(mock_paths.SSH_OLD_PRIVATE_KEY.exists())
+                    self.assertFalse(mock_paths.SSH_OLD_PUBLIC_KEY.exists())
+
+            mock_generate_ssh_key.assert_called_once_with(
+                mock_paths.SSH_NEW_PRIVATE_KEY, "ed25519"
+            )
+
+    @mock.patch("utils.BackupProcessor")
+    @mock.patch("utils.connect_controller")
+    def test_remove_ssh_keys_from_models(self, mock_connect_controller, mock_backup_processor):
+        """Test the removal of a key from all models."""
+        mock_backup_processor.return_value.controller_names = ["test-controller"]
+        controller = mock.MagicMock()
+        controller.list_models = AsyncMock(return_value=["with-key", "without-key"])
+        with_key, without_key = mock.MagicMock(), mock.MagicMock()
+        with_key.get_ssh_keys = AsyncMock(
+            return_value={"results": [{"result": [SSH_FINGERPRINT]}]}
+        )
+        without_key.get_ssh_keys = AsyncMock(return_value={"results": [{"result": None}]})
+        for model in (with_key, without_key):
+            model.remove_ssh_key = AsyncMock()
+        controller.get_model = AsyncMock(
+            side_effect=lambda name: with_key if name == "with-key" else without_key
+        )
+        mock_connect_controller.return_value.__enter__.return_value = controller
+
+        failures = self.helper.remove_ssh_keys_from_models(RAW_PUBKEY)
+
+        self.assertEqual(failures, {})
+        with_key.remove_ssh_key.assert_called_once_with("admin", RAW_PUBKEY)
+        without_key.remove_ssh_key.assert_not_called()
+        models_report = self.helper.report["test-controller"]["models"]
+        self.assertTrue(models_report["with-key"]["key_removed"])
+        self.assertFalse(models_report["without-key"]["key_removed"])
+
+    @mock.patch("utils.client.KeyManagerFacade.from_connection")
+    @mock.patch("utils.BackupProcessor")
+    @mock.patch("utils.connect_controller")
+    @mock.patch("utils.Shard.load", return_value=None)
+    @mock.patch("utils.Paths")
+    def test_gc_stale_ssh_keys(
+        self,
+        mock_paths,
+        mock_shard_load,
+        mock_connect_controller,
+        mock_backup_processor,
+        mock_key_facade,
+    ):
+        """Test the removal of the stale backup keys."""
+        mock_paths.SSH_PUBLIC_KEY.read_text.return_value = RAW_PUBKEY
+        mock_paths.SSH_NEW_PUBLIC_KEY.exists.return_value = False
+        mock_backup_processor.return_value.controller_names = ["test-controller"]
+        controller = mock.MagicMock()
+        controller.list_models = AsyncMock(return_value=["test-model"])
+        model = mock.MagicMock()
+        stale = "2a:e3:c7:e1:85:62:ec:67:c3:de:6c:23:87:2a:ba:8f (jujubackup@old-host)"
+        model.get_ssh_keys = AsyncMock(
+            return_value={
+                "results": [{"result": [SSH_FINGERPRINT, stale, "aa:bb (admin@laptop)"]}]
+            }
+        )
+        controller.get_model = AsyncMock(return_value=model)
+        mock_connect_controller.return_value.__enter__.return_value = controller
+        mock_key_facade.return_value.DeleteKeys = AsyncMock()
+
+        # the dry-run only reports the stale keys
+        self.assertEqual(self.helper.gc_stale_ssh_keys(dry_run=True), {})
+        mock_key_facade.return_value.DeleteKeys.assert_not_called()
+        models_report = self.helper.report["test-controller"]["models"]
+        self.assertEqual(models_report["test-model"]["stale_keys"], [stale])
+
+        self.assertEqual(self.helper.gc_stale_ssh_keys(), {})
+        mock_key_facade.return_value.DeleteKeys.assert_called_once_with(
+            ssh_keys=["2a:e3:c7:e1:85:62:ec:67:c3:de:6c:23:87:2a:ba:8f"], user="admin"
+        )
+
+    def test_get_model_ssh_key_fingeprints(self):
+        """Test the getting the model ssh fingerprint."""
+        result = "mock fingerprint"
+        self.model.get_ssh_keys = AsyncMock(return_value={"results": [{"result": result}]})
+        # asyncio.run would unset the event loop of the main thread, used by other tests
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                loop.run_until_complete(self.helper._get_model_ssh_key_fingeprints(self.model)),
+                result,
+            )
+        finally:
+            loop.close()
+
     @mock.patch("utils.BackupProcessor")
-    @mock.patch("utils.connect_model")
     @mock.patch("utils.connect_controller")
     @mock.patch("utils.Paths.SSH_PUBLIC_KEY")
     def test_push_ssh_keys_to_models(
         self,
         mock_pubkey_path,
         mock_connect_controller,
-        mock_connect_model,
         mock_backup_processor,
     ):
         """Parameterized test for ssh key push."""
@@ -190,25 +1306,69 @@ class TestSSHKeyHelper(unittest.TestCase):
         test_controller_name = "test-controller"
         mock_backup_processor.return_value.controller_names = [test_controller_name]
         mock_connect_controller.return_value.__enter__.return_value = MockController
-        mock_connect_model.return_value.__enter__.return_value = MockModel
 
         for msg, ssh_pubkey, add_ssh_keys_test in params:
             with self.subTest(msg):
                 mock_pubkey_path.read_text.return_value = ssh_pubkey
-                self.helper.push_ssh_keys_to_models()
+                failures = self.helper.push_ssh_keys_to_models()
 
+                self.assertEqual(failures, {})
                 mock_pubkey_path.read_text.assert_called()
                 mock_backup_processor.assert_called_once()
                 mock_connect_controller.assert_called_once_with(test_controller_name)
-                MockController.list_models.assert_called_once()
-                mock_connect_model.assert_called_once_with(MockController, "test-model")
+                MockController.model_uuids.assert_called_once()
+                MockController.get_model.assert_called_once_with("test-model")
                 MockModel.get_ssh_keys.assert_called_once()
+                MockModel.disconnect.assert_called_once()
                 add_ssh_keys_test(MockModel.add_ssh_keys)
 
             # reset mocks at the end of each test iteration
             mock_connect_controller.reset_mock()
-            mock_connect_model.reset_mock()
             mock_backup_processor.reset_mock()
-            MockController.list_models.reset_mock()
+            MockController.model_uuids.reset_mock()
+            MockController.get_model.reset_mock()
             MockModel.get_ssh_keys.reset_mock()
             MockModel.add_ssh_keys.reset_mock()
+            MockModel.disconnect.reset_mock()
+
+    @mock.patch("utils.BackupProcessor")
+    @mock.patch("utils.connect_controller")
+    @mock.patch("utils.Paths.SSH_PUBLIC_KEY")
+    def test_push_ssh_keys_to_models_failures(
+        self,
+        mock_pubkey_path,
+        mock_connect_controller,
+        mock_backup_processor,
+    ):
+        """Test ssh key push failures are collected per model."""
+        mock_pubkey_path.read_text.return_value = RAW_PUBKEY
+        mock_backup_processor.return_value.controller_names = ["test-controller"]
+        controller = mock.MagicMock()
+        controller.model_uuids = AsyncMock(
+            return_value={"good-model": "good-uuid", "bad-model": "bad-uuid"}
+        )
+
+        def get_model(model_name):
+            if model_name == "bad-model":
+                raise Exception("connection refused")
+            return MockModel
+
+        controller.get_model = AsyncMock(side_effect=get_model)
+        mock_connect_controller.return_value.__enter__.return_value = controller
+
+        progress = mock.Mock()
+        self.helper.progress = progress
+        failures = self.helper.push_ssh_keys_to_models()
+
+        self.assertEqual(failures, {"test-controller/bad-model": "connection refused"})
+        models_report = self.helper.report["test-controller"]["models"]
+        self.assertEqual(models_report["bad-model"]["error"], "connection refused")
+        self.assertFalse(models_report["good-model"]["key_added"])
+        self.assertEqual(models_report["good-model"]["key_check"], "model")
+        self.assertIn("key_check_time", models_report["good-model"])
+        self.assertIn("connect_time", self.helper.report["test-controller"])
+        progress.assert_any_call("test-controller/bad-model: failed: connection refused")
+        progress.assert_any_call("test-controller/good-model: key present (checked by model)")
+        MockModel.add_ssh_keys.assert_not_called()
+        MockModel.disconnect.reset_mock()
+        MockModel.get_ssh_keys.reset_mock()